@@ -1,17 +1,29 @@
 import os
+import time
 import click
-from flask import Flask, request
+from flask import Flask, request, got_request_exception
 import logging
 
 from MyBlog.blueprint.admin import admin_my
 from MyBlog.blueprint.blog import blog_my
 from MyBlog.blueprint.login import login_my
-from MyBlog.extensions import db, ckeditor, moment, bootstrap, login, csrf, migrate
+from MyBlog.blueprint.feed import feed_my
+from MyBlog.extensions import db, ckeditor, moment, bootstrap, login, csrf, site_cache, page_cache, \
+    profiler, assets, comment_queue, fragment_cache, identity_cache
 from MyBlog.settings import config
-from MyBlog.models import Admin, Category, Post, Comment
-from MyBlog.fakes import fake_admin, fake_post, fake_category, fake_comment
+from MyBlog.models import Admin, Category
+from MyBlog.signals import register_session_events
+from MyBlog.queries import register_query_budget
+from MyBlog.counters import register_counter_events, recompute_counters
+from MyBlog.utils import freezing
+from MyBlog.search import search_index
+from MyBlog.instrumentation import register_instrumentation, request_statements, perf_logger, JSONFormatter
+from MyBlog.logwriter import get_writer, writer_stats
+from MyBlog.uploads import responsive_images, check_image_support
+from MyBlog.compression import register_compression
+from MyBlog.feeds import feed_cache
+from MyBlog.database import configure_database, register_pragmas
 from flask_login import current_user
-from logging.handlers import RotatingFileHandler
 
 basedir = os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
 
@@ -32,6 +44,10 @@ def create_app(config_name=None):
     register_extensions(app)
     register_blueprint(app)
     register_logging(app)
+    check_image_support(app)
+    register_instrumentation(app)
+    register_query_budget(app)
+    register_compression(app)  # 最后注册的after_request最先执行,计时与日志记录压缩后的大小
 
     return app
 
@@ -41,8 +57,9 @@ def register_logging(app):
     class RequestFormatter(logging.Formatter):
 
         def format(self, record):
-            record.url = request.url
-            record.remote_addr = request.remote_addr
+            # 请求信息由RequestQueueHandler在入队时取出,写线程中没有请求上下文
+            record.url = getattr(record, 'url', '-')
+            record.remote_addr = getattr(record, 'remote_addr', '-')
             return super(RequestFormatter, self).format(record)
 
     request_formatter = RequestFormatter(
@@ -50,15 +67,17 @@ def register_logging(app):
         '%(levelname)s in %(module)s: %(message)s'
     )
 
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-
-    file_handler = RotatingFileHandler(os.path.join(basedir, 'logs/MyBlog.log'),
-                                       maxBytes=10 * 1024 * 1024, backupCount=10)
-    file_handler.setFormatter(formatter)
-    file_handler.setLevel(logging.INFO)
-
+    # 文件写入和轮转都在后台写线程中进行,请求线程只入队
     if not app.debug:
-        app.logger.addHandler(file_handler)
+        writer = get_writer(os.path.join(basedir, 'logs/MyBlog.log'), request_formatter, app.config)
+        app.logger.addHandler(writer.handler(logging.INFO))
+
+    # 性能日志单独写入,每行一个JSON
+    perf_logger.setLevel(logging.INFO)
+    perf_logger.propagate = False
+    if app.config['MYBLOG_PERF_LOG'] and not perf_logger.handlers:
+        writer = get_writer(app.config['MYBLOG_PERF_LOG'], JSONFormatter(), app.config)
+        perf_logger.addHandler(writer.handler())
 
 
 # 组织蓝本
@@ -66,36 +85,51 @@ def register_blueprint(app):
     app.register_blueprint(blog_my)
     app.register_blueprint(login_my, url_prefix='/auth')
     app.register_blueprint(admin_my, url_prefix='/admin')
+    app.register_blueprint(feed_my)
 
 
 def register_template_context(app):
+    app.add_template_filter(responsive_images)  # 文章正文中的上传图片使用srcset
+    app.add_template_global(freezing)  # flask freeze渲染静态页面时为True
+
     @app.context_processor
     def make_template_context():
-        admin = Admin.query.first()
-        categories = Category.query.order_by(Category.name).all()
-        posts = Post.query.order_by(Post.timestamp).all()
-
-        if current_user.is_authenticated:
-            unread_comments = Comment.query.filter_by(reviewed=False).count()
-        else:
-            unread_comments = None
+        # 管理员设置和分类列表来自site_cache,相关记录提交变更后自动失效
+        site = site_cache.get()
+
         return dict(
-            admin=admin,
-            categories=categories,
-            posts=posts,
-            unread_comments=unread_comments
+            admin=site['admin'],
+            categories=site['categories'],
+            # 读取冗余计数器(随身份缓存),队列中尚未写入的评论也是未读评论
+            unread_comments=identity_cache.unread_comments() + comment_queue.pending_count()
+            if current_user.is_authenticated else None
         )
 
 
 # 调用init_app()方法，传入程序实例，完成拓展初始化
 def register_extensions(app):
     bootstrap.init_app(app)
+    configure_database(app)
     db.init_app(app)
+    register_pragmas(app, db)
     moment.init_app(app)
     ckeditor.init_app(app)
     login.init_app(app)
     csrf.init_app(app)
-    migrate.init_app(app)
+    site_cache.init_app(app)
+    page_cache.init_app(app)
+    identity_cache.init_app(app)
+    fragment_cache.init_app(app)  # 注册{% cache %}模板标签
+    search_index.init_app(app)
+    profiler.init_app(app)
+    assets.init_app(app)
+    comment_queue.init_app(app)
+    if app.config['MYBLOG_DEBUG_TOOLBAR']:
+        # 仅开发时按需加载,生产环境不导入
+        from flask_debugtoolbar import DebugToolbarExtension
+        DebugToolbarExtension(app)
+    register_session_events(db.session)
+    register_counter_events()
 
     return app
 
@@ -103,10 +137,17 @@ def register_extensions(app):
 def register_shell_context(app):
     @app.shell_context_processor
     def make_shell_context():
-        return dict(db=db)
+        return dict(db=db, site_cache=site_cache, page_cache=page_cache, search_index=search_index,
+                    feed_cache=feed_cache, fragment_cache=fragment_cache, identity_cache=identity_cache,
+                    writer_stats=writer_stats)
 
 
 def register_commands(app):
+    # Flask-Migrate会导入alembic,只在flask命令行中加载;gunicorn worker不需要flask db命令
+    if click.get_current_context(silent=True) is not None:
+        from flask_migrate import Migrate
+        Migrate(app, db)
+
     @app.cli.command()  # 添加命令行接口
     @click.option('--drop', is_flag=True, help='重新创建数据库表')  # 使用click提供的option装饰器添加自定义数量支持
     def initdb(drop):  # 初始化数据库,传入drop参数
@@ -116,6 +157,8 @@ def register_commands(app):
             db.drop_all()
             click.echo('删除数据库')
         db.create_all()
+        recompute_counters()
+        search_index.rebuild()
         click.echo('已重置数据库')
 
     @app.cli.command()
@@ -151,6 +194,7 @@ def register_commands(app):
             db.session.add(category)
 
         db.session.commit()  # 调用session.commit()，将改动提交到数据库
+        recompute_counters()
         click.echo('完成.')
 
 
@@ -158,7 +202,14 @@ def register_commands(app):
     @click.option('--category', default=5, help='分类数量,默认值为5个')
     @click.option('--post', default=25, help='文章数量,默认值为25篇')
     @click.option('--comment', default=150, help='评论数量,默认值为150个')
-    def forge(category, post, comment):
+    @click.option('--batch-size', default=1000, help='每批写入的行数')
+    @click.option('--seed', type=int, help='随机种子,相同种子生成相同的数据')
+    @click.option('--processes', default=1, help='并行生成文本的进程数')
+    def forge(category, post, comment, batch_size, seed, processes):
+        """生成虚拟数据"""
+        from MyBlog.fakes import fake_admin, fake_post, fake_category, fake_comment  # Faker只在这里用到
+        from MyBlog.threads import rebuild_threads
+
         db.drop_all()
         db.create_all()
 
@@ -166,15 +217,220 @@ def register_commands(app):
         fake_admin()
 
         click.echo('生成 %d 个分类...' % category)
-        fake_category(category)
+        fake_category(category, seed=seed)
 
         click.echo('生成 %d 篇文章...' % post)
-        fake_post(post)
+        fake_post(post, batch_size, seed, processes, progress=_progress())
 
         click.echo('生成 %d 个评论...' % comment)
-        fake_comment(comment)
-
+        fake_comment(comment, batch_size, seed, processes, progress=_progress())
+        rebuild_threads(batch_size=batch_size)  # Core批量写入不会触发生成路径的事件
+
+        recompute_counters()
+        site_cache.invalidate()  # Core批量写入不会触发数据变更信号
+        page_cache.clear()
+        click.echo('建立搜索索引...')
+        search_index.rebuild()
         click.echo('数据生成完毕！')
 
+    @app.cli.command()
+    @click.option('--batch-size', default=500, help='每批处理的文章数')
+    def excerpts(batch_size):
+        """重新生成全部文章的摘要、字数和阅读时间"""
+        from MyBlog.schema import backfill_excerpts
+        total = backfill_excerpts(batch_size)
+        click.echo('已更新 %d 篇文章的摘要' % total)
+
+    @app.cli.command('upgrade-schema')
+    @click.option('--batch-size', default=1000, help='每批回填的行数')
+    def upgrade_schema(batch_size):
+        """升级旧版本的数据库:添加新增的表、列和索引,回填最后修改时间、摘要、计数、评论路径和搜索索引,可重复执行"""
+        from MyBlog.schema import upgrade_tables, backfill_updated, backfill_excerpts
+        from MyBlog.threads import rebuild_threads
+        changes = upgrade_tables()
+        for change in changes:
+            click.echo(change)
+        if not changes:
+            click.echo('数据库结构已是最新')
+        click.echo('回填最后修改时间: %d 篇文章' % backfill_updated())
+        click.echo('回填摘要: %d 篇文章' % backfill_excerpts(batch_size, missing_only=True))
+        click.echo('生成评论路径: %d 条评论' % rebuild_threads(batch_size=batch_size))
+        mismatches = recompute_counters()
+        click.echo('修复计数: %s' % ', '.join('%s %d' % item for item in sorted(mismatches.items())))
+        click.echo('已索引 %d 篇文章' % search_index.rebuild(batch_size))
+        site_cache.invalidate()
+        page_cache.clear()
+        feed_cache.clear()
+
+    @app.cli.command()
+    @click.option('--check', is_flag=True, help='只检查不修复,存在不一致时返回非零退出码')
+    def counters(check):
+        """重新统计评论数、分类文章数和未读评论数"""
+        mismatches = recompute_counters(fix=not check)
+        for name, count in sorted(mismatches.items()):
+            click.echo('%s: %d 条不一致%s' % (name, count, '' if check or not count else ',已修复'))
+        if check and any(mismatches.values()):
+            raise SystemExit(1)
+
+    @app.cli.command()
+    @click.option('--full', is_flag=True, help='重新生成全部评论的路径')
+    @click.option('--batch-size', default=1000, help='每批更新的评论数')
+    def threads(full, batch_size):
+        """为评论生成回复树路径(升级后或直接写入数据库后执行)"""
+        from MyBlog.threads import rebuild_threads
+        count = rebuild_threads(full, batch_size)
+        page_cache.clear()
+        click.echo('已更新 %d 条评论的路径' % count)
+
+    @app.cli.command()
+    @click.option('--batch-size', default=1000, help='每批写入索引的文章数')
+    def reindex(batch_size):
+        """重建全文搜索索引"""
+        count = search_index.rebuild(batch_size)
+        click.echo('已索引 %d 篇文章(%s)' % (count, search_index.backend.name))
+
+    @app.cli.command('assets')
+    @click.option('--no-compress', is_flag=True, help='不生成.gz/.br预压缩文件')
+    def build_assets(no_compress):
+        """生成静态文件指纹清单和预压缩文件"""
+        count, compressed = assets.build(compress=not no_compress)
+        click.echo('已记录 %d 个静态文件的指纹,生成 %d 个预压缩文件' % (count, compressed))
+
+    @app.cli.command('flush-comments')
+    def flush_comments():
+        """把评论队列中的评论全部写入数据库"""
+        if not comment_queue.enabled:
+            click.echo('未开启评论队列(MYBLOG_COMMENT_QUEUE)')
+            return
+        total = 0
+        while True:
+            count = comment_queue.flush()
+            total += count
+            if count < comment_queue.batch_size:
+                break
+        click.echo('已写入 %d 条评论' % total)
+
+    @app.cli.command('export')
+    @click.argument('path')
+    @click.option('--batch-size', default=1000, help='每次从数据库读取的行数')
+    @click.option('--no-uploads', is_flag=True, help='.tar.gz归档中不包含上传文件')
+    def export_data(path, batch_size, no_uploads):
+        """导出管理员、分类、文章和评论到.ndjson(.gz)或.tar.gz"""
+        from MyBlog.archive import export_archive
+        progress = _table_progress()
+        counts = export_archive(path, batch_size, uploads=not no_uploads, progress=progress)
+        progress.finish()
+        click.echo('已导出: %s' % ', '.join('%s %d' % item for item in counts.items()))
+
+    @app.cli.command('import')
+    @click.argument('path', type=click.Path(exists=True, dir_okay=False))
+    @click.option('--batch-size', default=1000, help='每批写入的行数')
+    @click.option('--no-uploads', is_flag=True, help='不导入归档中的上传文件')
+    def import_data(path, batch_size, no_uploads):
+        """从flask export生成的归档导入,中断后再次执行会从检查点继续"""
+        from MyBlog.archive import import_archive, ArchiveError
+        from MyBlog.threads import rebuild_threads
+        progress = _table_progress()
+        try:
+            counts = import_archive(path, batch_size, uploads=not no_uploads, progress=progress)
+        except ArchiveError as e:
+            raise click.ClickException(str(e))
+        finally:
+            progress.finish()
+        rebuild_threads(batch_size=batch_size)  # 旧版本导出的评论没有路径
+        recompute_counters()
+        site_cache.invalidate()  # Core批量写入不会触发数据变更信号
+        page_cache.clear()
+        feed_cache.clear()
+        click.echo('建立搜索索引...')
+        search_index.rebuild()
+        click.echo('已导入: %s' % ', '.join('%s %d' % item for item in counts.items()))
+
+    @app.cli.command()
+    @click.argument('output', required=False)
+    @click.option('--workers', default=4, help='并行渲染的线程数')
+    @click.option('--full', is_flag=True, help='忽略上次导出的记录,重新渲染全部页面')
+    def freeze(output, workers, full):
+        """把首页、分类页和文章页导出为静态HTML,默认只渲染有变化的页面"""
+        from MyBlog.freeze import freeze_site, FreezeError
+        output = output or app.config['MYBLOG_FREEZE_PATH']
+        try:
+            counts = freeze_site(output, workers, full, progress=_progress('页'))
+        except FreezeError as e:
+            raise click.ClickException(str(e))
+        click.echo('已导出到 %s: 渲染 %d 个页面, %d 个未变化, 删除 %d 个文件, 复制 %d 个文件' % (
+            output, counts['rendered'], counts['unchanged'], counts['removed'], counts['copied']))
+
+    @app.cli.command('startup-profile')
+    @click.option('--config', 'config_name', default='production', help='创建应用使用的配置名')
+    @click.option('--top', default=25, help='显示的模块数')
+    @click.option('--sort', type=click.Choice(['cumulative', 'self']), default='cumulative', help='排序方式')
+    def startup_profile(config_name, top, sort):
+        """在新的解释器中导入MyBlog并创建应用,按模块显示导入耗时(同python -X importtime)"""
+        from MyBlog.startup import profile_startup
+        try:
+            result = profile_startup(config_name)
+        except RuntimeError as e:
+            raise click.ClickException(str(e))
+        click.echo('导入MyBlog %.1f ms, create_app %.1f ms, 共导入 %d 个模块' % (
+            result['import_ms'], result['create_app_ms'], len(result['modules'])))
+        click.echo('%10s %10s  %s' % ('自身 ms', '累计 ms', '模块'))
+        key = (lambda m: m['cumulative']) if sort == 'cumulative' else (lambda m: m['self'])
+        for module in sorted(result['modules'], key=key, reverse=True)[:top]:
+            click.echo('%10.1f %10.1f  %s%s' % (module['self'] / 1000.0, module['cumulative'] / 1000.0,
+                                               '  ' * module['depth'], module['name']))
+
+    @app.cli.command()
+    @click.option('--endpoint', help='只显示该端点的采样')
+    @click.option('--output', type=click.File('w'), help='把折叠栈写入文件,可直接交给flamegraph.pl')
+    @click.option('--top', default=20, help='显示的热点函数数')
+    @click.option('--clear', is_flag=True, help='清空已有采样')
+    def profile(endpoint, output, top, clear):
+        """汇总采样分析器的结果"""
+        if clear:
+            profiler.clear()
+            click.echo('已清空采样')
+            return
+        stacks = profiler.load(endpoint)
+        if output is not None:
+            output.write(profiler.collapsed(stacks))
+        total = sum(stacks.values())
+        click.echo('共 %d 个采样' % total)
+        for frame, own, cumulative in profiler.top(stacks, top):
+            click.echo('%6.1f%% %6.1f%%  %s' % (own * 100.0 / total, cumulative * 100.0 / total, frame))
+
+# 批量写入进度:已完成数量和每秒数量
+def _progress(unit='行'):
+    start = time.time()
+
+    def report(done, total):
+        rate = done / max(time.time() - start, 1e-6)
+        click.echo('\r  %d/%d (%d%%) %.0f %s/秒' % (done, total, done * 100 // max(total, 1), rate, unit),
+                   nl=done >= total)
+    return report
+
+
+# 导出导入进度:当前表和已处理行数
+def _table_progress():
+    current = dict(table=None, start=None)
+
+    def report(table, done):
+        if table != current['table']:
+            if current['table'] is not None:
+                click.echo()
+            current.update(table=table, start=time.time())
+        rate = done / max(time.time() - current['start'], 1e-6)
+        click.echo('\r  %s: %d 行 %.0f 行/秒' % (table, done, rate), nl=False)
+
+    report.finish = lambda: current['table'] is not None and click.echo()
+    return report
+
+
 def register_errors(app):
-    pass
\ No newline at end of file
+    # 未处理的异常连同该请求已执行的SQL一起记录
+    @got_request_exception.connect_via(app)
+    def log_exception(sender, exception, **extra):
+        perf_logger.error('unhandled exception', exc_info=exception, extra=dict(perf=dict(
+            method=request.method, path=request.full_path.rstrip('?'), endpoint=request.endpoint,
+            statements=[dict(ms=round(duration, 2), sql=statement, params=repr(parameters)[:200])
+                        for duration, statement, parameters in request_statements()])))
\ No newline at end of file
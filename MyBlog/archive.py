@@ -0,0 +1,304 @@
+import datetime
+import gzip
+import io
+import json
+import os
+import tarfile
+import tempfile
+
+from flask import current_app
+from sqlalchemy import func
+
+from MyBlog.extensions import db
+
+# 导出/导入:按外键顺序逐表用游标分批读取,每行一条JSON(NDJSON);
+# .ndjson(.gz)为单个文件,.tar.gz中每个表一个成员并附带上传目录。
+# 导入用Core executemany按批写入,每批提交后记录检查点,中断后重新执行即可从断点继续
+
+FORMAT = 'myblog-export'
+VERSION = 1
+TABLES = ('admin', 'category', 'post', 'comment')   # 被引用的表在前
+
+
+class ArchiveError(ValueError):
+    pass
+
+
+def _table(name):
+    return db.metadata.tables[name]
+
+
+def _encode(value):
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    raise TypeError(repr(value))
+
+
+def _dumps(obj):
+    return json.dumps(obj, ensure_ascii=False, default=_encode, separators=(',', ':'))
+
+
+def _parse_datetime(value):
+    # _encode()写入的isoformat()格式;datetime.fromisoformat()要求Python 3.7
+    layout = '%Y-%m-%dT%H:%M:%S.%f' if '.' in value else '%Y-%m-%dT%H:%M:%S'
+    return datetime.datetime.strptime(value, layout)
+
+
+def _decoder(table):
+    """返回把导出的字典转换为可插入行的函数,忽略目标库中不存在的列"""
+    columns = {column.name: column for column in table.columns}
+    datetimes = set(name for name, column in columns.items() if isinstance(column.type, db.DateTime))
+
+    def decode(row):
+        values = {}
+        for key, value in row.items():
+            if key not in columns:
+                continue
+            if key in datetimes and value is not None:
+                value = _parse_datetime(value)
+            values[key] = value
+        return values
+    return decode
+
+
+def iter_rows(name, batch_size=1000):
+    """按主键顺序流式读取一个表,每次只取batch_size行"""
+    table = _table(name)
+    connection = db.session.connection().execution_options(stream_results=True)
+    result = connection.execute(table.select().order_by(*table.primary_key.columns))
+    keys = list(result.keys())
+    try:
+        while True:
+            rows = result.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield dict(zip(keys, row))
+    finally:
+        result.close()
+
+
+def _upload_files(folder):
+    for root, dirs, files in os.walk(folder):
+        dirs.sort()
+        for name in sorted(files):
+            if not name.endswith('.part'):
+                path = os.path.join(root, name)
+                yield os.path.relpath(path, folder).replace(os.sep, '/'), path
+
+
+def _is_tar(path):
+    return path.endswith(('.tar.gz', '.tgz', '.tar'))
+
+
+def export_archive(path, batch_size=1000, uploads=True, progress=None):
+    """导出到path,返回{表名: 行数}(以及'uploads': 文件数)"""
+    counts = {}
+    header = dict(format=FORMAT, version=VERSION, tables=list(TABLES),
+                  created=datetime.datetime.utcnow().isoformat())
+    if _is_tar(path):
+        with tarfile.open(path, 'w:gz' if path.endswith(('.gz', '.tgz')) else 'w') as tar:
+            _add_bytes(tar, 'manifest.json', _dumps(header).encode('utf-8'))
+            for name in TABLES:
+                # 成员大小需预先知道,先写入临时文件,内存占用与表大小无关
+                with tempfile.TemporaryFile() as f:
+                    counts[name] = 0
+                    for row in iter_rows(name, batch_size):
+                        f.write(_dumps(row).encode('utf-8') + b'\n')
+                        counts[name] += 1
+                        if progress is not None and counts[name] % batch_size == 0:
+                            progress(name, counts[name])
+                    info = tarfile.TarInfo('%s.ndjson' % name)
+                    info.size = f.tell()
+                    info.mtime = int(datetime.datetime.now().timestamp())
+                    f.seek(0)
+                    tar.addfile(info, f)
+            if uploads:
+                counts['uploads'] = 0
+                for name, file_path in _upload_files(current_app.config['MYBLOG_UPLOAD_PATH']):
+                    tar.add(file_path, 'uploads/' + name)
+                    counts['uploads'] += 1
+        return counts
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'wt', encoding='utf-8') as f:
+        f.write(_dumps(header) + '\n')
+        for name in TABLES:
+            counts[name] = 0
+            for row in iter_rows(name, batch_size):
+                f.write(_dumps(dict(table=name, row=row)) + '\n')
+                counts[name] += 1
+                if progress is not None and counts[name] % batch_size == 0:
+                    progress(name, counts[name])
+    return counts
+
+
+def _add_bytes(tar, name, data):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = int(datetime.datetime.now().timestamp())
+    tar.addfile(info, io.BytesIO(data))
+
+
+def _check_header(header):
+    if header.get('format') != FORMAT:
+        raise ArchiveError('not a MyBlog export')
+    if header.get('version', 0) > VERSION:
+        raise ArchiveError('export version %s is newer than supported (%d)' % (header.get('version'), VERSION))
+
+
+def read_archive(path):
+    """依次产生('row', 表名, 字典)与('upload', 相对路径, 文件对象);文件对象须在取下一项前读完"""
+    if _is_tar(path):
+        # 流式读取,成员按写入顺序(即外键顺序)处理
+        with tarfile.open(path, 'r|*') as tar:
+            header = None
+            for member in tar:
+                if member.name == 'manifest.json':
+                    header = json.loads(tar.extractfile(member).read().decode('utf-8'))
+                    _check_header(header)
+                elif header is None:
+                    raise ArchiveError('manifest.json missing')
+                elif member.name.endswith('.ndjson'):
+                    name = member.name[:-len('.ndjson')]
+                    for line in tar.extractfile(member):
+                        if line.strip():
+                            yield 'row', name, json.loads(line.decode('utf-8'))
+                elif member.isfile() and member.name.startswith('uploads/'):
+                    yield 'upload', member.name[len('uploads/'):], tar.extractfile(member)
+        return
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt', encoding='utf-8') as f:
+        _check_header(json.loads(f.readline() or '{}'))
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                yield 'row', record['table'], record['row']
+
+
+class Checkpoint(object):
+    """导入进度:各表已提交的最大id,以及等待补写的回复关系;保存在<归档>.checkpoint"""
+
+    def __init__(self, archive):
+        self.path = archive + '.checkpoint'
+        self.size = os.path.getsize(archive)
+        self.tables = {}
+        self.deferred = []
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                data = json.load(f)
+            if data.get('size') != self.size:
+                raise ArchiveError('checkpoint %s belongs to another archive' % self.path)
+            self.tables = data['tables']
+            self.deferred = data['deferred']
+
+    @property
+    def started(self):
+        return bool(self.tables)
+
+    def save(self):
+        with open(self.path + '.part', 'w') as f:
+            json.dump(dict(size=self.size, tables=self.tables, deferred=self.deferred), f)
+        os.replace(self.path + '.part', self.path)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def _max_id(table):
+    return db.session.query(func.max(table.c.id)).scalar() or 0
+
+
+def import_archive(path, batch_size=1000, uploads=True, progress=None):
+    """导入path,返回{表名: 新写入行数};目标库已有数据且没有检查点时抛出ArchiveError"""
+    checkpoint = Checkpoint(path)
+    db.create_all()
+    if not checkpoint.started and any(_max_id(_table(name)) for name in TABLES):
+        raise ArchiveError('database is not empty')
+    counts = dict((name, 0) for name in TABLES)
+    counts['uploads'] = 0
+    state = dict(name=None, table=None, decode=None, last_id=0, batch=[], inserted=set(),
+                 saved_deferred=len(checkpoint.deferred))
+
+    def flush():
+        if not state['batch']:
+            return
+        if len(checkpoint.deferred) > state['saved_deferred']:
+            # 这一批中被置空的回复关系必须在提交前记录,否则提交后、保存检查点前中断时,
+            # 续传会跳过这些已提交的评论,回复关系随之丢失
+            checkpoint.save()
+            state['saved_deferred'] = len(checkpoint.deferred)
+        db.session.execute(state['table'].insert(), state['batch'])
+        db.session.commit()
+        counts[state['name']] += len(state['batch'])
+        # 提交后才记录检查点;两者之间中断时,续传会以库中的最大id为准
+        checkpoint.tables[state['name']] = state['batch'][-1]['id']
+        checkpoint.save()
+        if progress is not None:
+            progress(state['name'], counts[state['name']])
+        state['batch'] = []
+
+    for kind, name, payload in read_archive(path):
+        if kind == 'upload':
+            if uploads:
+                counts['uploads'] += _save_upload(name, payload)
+            continue
+        if name not in TABLES:
+            continue
+        if name != state['name']:
+            flush()
+            table = _table(name)
+            state.update(name=name, table=table, decode=_decoder(table),
+                         last_id=max(checkpoint.tables.get(name, 0), _max_id(table)))
+        if payload['id'] <= state['last_id']:  # 上次已导入
+            continue
+        row = state['decode'](payload)
+        replied_id = row.get('replied_id')
+        if name == 'comment' and replied_id is not None and replied_id >= row['id']:
+            # 回复通常晚于被回复的评论;少数id倒序的回复先不建立关系,全部评论写入后再补上
+            checkpoint.deferred.append([row['id'], replied_id])
+            row['replied_id'] = None
+        state['batch'].append(row)
+        if len(state['batch']) >= batch_size:
+            flush()
+    flush()
+
+    if checkpoint.deferred:
+        # 提交前中断后续传的评论会再次加入,按评论id去重
+        deferred = dict((comment_id, replied_id) for comment_id, replied_id in checkpoint.deferred)
+        comment = _table('comment')
+        db.session.execute(comment.update().where(comment.c.id == db.bindparam('_id'))
+                           .values(replied_id=db.bindparam('_replied_id')),
+                           [dict(_id=comment_id, _replied_id=replied_id)
+                            for comment_id, replied_id in sorted(deferred.items())])
+        db.session.commit()
+    _reset_sequences()
+    checkpoint.remove()
+    return counts
+
+
+def _save_upload(name, fileobj):
+    folder = os.path.abspath(current_app.config['MYBLOG_UPLOAD_PATH'])
+    path = os.path.abspath(os.path.join(folder, name))
+    if not path.startswith(folder + os.sep) or os.path.exists(path):  # 拒绝越出上传目录的路径,已存在的文件跳过
+        return 0
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path + '.part', 'wb') as f:
+        while True:
+            chunk = fileobj.read(64 * 1024)
+            if not chunk:
+                break
+            f.write(chunk)
+    os.replace(path + '.part', path)
+    return 1
+
+
+def _reset_sequences():
+    # 显式写入id后,PostgreSQL的自增序列需要移到最大id之后;SQLite与MySQL自动处理
+    if db.engine.dialect.name != 'postgresql':
+        return
+    for name in TABLES:
+        db.session.execute("SELECT setval(pg_get_serial_sequence('%s', 'id'), "
+                           "coalesce((SELECT max(id) FROM %s), 0) + 1, false)" % (name, name))
+    db.session.commit()
@@ -0,0 +1,169 @@
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import threading
+
+from flask import current_app, request, send_file, safe_join, abort
+
+try:
+    import brotli
+except ImportError:  # 未安装brotli时只生成和使用.gz
+    brotli = None
+
+# 静态文件指纹:url_for('static', ...)自动附加 v=<内容哈希>,带当前指纹的请求可以被浏览器永久缓存;
+# 指纹清单可由flask assets预先生成,否则在首次引用某个文件时计算
+
+IMMUTABLE = 'public, max-age=31536000, immutable'
+COMPRESSIBLE = ('.js', '.css', '.svg', '.json', '.txt', '.html', '.map', '.ico')
+
+
+def file_hash(path):
+    digest = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(64 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()[:12]
+
+
+class Assets(object):
+
+    def __init__(self, app=None):
+        self.folder = None
+        self.manifest_path = None
+        self.manifest = {}
+        self.check_mtime = False
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.folder = app.static_folder
+        self.manifest_path = app.config['MYBLOG_ASSET_MANIFEST']
+        self.check_mtime = app.debug  # 开发时修改静态文件立即生效
+        self.manifest = {}
+        if self.manifest_path and os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                self.manifest = json.load(f)
+
+        @app.url_defaults
+        def fingerprint_static(endpoint, values):
+            if endpoint == 'static' and 'filename' in values and 'v' not in values:
+                version = self.version(values['filename'])
+                if version is not None:
+                    values['v'] = version
+
+        app.view_functions['static'] = self.send_static_file
+
+    def version(self, filename):
+        entry = self.manifest.get(filename)
+        if entry is not None and not self.check_mtime:
+            return entry[0]
+        path = safe_join(self.folder, filename)
+        try:
+            mtime = os.path.getmtime(path)
+        except (OSError, TypeError):
+            return None
+        if entry is None or entry[1] != mtime:
+            entry = [file_hash(path), mtime]
+            with self._lock:
+                self.manifest[filename] = entry
+        return entry[0]
+
+    def build(self, compress=True, min_saving=0.1):
+        """计算全部静态文件的指纹并写入清单;compress时为文本文件生成.gz(以及.br)预压缩版本"""
+        manifest = {}
+        compressed = 0
+        for root, dirs, files in os.walk(self.folder):
+            for name in files:
+                if name.endswith(('.gz', '.br')):
+                    continue
+                path = os.path.join(root, name)
+                filename = os.path.relpath(path, self.folder).replace(os.sep, '/')
+                manifest[filename] = [file_hash(path), os.path.getmtime(path)]
+                if compress and name.endswith(COMPRESSIBLE):
+                    compressed += self._compress(path, min_saving)
+        with self._lock:
+            self.manifest = manifest
+        if self.manifest_path:
+            folder = os.path.dirname(self.manifest_path)
+            if folder and not os.path.exists(folder):
+                os.makedirs(folder)
+            with open(self.manifest_path, 'w') as f:
+                json.dump(manifest, f, sort_keys=True)
+        return len(manifest), compressed
+
+    @staticmethod
+    def _compress(path, min_saving):
+        with open(path, 'rb') as f:
+            data = f.read()
+        variants = [('.gz', gzip.compress(data, 9))]
+        if brotli is not None:
+            variants.append(('.br', brotli.compress(data, quality=11)))
+        count = 0
+        for suffix, body in variants:
+            if len(body) <= len(data) * (1 - min_saving):  # 压缩收益太小的文件不保留压缩版本
+                with open(path + suffix, 'wb') as f:
+                    f.write(body)
+                count += 1
+            elif os.path.exists(path + suffix):
+                os.remove(path + suffix)
+        return count
+
+    def send_static_file(self, filename):
+        path = safe_join(self.folder, filename)
+        if path is None or not os.path.isfile(path):
+            abort(404)
+        immutable = request.args.get('v') is not None and request.args.get('v') == self.version(filename)
+        encoding = None
+        # Range请求针对原始字节,不使用预压缩版本
+        if 'Range' not in request.headers and filename.endswith(COMPRESSIBLE):
+            accepted = request.accept_encodings
+            for candidate, suffix in (('br', '.br'), ('gzip', '.gz')):
+                if accepted[candidate] and os.path.isfile(path + suffix) \
+                        and os.path.getmtime(path + suffix) >= os.path.getmtime(path):
+                    encoding = candidate
+                    break
+        if encoding is None:
+            response = send_file(path, conditional=True,
+                                 cache_timeout=31536000 if immutable else None)
+        else:
+            response = send_file(path + ('.br' if encoding == 'br' else '.gz'),
+                                 mimetype=_guess_type(filename), conditional=True,
+                                 cache_timeout=31536000 if immutable else None)
+            response.headers['Content-Encoding'] = encoding
+        if filename.endswith(COMPRESSIBLE):
+            response.vary.add('Accept-Encoding')
+        if immutable:
+            response.headers['Cache-Control'] = IMMUTABLE
+        return response
+
+
+def _guess_type(filename):
+    return mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+
+
+def send_upload(filename, immutable):
+    """发送上传目录中的文件;MYBLOG_SENDFILE为'x-accel-redirect'(nginx)或'x-sendfile'(Apache等)时
+    交给前端服务器发送,否则由应用自己发送(支持Range和条件请求)"""
+    folder = current_app.config['MYBLOG_UPLOAD_PATH']
+    path = safe_join(folder, filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+    cache_timeout = 31536000 if immutable else None
+    mode = current_app.config['MYBLOG_SENDFILE']
+    if mode in ('x-accel-redirect', 'x-sendfile'):
+        # 只返回响应头,文件内容、Range和条件请求都由前端服务器处理
+        response = current_app.response_class(mimetype=_guess_type(filename))
+        if mode == 'x-accel-redirect':
+            response.headers['X-Accel-Redirect'] = current_app.config['MYBLOG_ACCEL_PREFIX'] + filename
+        else:
+            response.headers['X-Sendfile'] = path
+        response.cache_control.public = True
+        response.cache_control.max_age = cache_timeout or current_app.get_send_file_max_age(filename)
+    else:
+        response = send_file(path, conditional=True, cache_timeout=cache_timeout)
+    if immutable:
+        response.headers['Cache-Control'] = IMMUTABLE
+    return response
@@ -1,11 +1,16 @@
-import os
-from flask import Blueprint, render_template, flash, redirect, url_for, request, current_app, send_from_directory
+from flask import Blueprint, render_template, flash, redirect, url_for, request, current_app
 from flask_login import login_required, current_user
 
 from MyBlog.forms import SettingForm, PostForm, CategoryForm
-from MyBlog.extensions import db
+from MyBlog.extensions import db, profiler
 from MyBlog.models import Post, Category, Comment
-from MyBlog.utils import redirect_back, allowed_file
+from MyBlog.utils import redirect_back
+from MyBlog.uploads import save_image, is_hashed_name, UploadError
+from MyBlog.assets import send_upload
+from MyBlog.pagination import paginate
+from MyBlog import queries
+from MyBlog.counters import unread_comments
+from MyBlog.threads import delete_thread
 from flask_ckeditor import upload_success, upload_fail
 
 
@@ -70,12 +75,11 @@ def new_category():
 @admin_my.route('/post/manage')
 @login_required
 def manage_post():
-    page = request.args.get('page', 1, type=int)
     per_page = current_app.config['MYBLOG_MANAGE_POST_PER_PAGE']
-    pagination = Post.query.order_by(Post.timestamp.desc()).paginate(page, per_page=per_page)
+    pagination = paginate(queries.manage_posts(), per_page, Post.timestamp, Post.id, count=Post.query.count)
     posts = pagination.items
 
-    return render_template('admin/manage_post.html', pagination=pagination, posts=posts, page=page )
+    return render_template('admin/manage_post.html', pagination=pagination, posts=posts, page=pagination.page)
 
 
 @admin_my.route('/post/<int:post_id>/edit', methods=['GET', 'POST'])
@@ -112,7 +116,9 @@ def delete_post(post_id):
 @admin_my.route('/category/manage')
 @login_required
 def manage_category():
-    return render_template('admin/manage_category.html')
+    # categories已被导航栏使用,这里另取名字
+    category_list = Category.query.order_by(Category.name).all()
+    return render_template('admin/manage_category.html', category_list=category_list)
 
 
 @admin_my.route('/category/<int:category_id>/edit', methods=['GET', 'POST'])
@@ -151,18 +157,13 @@ def delete_category(category_id):
 @login_required
 def manage_comments():
     filter_rule = request.args.get('filter', 'all')  # 从查询字符串获取过滤规则
-    page = request.args.get('page', 1, type=int)
 
-    if filter_rule == 'unread':
-        filtered_comments = Comment.query.filter_by(reviewed=False)
-    elif filter_rule == 'admin':
-        filtered_comments = Comment.query.filter_by(from_admin=True)
-    else:
-        filtered_comments = Comment.query
+    filtered_comments = queries.manage_comments(filter_rule)
 
-    # 筛选后的实例化对象进行排序
-    pagination = filtered_comments.order_by(Comment.timestamp.desc()).paginate(
-        page, per_page=current_app.config['MYBLOG_MANAGE_COMMENT_PER_PAGE'])
+    # 筛选后的实例化对象进行排序分页
+    pagination = paginate(filtered_comments, current_app.config['MYBLOG_MANAGE_COMMENT_PER_PAGE'],
+                          Comment.timestamp, Comment.id,
+                          count=unread_comments if filter_rule == 'unread' else filtered_comments.count)
     comments = pagination.items
 
     return render_template('admin/manage_comments.html',  pagination=pagination, comments=comments)
@@ -196,31 +197,51 @@ def approve_comments(comment_id):
 @login_required
 def delete_comments(comment_id):
     comment = Comment.query.get_or_404(comment_id)
-    db.session.delete(comment)
-    db.session.commit()
+    delete_thread(comment)  # 连同全部回复一起删除
     flash('评论已删除.', 'success')
     return redirect_back()
 
 
+# 采样分析结果,折叠栈格式可直接生成火焰图;top参数给出热点函数
+@admin_my.route('/profile')
+@login_required
+def profile():
+    stacks = profiler.load(request.args.get('endpoint'))
+    if request.args.get('top'):
+        total = sum(stacks.values()) or 1
+        body = ''.join('%6.1f%% %6.1f%%  %s\n' % (own * 100.0 / total, cumulative * 100.0 / total, frame)
+                       for frame, own, cumulative in profiler.top(stacks, request.args.get('top', 20, type=int)))
+    else:
+        body = profiler.collapsed(stacks)
+    return current_app.response_class(body, mimetype='text/plain')
+
+
+@admin_my.route('/profile/clear', methods=['POST'])
+@login_required
+def clear_profile():
+    profiler.clear()
+    flash('采样已清空', 'success')
+    return redirect_back()
+
+
 # 获取图片路径
 @admin_my.route('/uploads/<path:filename>')
 def get_image(filename):
-    return send_from_directory(current_app.config['MYBLOG_UPLOAD_PATH'], filename)
+    # 按内容寻址的文件名随内容变化,可以让浏览器永久缓存
+    return send_upload(filename, immutable=is_hashed_name(filename))
 
 
 # 上传图片
 @admin_my.route('/upload', methods=['POST'])
+@login_required
 def upload_image():
-    # 创建uploads文件夹用于上传图片
-    folder = os.path.exists(current_app.config['MYBLOG_UPLOAD_PATH'])
-    if not folder:
-            os.makedirs(current_app.config['MYBLOG_UPLOAD_PATH'])
-    # 获取上传对象
     f = request.files.get('upload')
-    # 若不符合规定文件名
-    if not allowed_file(f.filename):
-        return upload_fail('Image only!')
-    f.save(os.path.join(current_app.config['MYBLOG_UPLOAD_PATH'], f.filename))
+    if f is None:
+        return upload_fail('No file uploaded!')
+    try:
+        filename = save_image(f.stream)  # 流式写入并按文件头校验类型
+    except UploadError as e:
+        return upload_fail(str(e))
     # 设置图片url规则
-    url = url_for('.get_image', filename=f.filename)
-    return upload_success(url, f.filename)
\ No newline at end of file
+    url = url_for('.get_image', filename=filename)
+    return upload_success(url, filename)
@@ -1,27 +1,64 @@
 from flask import Blueprint, render_template, request, current_app, flash, redirect, url_for
 from MyBlog.models import Post, Category, Comment
 from MyBlog.forms import CommentForm
-from MyBlog.extensions import db
+from MyBlog.extensions import db, page_cache, site_cache, comment_queue
+from MyBlog.utils import conditional, csrf_epoch, redirect_back
+from MyBlog.pagination import paginate
+from MyBlog import queries
+from MyBlog.search import search_index
+from MyBlog.database import use_read_bind
+from MyBlog.threads import comment_threads
+from sqlalchemy import func
 
 blog_my = Blueprint('blog', __name__)
+blog_my.before_request(use_read_bind)  # 匿名用户的GET请求使用只读连接
+
+
+# 以下函数只查询时间戳和冗余计数,为条件请求提供(etag, last_modified)
+def _listing_validator(category_id=None):
+    last_modified = db.session.query(func.max(Post.updated))
+    if category_id is None:
+        count = db.session.query(func.sum(Category.post_count))
+    else:
+        last_modified = last_modified.filter(Post.category_id == category_id)
+        count = db.session.query(Category.post_count).filter(Category.id == category_id)
+    last_modified, count = db.session.query(last_modified.as_scalar(), count.as_scalar()).one()
+    return '%s|%s|%s' % (last_modified, count, site_cache.get()['version']), last_modified
+
+
+def _post_validator(post_id):
+    last_comment = db.session.query(func.max(Comment.timestamp)).filter(Comment.post_id == Post.id) \
+        .correlate(Post).as_scalar()
+    row = db.session.query(func.coalesce(Post.updated, Post.timestamp), Post.comment_count, last_comment) \
+        .filter(Post.id == post_id).first()
+    if row is None:
+        return None
+    updated, count, last_comment = row
+    last_modified = max(updated, last_comment) if last_comment else updated
+    return '%s|%s|%s|%s|%s' % (updated, last_comment, count, site_cache.get()['version'], csrf_epoch()), \
+        last_modified
 
 
 @blog_my.route('/')
+@conditional(lambda: _listing_validator())
+@page_cache.cached(lambda: ['index'])
 def index():
-    page = request.args.get('page', 1, type=int)    # 从查询字符串获取当前页数
     per_page = current_app.config['MYBLOG_POST_PER_PAGE']   #每页文章数
-    pagination = Post.query.order_by(Post.timestamp.desc()).paginate(page, per_page=per_page)
+    pagination = paginate(queries.post_listing(), per_page, Post.timestamp, Post.id)   # 从查询字符串获取当前页数或游标
     posts = pagination.items
     return render_template('blog/index.html', pagination=pagination, posts=posts)
 
 
 @blog_my.route('/post/<int:post_id>', methods=['GET', 'POST'])
+@conditional(_post_validator, private=True)  # 评论表单含有CSRF令牌
+@page_cache.cached(lambda post_id: ['post:%d' % post_id])
 def show_post(post_id):
-    post = Post.query.get_or_404(post_id)
-    page = request.args.get('page', 1, type=int)
+    post = queries.post_detail().get_or_404(post_id)
     per_page = current_app.config['MYBLOG_COMMENT_PER_PAGE']
-    pagination = Comment.query.with_parent(post).order_by(Comment.timestamp.desc()).paginate(page, per_page=per_page)
-    comments = pagination.items
+    roots = queries.comment_thread(post)
+    # 每页per_page条顶层评论,回复跟在所属评论之后;总页数按需统计顶层评论
+    pagination = paginate(roots, per_page, Comment.timestamp, Comment.id, count=roots.count)
+    comments = comment_threads(post.id, pagination.items)
 
     form = CommentForm()
 
@@ -29,22 +66,33 @@ def show_post(post_id):
         author = form.name.data
         body = form.comment.data
 
+        # 被回复评论必须属于这篇文章,否则新评论的路径落在另一篇文章的回复树中,哪里都不会显示。
+        # 先查出被回复评论:新评论加入会话后再查询会触发autoflush,评论会在设置回复关系之前写入,路径不正确
+        replied_id = request.args.get('reply', type=int)
+        replied_comment = Comment.query.filter_by(id=replied_id, post_id=post.id).first_or_404() \
+            if replied_id is not None else None
+
+        if comment_queue.enabled:
+            # 写入队列即返回,由后台线程批量写入数据库
+            comment_queue.enqueue(post.id, author, body, replied_id)
+            flash('评论成功！', 'success')
+            return redirect(url_for('.show_post', post_id=post_id))
+
         # 必须加入post=post参数，否则无法显示出对应评论，因为comment不知道自己属于哪一篇文章
         comment = Comment(
             author=author,
             body=body,
-            post=post
+            post=post,
+            replied=replied_comment
         )
-        replied_id = request.args.get('reply')
-        if replied_id:
-            replied_comment = Comment.query.get_or_404(replied_id)
-            comment.replied = replied_comment
 
         db.session.add(comment)
         db.session.commit()
         flash('评论成功！', 'success')
         return redirect(url_for('.show_post', post_id=post_id))
-    return render_template('blog/post.html', post=post, pagination=pagination, comments=comments, form=form)
+    pending = comment_queue.pending_for(post.id)  # 当前访客已提交、尚未写入数据库的评论
+    return render_template('blog/post.html', post=post, pagination=pagination, comments=comments, form=form,
+                           pending=pending)
 
 
 @blog_my.route('/reply/comment/<int:comment_id>', methods=['GET', 'POST'])
@@ -59,10 +107,22 @@ def reply_comment(comment_id):
 
 
 @blog_my.route('/category/<int:category_id>', methods=['GET', 'POST'])
+@conditional(_listing_validator)
+@page_cache.cached(lambda category_id: ['category:%d' % category_id])
 def show_category(category_id):
     category = Category.query.get_or_404(category_id)
-    page = request.args.get('page', 1, type=int)
     per_page = current_app.config['MYBLOG_POST_PER_PAGE']
-    pagination = Post.query.with_parent(category).order_by(Post.timestamp.desc()).paginate(page, per_page=per_page)
+    pagination = paginate(queries.post_listing().with_parent(category), per_page, Post.timestamp, Post.id)
     posts = pagination.items
-    return render_template('blog/category.html', category=category, pagination=pagination, posts=posts)
\ No newline at end of file
+    return render_template('blog/category.html', category=category, pagination=pagination, posts=posts)
+
+
+@blog_my.route('/search')
+def search():
+    q = request.args.get('q', '').strip()
+    if not q:
+        flash('请输入搜索关键词', 'warning')
+        return redirect_back()
+    per_page = current_app.config['MYBLOG_SEARCH_PER_PAGE']
+    pagination = search_index.search(q, request.args.get('page'), per_page)  # page为按(得分, id)的游标
+    return render_template('blog/search.html', q=q, pagination=pagination, results=pagination.items)
@@ -0,0 +1,56 @@
+from functools import partial
+
+from flask import Blueprint, abort
+
+from MyBlog.database import use_read_bind
+from MyBlog.feeds import feed_cache, feed_validator, atom, rss, sitemap, sitemap_index, sitemap_pages, \
+    ATOM, RSS, SITEMAP
+
+feed_my = Blueprint('feed', __name__)
+feed_my.before_request(use_read_bind)  # 匿名用户的GET请求使用只读连接
+
+
+def _validate(category_id=None):
+    validators = feed_validator(category_id)
+    if validators is None:
+        abort(404)
+    return validators
+
+
+@feed_my.route('/feed.atom')
+def atom_feed():
+    return feed_cache.serve(_validate(), atom, ATOM)
+
+
+@feed_my.route('/feed.rss')
+def rss_feed():
+    return feed_cache.serve(_validate(), rss, RSS)
+
+
+# 分类订阅,对应blog.show_category
+@feed_my.route('/category/<int:category_id>/feed.atom')
+def category_atom(category_id):
+    return feed_cache.serve(_validate(category_id), partial(atom, category_id), ATOM)
+
+
+@feed_my.route('/category/<int:category_id>/feed.rss')
+def category_rss(category_id):
+    return feed_cache.serve(_validate(category_id), partial(rss, category_id), RSS)
+
+
+# 文章超过MYBLOG_SITEMAP_SIZE篇时/sitemap.xml为索引,各页为/sitemap-<页码>.xml
+@feed_my.route('/sitemap.xml')
+def sitemap_xml():
+    validators = _validate()
+    pages = sitemap_pages(validators[2])
+    if pages > 1:
+        return feed_cache.serve(validators, partial(sitemap_index, pages), SITEMAP)
+    return feed_cache.serve(validators, sitemap, SITEMAP)
+
+
+@feed_my.route('/sitemap-<int:page>.xml')
+def sitemap_page(page):
+    validators = _validate()
+    if not 1 <= page <= sitemap_pages(validators[2]):
+        abort(404)
+    return feed_cache.serve(validators, partial(sitemap, page), SITEMAP)
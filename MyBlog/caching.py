@@ -0,0 +1,474 @@
+import hashlib
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import current_app, g, make_response, request, session
+from flask_login import current_user
+from flask_wtf.csrf import generate_csrf
+from sqlalchemy import inspect
+from sqlalchemy.orm import make_transient_to_detached
+
+from MyBlog.signals import models_changed, changed_models
+from MyBlog.utils import freezing, personalized
+from MyBlog.compression import brotli, choose_encoding, compress, deflate_segment, splice_gzip
+
+
+class Snapshot(object):
+    """模型记录的只读快照,脱离数据库会话后仍可在模板中安全访问"""
+
+    def __init__(self, **values):
+        self.__dict__.update(values)
+
+    def __repr__(self):
+        return '<Snapshot %r>' % self.__dict__.get('id')
+
+
+# 全局模板上下文缓存:管理员设置与分类列表
+class SiteContextCache(object):
+    # 这些模型的变更会使缓存失效
+    models = ('Admin', 'Category')
+
+    def __init__(self, app=None):
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.ttl = None
+        self._data = None
+        self._expires = None
+        self._generation = 0
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        # 多个gunicorn worker之间无法互相通知,由TTL兜底
+        self.ttl = app.config.get('MYBLOG_SITE_CACHE_TTL')
+        models_changed.connect(self._on_models_changed)
+
+    def _on_models_changed(self, sender, changes):
+        if changed_models(changes).intersection(self.models):
+            self.invalidate()
+
+    def _load(self):
+        from MyBlog.models import Admin, Category
+
+        admin = Admin.query.first()
+        if admin is not None:
+            admin = Snapshot(id=admin.id, username=admin.username, blog_title=admin.blog_title,
+                             blog_sub_title=admin.blog_sub_title, name=admin.name, about=admin.about)
+        categories = [Snapshot(id=category_id, name=name) for category_id, name in
+                      Category.query.with_entities(Category.id, Category.name).order_by(Category.name)]
+        # 内容指纹,页面ETag依赖它感知博客设置和分类的变化
+        version = hashlib.sha1(repr((sorted(admin.__dict__.items()) if admin else None,
+                                     [(c.id, c.name) for c in categories])).encode('utf-8')).hexdigest()
+        return dict(admin=admin, categories=categories, version=version)
+
+    def get(self):
+        data = self._data
+        if data is not None and (self._expires is None or self._expires > time.time()):
+            self.hits += 1
+            return data
+        self.misses += 1
+        generation = self._generation
+        data = self._load()
+        with self._lock:
+            # 加载期间若缓存已失效,则不保存这份可能过期的数据
+            if generation == self._generation:
+                self._data = data
+                self._expires = time.time() + self.ttl if self.ttl else None
+        return data
+
+    def invalidate(self):
+        with self._lock:
+            self._data = None
+            self._generation += 1
+            self.invalidations += 1
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses, invalidations=self.invalidations)
+
+
+# 已登录管理员的身份缓存:load_user和未读评论数在TTL内不查询数据库
+class IdentityCache(object):
+    # 计数器随评论变化
+    unread_models = ('Comment', 'Counter')
+
+    def __init__(self, app=None):
+        self.hits = 0
+        self.misses = 0
+        self.ttl = None
+        self.stamp_path = None
+        self._users = {}  # user_id -> (expires, 脱离会话的Admin)
+        self._unread = None  # (expires, 未读评论数)
+        self._stamp = None
+        self._generation = 0
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.ttl = app.config['MYBLOG_IDENTITY_CACHE_TTL']
+        # 管理员记录变更时更新该文件的修改时间,同一台机器上的其他进程(包括flask init)据此立即失效
+        self.stamp_path = app.config['MYBLOG_IDENTITY_STAMP']
+        models_changed.connect(self._on_models_changed)
+
+    def _on_models_changed(self, sender, changes):
+        models = changed_models(changes)
+        if 'Admin' in models:
+            self.invalidate()
+            self._touch()
+        if models.intersection(self.unread_models):
+            self._unread = None
+
+    def _touch(self):
+        if self.stamp_path is None:
+            return
+        folder = os.path.dirname(self.stamp_path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        with open(self.stamp_path, 'a'):
+            os.utime(self.stamp_path)
+
+    def _check_stamp(self):
+        if self.stamp_path is None:
+            return
+        try:
+            stamp = os.stat(self.stamp_path).st_mtime_ns
+        except OSError:
+            stamp = None
+        if stamp != self._stamp:
+            self.invalidate()
+            self._stamp = stamp
+
+    def load_user(self, user_id, refresh=False):
+        """返回当前会话中的Admin;缓存命中时用merge(load=False)放入会话,不查询数据库。
+        refresh为True时跳过缓存重新查询这一个用户,记录确有变化时才替换缓存中的副本"""
+        from MyBlog.extensions import db
+        from MyBlog.models import Admin
+
+        self._check_stamp()
+        item = self._users.get(user_id)
+        if not refresh and item is not None and (item[0] is None or item[0] > time.time()):
+            self.hits += 1
+            return db.session.merge(item[1], load=False)
+        self.misses += 1
+        generation = self._generation
+        # 会话中可能已有merge进来的缓存副本,populate_existing用查询结果覆盖它
+        user = Admin.query.populate_existing().get(user_id) if refresh else Admin.query.get(user_id)
+        columns = [attr.key for attr in inspect(Admin).column_attrs]
+        with self._lock:
+            current = self._users.get(user_id)
+            if user is None:
+                if refresh:
+                    self._users.pop(user_id, None)
+                return None
+            values = dict((key, getattr(user, key)) for key in columns)
+            if refresh and current is not None and \
+                    dict((key, current[1].__dict__.get(key)) for key in columns) == values:
+                return user  # 记录未变(只是会话过期),保留原有缓存
+            # 缓存一份与会话无关的副本,各请求、各线程的会话各自merge
+            detached = Admin(**values)
+            make_transient_to_detached(detached)
+            # 查询期间缓存已失效时不保存,避免缓存修改前的记录
+            if generation == self._generation:
+                self._users[user_id] = (time.time() + self.ttl if self.ttl else None, detached)
+        return user
+
+    def unread_comments(self):
+        """未读评论数;本进程的评论变更立即失效,其他进程的变更最迟TTL秒后可见"""
+        from MyBlog.counters import unread_comments
+
+        item = self._unread
+        if item is not None and (item[0] is None or item[0] > time.time()):
+            return item[1]
+        value = unread_comments()
+        self._unread = (time.time() + self.ttl if self.ttl else None, value)
+        return value
+
+    def invalidate(self):
+        with self._lock:
+            self._users.clear()
+            self._unread = None
+            self._generation += 1
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses, users=len(self._users))
+
+
+# 页面缓存的进程内LRU后端
+class MemoryBackend(object):
+
+    def __init__(self, max_entries=500):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> (expires, entry, tags)
+        self._tags = {}  # tag -> set(key)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            if item[0] is not None and item[0] <= time.time():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return item[1]
+
+    def set(self, key, entry, tags, ttl=None):
+        expires = time.time() + ttl if ttl else None
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (expires, entry, tags)
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        item = self._entries.pop(key, None)
+        if item is not None:
+            for tag in item[2]:
+                keys = self._tags.get(tag)
+                if keys is not None:
+                    keys.discard(key)
+                    if not keys:
+                        del self._tags[tag]
+
+    def purge(self, tags):
+        with self._lock:
+            for tag in tags:
+                for key in list(self._tags.get(tag, ())):
+                    self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tags.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# 页面缓存的SQLite文件后端,多个gunicorn worker共享同一份缓存与清除结果
+class SQLiteBackend(object):
+
+    def __init__(self, path, max_entries=5000):
+        self.path = path
+        self.max_entries = max_entries
+        self._local = threading.local()
+        self._writes = 0
+        folder = os.path.dirname(path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        with self._connect() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS page '
+                         '(key TEXT PRIMARY KEY, entry BLOB, expires REAL, created REAL)')
+            conn.execute('CREATE TABLE IF NOT EXISTS page_tag (tag TEXT, key TEXT)')
+            conn.execute('CREATE INDEX IF NOT EXISTS ix_page_tag_tag ON page_tag (tag)')
+            conn.execute('CREATE INDEX IF NOT EXISTS ix_page_tag_key ON page_tag (key)')
+
+    def _connect(self):
+        # sqlite3连接不能跨线程使用,每个线程各持有一个
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        row = self._connect().execute('SELECT entry, expires FROM page WHERE key = ?', (key,)).fetchone()
+        if row is None or (row[1] is not None and row[1] <= time.time()):
+            return None
+        return pickle.loads(row[0])
+
+    def set(self, key, entry, tags, ttl=None):
+        now = time.time()
+        conn = self._connect()
+        with conn:
+            conn.execute('DELETE FROM page_tag WHERE key = ?', (key,))
+            conn.execute('INSERT OR REPLACE INTO page (key, entry, expires, created) VALUES (?, ?, ?, ?)',
+                         (key, pickle.dumps(entry, pickle.HIGHEST_PROTOCOL), now + ttl if ttl else None, now))
+            conn.executemany('INSERT INTO page_tag (tag, key) VALUES (?, ?)', [(tag, key) for tag in tags])
+        self._writes += 1
+        if self._writes % 100 == 0:
+            self._evict(conn)
+
+    def _evict(self, conn):
+        with conn:
+            conn.execute('DELETE FROM page WHERE expires IS NOT NULL AND expires <= ?', (time.time(),))
+            conn.execute('DELETE FROM page WHERE key IN (SELECT key FROM page ORDER BY created DESC '
+                         'LIMIT -1 OFFSET ?)', (self.max_entries,))
+            conn.execute('DELETE FROM page_tag WHERE key NOT IN (SELECT key FROM page)')
+
+    def purge(self, tags):
+        conn = self._connect()
+        with conn:
+            for tag in tags:
+                conn.execute('DELETE FROM page WHERE key IN (SELECT key FROM page_tag WHERE tag = ?)', (tag,))
+                conn.execute('DELETE FROM page_tag WHERE key NOT IN (SELECT key FROM page)')
+
+    def clear(self):
+        conn = self._connect()
+        with conn:
+            conn.execute('DELETE FROM page')
+            conn.execute('DELETE FROM page_tag')
+
+    def __len__(self):
+        return self._connect().execute('SELECT COUNT(*) FROM page').fetchone()[0]
+
+
+# 匿名访客的整页缓存,以端点、视图参数、页码和语言为键,并按标签在数据变更提交后精确清除
+class PageCache(object):
+    backends = {
+        'memory': MemoryBackend,
+        'sqlite': SQLiteBackend
+    }
+    csrf_placeholder = b'__MYBLOG_CSRF_TOKEN__'
+
+    def __init__(self, app=None):
+        self.backend = None
+        self.ttl = None
+        self.hits = 0
+        self.misses = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        backend = app.config.get('MYBLOG_PAGE_CACHE')
+        if backend == 'sqlite':
+            self.backend = SQLiteBackend(app.config['MYBLOG_PAGE_CACHE_PATH'],
+                                         app.config['MYBLOG_PAGE_CACHE_SIZE'])
+        elif backend == 'memory':
+            self.backend = MemoryBackend(app.config['MYBLOG_PAGE_CACHE_SIZE'])
+        elif backend is None:
+            self.backend = None
+        else:  # 也可直接传入实现了get/set/purge/clear的后端对象
+            self.backend = backend
+        self.ttl = app.config.get('MYBLOG_PAGE_CACHE_TTL')
+        models_changed.connect(self._on_models_changed)
+
+    def cached(self, tags):
+        """视图装饰器,tags接收视图参数并返回该页面所属的标签列表"""
+        def decorator(f):
+            @wraps(f)
+            def decorated_function(*args, **kwargs):
+                if not self._cacheable():
+                    return f(*args, **kwargs)
+                key, entry = self._lookup()
+                if entry is not None:
+                    self.hits += 1
+                    return self._make_response(entry)
+                self.misses += 1
+                response = make_response(f(*args, **kwargs))
+                if response.status_code == 200 and not response.is_streamed and not session.get('_flashes'):
+                    entry = self._make_entry(response)
+                    self.backend.set(key, entry, tags(**kwargs), self.ttl)
+                    response = self._make_response(entry)  # 直接使用刚压缩好的版本
+                    response.headers['X-Page-Cache'] = 'MISS'
+                return response
+            return decorated_function
+        return decorator
+
+    def _cacheable(self):
+        return self.backend is not None and request.method == 'GET' \
+            and set(request.args) <= {'page'} \
+            and not personalized() and not freezing() \
+            and not current_user.is_authenticated
+
+    def lookup(self):
+        """返回当前请求的缓存条目,没有或不可缓存时返回None;同一请求内只查询一次后端"""
+        if not self._cacheable():
+            return None
+        return self._lookup()[1]
+
+    def _lookup(self):
+        if 'myblog_page_cache_entry' not in g:
+            key = self._make_key()
+            g.myblog_page_cache_entry = (key, self.backend.get(key))
+        return g.myblog_page_cache_entry
+
+    def _make_key(self):
+        view_args = ','.join('%s=%s' % item for item in sorted(request.view_args.items()))
+        locale = request.accept_languages.best or ''
+        return '%s|%s|%s|%s' % (request.endpoint, view_args, request.args.get('page', '1'), locale.lower())
+
+    def _make_entry(self, response):
+        body = response.get_data()
+        # 评论表单中的CSRF令牌与访客会话绑定,缓存时替换为占位符,命中时再填入当前访客的令牌
+        token = g.get(current_app.config.get('WTF_CSRF_FIELD_NAME', 'csrf_token'))
+        csrf = bool(token) and token.encode() in body
+        if csrf:
+            body = body.replace(token.encode(), self.csrf_placeholder)
+        # conditional()为本次渲染计算的验证器随页面一起缓存,命中时不必再查询时间戳和计数
+        entry = dict(body=body, content_type=response.headers.get('Content-Type'), csrf=csrf,
+                     validators=g.get('myblog_validators'))
+        config = current_app.config
+        if config['MYBLOG_COMPRESS'] and response.mimetype in config['MYBLOG_COMPRESS_MIMETYPES'] \
+                and len(body) >= config['MYBLOG_COMPRESS_MIN_SIZE']:
+            # 每次数据变更后只压缩一次;含CSRF令牌的页面按占位符分段压缩,命中时只压缩令牌再拼接
+            level = config['MYBLOG_COMPRESS_LEVEL']
+            entry['gzip'] = [(segment, deflate_segment(segment, level))
+                             for segment in body.split(self.csrf_placeholder)]
+            if not csrf and brotli is not None:
+                entry['br'] = compress(body, 'br')
+            del entry['body']   # 原文即各段以占位符连接,不再重复保存
+        return entry
+
+    def _make_response(self, entry):
+        token = generate_csrf().encode() if entry['csrf'] else None
+        encoding = choose_encoding(allow_br='br' in entry) if 'gzip' in entry else None
+        if encoding == 'br':
+            body = entry['br']
+        elif encoding == 'gzip':
+            segments = entry['gzip']
+            body = splice_gzip(segments, [token] * (len(segments) - 1), current_app.config['MYBLOG_COMPRESS_LEVEL'])
+        else:
+            body = entry['body'] if 'gzip' not in entry else \
+                self.csrf_placeholder.join(segment for segment, _ in entry['gzip'])
+            if token is not None:
+                body = body.replace(self.csrf_placeholder, token)
+        response = current_app.response_class(body, content_type=entry['content_type'])
+        if encoding is not None:
+            response.headers['Content-Encoding'] = encoding
+        if 'gzip' in entry:
+            response.vary.add('Accept-Encoding')
+        response.headers['X-Page-Cache'] = 'HIT'
+        return response
+
+    def _on_models_changed(self, sender, changes):
+        if self.backend is None:
+            return
+        tags = set()
+        for change in changes:
+            if change.model in ('Admin', 'Category') or change.op == 'bulk':
+                # 博客标题和导航栏分类出现在每个页面中
+                self.clear()
+                return
+            if change.model == 'Post':
+                tags.add('post:%s' % change.get('id'))
+                if change.op != 'update' or set(change.old) - {'can_comments'}:
+                    tags.add('index')
+                    tags.add('category:%s' % change.get('category_id'))
+                    if 'category_id' in change.old:
+                        tags.add('category:%s' % change.old['category_id'])
+            elif change.model == 'Comment':
+                tags.add('post:%s' % change.get('post_id'))
+                if 'post_id' in change.old:
+                    tags.add('post:%s' % change.old['post_id'])
+        if tags:
+            self.backend.purge(tags)
+
+    def clear(self):
+        if self.backend is not None:
+            self.backend.clear()
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses, entries=len(self.backend) if self.backend is not None else 0)
@@ -0,0 +1,176 @@
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from datetime import datetime
+
+from flask import session
+
+# 评论写入队列(可选):表单校验通过的评论先写入本地SQLite队列文件,请求立即返回;
+# 后台线程按批把评论写入数据库,一个事务提交一批。已写入的最大队列id与评论在同一事务中记录在Counter表,
+# 写入后进程中断也不会重复提交。提交者在写入前就能看到自己的待发布评论
+
+SESSION_KEY = 'myblog_pending_comments'
+SESSION_LIMIT = 20  # 会话中最多记录的待发布评论数
+
+
+class PendingComment(object):
+    """尚未写入数据库的评论,属性与模板中用到的Comment属性一致"""
+    from_admin = False
+    replied = None
+
+    def __init__(self, id, post_id, author, body, replied_id, timestamp):
+        self.id = id
+        self.post_id = post_id
+        self.author = author
+        self.body = body
+        self.replied_id = replied_id
+        self.timestamp = datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S.%f')
+
+
+class CommentQueue(object):
+
+    def __init__(self, app=None):
+        self.path = None
+        self.app = None
+        self.batch_size = 200
+        self.interval = 0.5
+        self.flushed = 0
+        self.counter = None
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._thread = None
+        if app is not None:
+            self.init_app(app)
+
+    @property
+    def enabled(self):
+        return self.path is not None
+
+    def init_app(self, app):
+        self.path = app.config['MYBLOG_COMMENT_QUEUE']
+        self.batch_size = app.config['MYBLOG_COMMENT_QUEUE_BATCH']
+        self.interval = app.config['MYBLOG_COMMENT_QUEUE_INTERVAL']
+        self.app = app
+        self._local = threading.local()
+        if self.path is None:
+            return
+        folder = os.path.dirname(self.path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        # 建表使用临时连接,不把连接留给可能fork出的worker进程
+        conn = sqlite3.connect(self.path, timeout=10)
+        conn.execute('CREATE TABLE IF NOT EXISTS pending (id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                     'post_id INTEGER NOT NULL, author TEXT, body TEXT, replied_id INTEGER, '
+                     'timestamp TEXT NOT NULL)')
+        # 每个队列文件有自己的编号,重建队列文件后队列id从1开始,对应新的计数器
+        conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        conn.execute("INSERT OR IGNORE INTO meta VALUES ('id', ?)", (uuid.uuid4().hex[:12],))
+        conn.commit()
+        self.counter = 'comment_queue:%s' % conn.execute("SELECT value FROM meta WHERE key = 'id'").fetchone()[0]
+        conn.close()
+
+        @app.before_first_request
+        def resume_flush():
+            # 上次退出时未写入的评论由新进程继续写入
+            if self.pending_count():
+                self._start()
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # isolation_level=None:自动提交,批量写入时显式BEGIN IMMEDIATE
+            conn = self._local.conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=FULL')  # 队列是评论唯一的副本,每次提交都落盘
+        return conn
+
+    def enqueue(self, post_id, author, body, replied_id=None):
+        """保存一条待发布评论并记入当前会话,返回队列id"""
+        cursor = self._connect().execute(
+            'INSERT INTO pending (post_id, author, body, replied_id, timestamp) VALUES (?, ?, ?, ?, ?)',
+            (post_id, author, body, replied_id, datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S.%f')))
+        session[SESSION_KEY] = (session.get(SESSION_KEY) or [])[-(SESSION_LIMIT - 1):] + [cursor.lastrowid]
+        self._start()
+        return cursor.lastrowid
+
+    def pending_for(self, post_id):
+        """当前会话在post_id下尚未写入数据库的评论;已写入的从会话中移除"""
+        ids = session.get(SESSION_KEY)
+        if not ids or not self.enabled:
+            return []
+        rows = self._connect().execute(
+            'SELECT id, post_id, author, body, replied_id, timestamp FROM pending WHERE id IN (%s) ORDER BY id'
+            % ','.join('?' * len(ids)), ids).fetchall()
+        remaining = [row[0] for row in rows]
+        if remaining != ids:
+            if remaining:
+                session[SESSION_KEY] = remaining
+            else:
+                session.pop(SESSION_KEY)
+        return [PendingComment(*row) for row in rows if row[1] == post_id]
+
+    def pending_count(self):
+        if not self.enabled:
+            return 0
+        return self._connect().execute('SELECT count(*) FROM pending').fetchone()[0]
+
+    def flush(self):
+        """把一批评论写入数据库,返回本批处理的队列记录数;需在应用上下文中调用"""
+        from MyBlog.extensions import db
+        from MyBlog.models import Post, Comment, Counter
+
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')  # 多个进程的写线程依次处理
+        try:
+            flushed = Counter.get_value(self.counter) or 0
+            rows = conn.execute('SELECT id, post_id, author, body, replied_id, timestamp FROM pending '
+                                'WHERE id > ? ORDER BY id LIMIT ?', (flushed, self.batch_size)).fetchall()
+            if rows:
+                comments = [PendingComment(*row) for row in rows]
+                # 一次查询确认文章和被回复评论仍然存在,且被回复评论属于同一篇文章
+                posts = set(post_id for post_id, in db.session.query(Post.id)
+                            .filter(Post.id.in_(set(c.post_id for c in comments))))
+                replied_ids = set(c.replied_id for c in comments if c.replied_id is not None)
+                replied = dict(db.session.query(Comment.id, Comment.post_id)
+                               .filter(Comment.id.in_(replied_ids))) if replied_ids else {}
+                db.session.add_all([Comment(author=c.author, body=c.body, post_id=c.post_id, timestamp=c.timestamp,
+                                            replied_id=c.replied_id if replied.get(c.replied_id) == c.post_id
+                                            else None)
+                                    for c in comments if c.post_id in posts])
+                db.session.merge(Counter(name=self.counter, value=rows[-1][0]))  # 已写入的最大队列id
+                db.session.commit()  # 计数器由counters模块在同一事务中更新
+                flushed = rows[-1][0]
+            conn.execute('DELETE FROM pending WHERE id <= ?', (flushed,))
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            db.session.rollback()
+            raise
+        self.flushed += len(rows)
+        return len(rows)
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, args=(self.app,), name='myblog-comment-queue')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _run(self, app):
+        # 与采样线程相同:队列清空后线程退出,下次入队时重新启动
+        while True:
+            time.sleep(self.interval)
+            try:
+                with app.app_context():
+                    while self.flush() == self.batch_size:
+                        pass
+            except Exception:
+                app.logger.exception('comment queue flush failed')
+                continue
+            with self._lock:
+                # 在锁内检查:enqueue先写入队列再获取锁,不会遗漏刚入队的评论
+                if not self.pending_count():
+                    self._thread = None
+                    return
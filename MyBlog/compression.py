@@ -0,0 +1,135 @@
+import struct
+import zlib
+
+from flask import current_app, request
+
+try:
+    import brotli
+except ImportError:  # 未安装brotli时只使用gzip
+    brotli = None
+
+# 响应压缩:按Accept-Encoding选择br或gzip,只处理白名单中的文本类型且超过最小长度的响应,
+# 流式响应逐块压缩。页面缓存保存压缩后的分段(见PageCache),命中时不再重复压缩
+
+GZIP_HEADER = b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'
+DEFLATE_END = b'\x03\x00'  # 空的最后一个块
+
+
+def choose_encoding(allow_br=True):
+    accepted = request.accept_encodings
+    if allow_br and brotli is not None and accepted['br']:
+        return 'br'
+    if accepted['gzip']:
+        return 'gzip'
+    return None
+
+
+def compress(data, encoding):
+    config = current_app.config
+    if encoding == 'br':
+        return brotli.compress(data, quality=config['MYBLOG_BROTLI_QUALITY'])
+    return GZIP_HEADER + deflate_segment(data, config['MYBLOG_COMPRESS_LEVEL']) + DEFLATE_END + \
+        struct.pack('<II', zlib.crc32(data), len(data) & 0xffffffff)
+
+
+def deflate_segment(data, level):
+    """把data压缩为以完全刷新结尾的raw deflate块;各段互不引用,可以按任意顺序拼接"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return compressor.compress(data) + compressor.flush(zlib.Z_FULL_FLUSH)
+
+
+def splice_gzip(segments, pieces, level):
+    """把预先压缩的分段与每次请求不同的片段交替拼成gzip
+
+    segments为原文按占位符切开后各段的(原文, deflate_segment结果),pieces为填入各占位符的内容,
+    只需压缩很短的pieces,CRC32仍按完整原文计算。
+    """
+    parts = [GZIP_HEADER]
+    crc = 0
+    size = 0
+    for index, (data, deflated) in enumerate(segments):
+        if index:
+            piece = pieces[index - 1]
+            parts.append(deflate_segment(piece, level))
+            crc = zlib.crc32(piece, crc)
+            size += len(piece)
+        parts.append(deflated)
+        crc = zlib.crc32(data, crc)
+        size += len(data)
+    parts.append(DEFLATE_END)
+    parts.append(struct.pack('<II', crc, size & 0xffffffff))
+    return b''.join(parts)
+
+
+class _StreamCompressor(object):
+
+    def __init__(self, encoding, level, quality):
+        self.encoding = encoding
+        if encoding == 'br':
+            self._brotli = brotli.Compressor(quality=quality)
+        else:
+            self._zlib = zlib.compressobj(level, zlib.DEFLATED, 31)  # wbits=31: 带gzip头和尾
+
+    def compress(self, chunk):
+        # 每块都刷新,客户端可以边收边显示
+        if self.encoding == 'br':
+            return self._brotli.process(chunk) + self._brotli.flush()
+        return self._zlib.compress(chunk) + self._zlib.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        if self.encoding == 'br':
+            return self._brotli.finish()
+        return self._zlib.flush()
+
+
+def _compress_stream(iterable, compressor, charset):
+    try:
+        for chunk in iterable:
+            if not isinstance(chunk, bytes):
+                chunk = chunk.encode(charset)
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.finish()
+    finally:
+        if hasattr(iterable, 'close'):
+            iterable.close()
+
+
+def _weaken_etag(response):
+    # 压缩后的字节与原文不同,强ETag改为弱ETag;条件请求用弱比较,原有的304判断不受影响
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+
+
+def register_compression(app):
+    @app.after_request
+    def compress_response(response):
+        config = current_app.config
+        if not config['MYBLOG_COMPRESS'] or response.direct_passthrough:  # send_file的响应由静态文件处理
+            return response
+        if response.headers.get('Content-Encoding'):
+            if response.headers['Content-Encoding'] in ('gzip', 'br'):  # 页面缓存已给出压缩版本
+                _weaken_etag(response)
+            return response
+        if response.status_code < 200 or response.status_code in (204, 206, 304) \
+                or response.mimetype not in config['MYBLOG_COMPRESS_MIMETYPES'] \
+                or 'Range' in request.headers:
+            return response
+        response.vary.add('Accept-Encoding')
+        encoding = choose_encoding()
+        if encoding is None:
+            return response
+        if response.is_streamed:
+            compressor = _StreamCompressor(encoding, config['MYBLOG_COMPRESS_LEVEL'], config['MYBLOG_BROTLI_QUALITY'])
+            response.response = _compress_stream(response.response, compressor, response.charset)
+            response.headers.pop('Content-Length', None)
+        else:
+            data = response.get_data()
+            if len(data) < config['MYBLOG_COMPRESS_MIN_SIZE']:
+                return response
+            response.set_data(compress(data, encoding))
+        response.headers['Content-Encoding'] = encoding
+        _weaken_etag(response)
+        return response
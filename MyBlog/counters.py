@@ -0,0 +1,126 @@
+from sqlalchemy import event, func
+from sqlalchemy.orm.attributes import get_history
+
+from MyBlog.extensions import db
+from MyBlog.models import Post, Category, Comment, Counter
+
+# 冗余计数字段的维护:评论数(Post.comment_count)、分类文章数(Category.post_count)、未读评论数(Counter)
+# 在ORM写入的同一连接、同一事务中用UPDATE col = col + n完成,回滚时一并撤销
+
+UNREAD_COMMENTS = 'unread_comments'
+
+
+def _add_comments(connection, post_id, n):
+    if post_id is not None:
+        # 显式保留updated,评论数变化不算文章内容修改
+        connection.execute(Post.__table__.update().where(Post.id == post_id)
+                           .values(comment_count=Post.comment_count + n, updated=Post.updated))
+
+
+def _add_posts(connection, category_id, n):
+    if category_id is not None:
+        connection.execute(Category.__table__.update().where(Category.id == category_id)
+                           .values(post_count=Category.post_count + n))
+
+
+def _add_unread(connection, n):
+    connection.execute(Counter.__table__.update().where(Counter.name == UNREAD_COMMENTS)
+                       .values(value=Counter.value + n))
+
+
+def _changed(target, key):
+    history = get_history(target, key)
+    if history.deleted and history.added:
+        return history.deleted[0], history.added[0]
+    return None
+
+
+def _comment_inserted(mapper, connection, target):
+    _add_comments(connection, target.post_id, 1)
+    if not target.reviewed:
+        _add_unread(connection, 1)
+
+
+def _comment_deleted(mapper, connection, target):
+    _add_comments(connection, target.post_id, -1)
+    if not target.reviewed:
+        _add_unread(connection, -1)
+
+
+def _comment_updated(mapper, connection, target):
+    reviewed = _changed(target, 'reviewed')
+    if reviewed is not None and bool(reviewed[0]) != bool(reviewed[1]):
+        _add_unread(connection, -1 if reviewed[1] else 1)
+    post_id = _changed(target, 'post_id')
+    if post_id is not None:
+        _add_comments(connection, post_id[0], -1)
+        _add_comments(connection, post_id[1], 1)
+
+
+def _post_inserted(mapper, connection, target):
+    _add_posts(connection, target.category_id, 1)
+
+
+def _post_deleted(mapper, connection, target):
+    _add_posts(connection, target.category_id, -1)
+
+
+def _post_updated(mapper, connection, target):
+    category_id = _changed(target, 'category_id')
+    if category_id is not None:
+        _add_posts(connection, category_id[0], -1)
+        _add_posts(connection, category_id[1], 1)
+
+
+def register_counter_events():
+    if event.contains(Comment, 'after_insert', _comment_inserted):
+        return
+    event.listen(Comment, 'after_insert', _comment_inserted)
+    event.listen(Comment, 'after_delete', _comment_deleted)
+    event.listen(Comment, 'after_update', _comment_updated)
+    event.listen(Post, 'after_insert', _post_inserted)
+    event.listen(Post, 'after_delete', _post_deleted)
+    event.listen(Post, 'after_update', _post_updated)
+
+
+def unread_comments():
+    value = Counter.get_value(UNREAD_COMMENTS)
+    if value is None:  # 计数器尚未初始化时退回到实时统计
+        value = Comment.query.filter_by(reviewed=False).count()
+    return value
+
+
+def recompute_counters(fix=True):
+    """按实际数据重新统计全部计数,返回{计数名: 不一致的记录数};fix为True时写回正确值"""
+    mismatches = {}
+
+    comment_counts = dict(db.session.query(Comment.post_id, func.count(Comment.id)).group_by(Comment.post_id))
+    wrong = [dict(_id=post_id, value=comment_counts.get(post_id, 0))
+             for post_id, stored in db.session.query(Post.id, Post.comment_count)
+             if stored != comment_counts.get(post_id, 0)]
+    mismatches['post.comment_count'] = len(wrong)
+    if fix and wrong:
+        db.session.execute(Post.__table__.update().where(Post.id == db.bindparam('_id'))
+                           .values(comment_count=db.bindparam('value'), updated=Post.updated), wrong)
+
+    post_counts = dict(db.session.query(Post.category_id, func.count(Post.id)).group_by(Post.category_id))
+    wrong = [dict(_id=category_id, value=post_counts.get(category_id, 0))
+             for category_id, stored in db.session.query(Category.id, Category.post_count)
+             if stored != post_counts.get(category_id, 0)]
+    mismatches['category.post_count'] = len(wrong)
+    if fix and wrong:
+        db.session.execute(Category.__table__.update().where(Category.id == db.bindparam('_id'))
+                           .values(post_count=db.bindparam('value')), wrong)
+
+    unread = Comment.query.filter_by(reviewed=False).count()
+    counter = Counter.query.get(UNREAD_COMMENTS)
+    mismatches[UNREAD_COMMENTS] = int(counter is None or counter.value != unread)
+    if fix and mismatches[UNREAD_COMMENTS]:
+        if counter is None:
+            db.session.add(Counter(name=UNREAD_COMMENTS, value=unread))
+        else:
+            counter.value = unread
+
+    if fix:
+        db.session.commit()
+    return mismatches
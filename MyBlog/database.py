@@ -0,0 +1,81 @@
+from flask import current_app, g, has_request_context, request
+from flask_login import current_user
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import event, orm
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
+
+from MyBlog.utils import personalized
+
+# 数据库连接配置:SQLite连接建立时执行MYBLOG_SQLITE_PRAGMAS(WAL、synchronous等);
+# 配置了MYBLOG_READ_DATABASE_URI时,匿名用户的GET请求经只读连接(或只读副本)查询,写入始终使用主库
+
+READ_BIND = 'myblog_read'
+
+
+class RoutingSession(SignallingSession):
+
+    def __init__(self, db, **options):
+        self.db = db
+        super(RoutingSession, self).__init__(db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        # flush总是写主库;请求标记为只读时其余查询走只读连接
+        if not self._flushing and has_request_context() and g.get('myblog_read_only'):
+            return self.db.get_engine(self.app, bind=READ_BIND)
+        return super(RoutingSession, self).get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+def _is_sqlite(uri):
+    return uri is not None and make_url(uri).drivername.startswith('sqlite')
+
+
+def configure_database(app):
+    """在db.init_app()之前调用:补充连接池选项并登记只读绑定"""
+    options = app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', {})
+    if _is_sqlite(app.config['SQLALCHEMY_DATABASE_URI']) and options.get('pool_size'):
+        # Flask-SQLAlchemy对SQLite文件默认使用NullPool,需显式指定;连接池中的连接会在线程间复用
+        options.setdefault('poolclass', QueuePool)
+        options.setdefault('connect_args', {}).setdefault('check_same_thread', False)
+    read_uri = app.config['MYBLOG_READ_DATABASE_URI']
+    if read_uri:
+        binds = app.config.get('SQLALCHEMY_BINDS') or {}
+        binds[READ_BIND] = read_uri
+        app.config['SQLALCHEMY_BINDS'] = binds
+
+
+def register_pragmas(app, db):
+    """在db.init_app()之后调用:为SQLite引擎注册连接事件"""
+    pragmas = app.config['MYBLOG_SQLITE_PRAGMAS']
+    with app.app_context():
+        if _is_sqlite(app.config['SQLALCHEMY_DATABASE_URI']) and pragmas:
+            event.listen(db.get_engine(app), 'connect', _pragma_listener(pragmas))
+        if _is_sqlite(app.config['MYBLOG_READ_DATABASE_URI']):
+            # 只读连接上的写入会直接报错,不会绕过主库
+            event.listen(db.get_engine(app, bind=READ_BIND), 'connect',
+                         _pragma_listener(dict(pragmas or {}, query_only='ON')))
+
+
+def _pragma_listener(pragmas):
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute('PRAGMA %s = %s' % (name, value))
+        cursor.close()
+    return set_pragmas
+
+
+def use_read_bind():
+    """蓝本的before_request:匿名用户的GET请求改用只读连接
+
+    带闪现消息或待发布评论的请求仍读主库,避免只读副本延迟导致看不到自己刚提交的修改。
+    """
+    if current_app.config['MYBLOG_READ_DATABASE_URI'] and request.method == 'GET' \
+            and not personalized() and not current_user.is_authenticated:
+        g.myblog_read_only = True
@@ -1,25 +1,44 @@
 
-from flask_sqlalchemy import SQLAlchemy
 from flask_ckeditor import CKEditor
 from flask_moment import Moment
 from flask_bootstrap import Bootstrap
 from flask_login import LoginManager
 from flask_wtf.csrf import CSRFProtect
-from flask_migrate import Migrate
+
+from MyBlog.database import RoutingSQLAlchemy
+from MyBlog.caching import SiteContextCache, PageCache, IdentityCache
+from MyBlog.profiler import Profiler
+from MyBlog.assets import Assets
+from MyBlog.commentqueue import CommentQueue
+from MyBlog.fragments import FragmentCache
 
 
 bootstrap = Bootstrap()
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()  # 支持把匿名读请求路由到只读连接
 moment = Moment()
 ckeditor = CKEditor()
 login = LoginManager()
 csrf = CSRFProtect()
-migrate = Migrate()
+site_cache = SiteContextCache()
+page_cache = PageCache()
+identity_cache = IdentityCache()
+profiler = Profiler()
+assets = Assets()
+comment_queue = CommentQueue()
+fragment_cache = FragmentCache()
 
 
-# 用户加载函数,接收用户Id作为参数，返回对应的用户对象
+# 用户加载函数,接收Admin.get_id()的值('id:密码指纹')作为参数，返回对应的用户对象
 @login.user_loader
 def load_user(user_id):
-    from MyBlog.models import Admin
-    user = Admin.query.get(int(user_id))
+    id, _, fingerprint = user_id.partition(':')
+    if not id.isdigit() or not fingerprint:
+        return None
+    user = identity_cache.load_user(int(id))
+    if user is not None and user.get_id() != user_id:
+        # 缓存可能早于密码修改,只重新查询这个用户,以数据库为准;修改密码前签发的会话在这里失效。
+        # 不清空整个缓存:过期的记住我cookie每次请求都会走到这里
+        user = identity_cache.load_user(int(id), refresh=True)
+    if user is None or user.get_id() != user_id:
+        return None
     return user
\ No newline at end of file
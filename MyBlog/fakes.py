@@ -1,10 +1,19 @@
 import random
+from array import array
+from datetime import datetime, timedelta
+from multiprocessing import Pool
+
 from MyBlog.models import Admin, Category, Post, Comment
 from MyBlog.extensions import db
+from MyBlog.utils import summarize_html
 from faker import Faker
-from sqlalchemy.exc import IntegrityError
+from sqlalchemy import func
+
+# 文章和评论用Core insert()按批executemany写入,不经过ORM;
+# 冗余计数与搜索索引由调用方(flask forge)在生成完毕后统一重建。
+# 时间在由种子决定的锚点之前一年内随机生成,相同种子在任何日期生成的数据都相同
 
-fake = Faker()
+EPOCH = datetime(2018, 1, 1)
 
 
 def fake_admin():
@@ -20,77 +29,105 @@ def fake_admin():
     db.session.commit()
 
 
-def fake_category(count=5):
-    # 定义默认分类
-    category = Category(name='Default')
-    db.session.add(category)
+def fake_category(count=5, seed=None):
+    faker = Faker()
+    faker.seed_instance(seed)
+    # 定义默认分类,随机分类名先在内存中去重,一次提交;
+    # 重复时加上序号,数量超过Faker词库中的单词数时也能生成
+    names = ['Default']
+    seen = set(names)
+    while len(names) < count + 1:
+        name = faker.word()
+        if name in seen:
+            name = '%s-%d' % (name, len(names))
+        seen.add(name)
+        names.append(name)
+    db.session.add_all([Category(name=name) for name in names])
+    db.session.commit()
+
 
+# 以下两个函数在子进程中运行:每批使用独立的种子,结果与进程数无关
+def _post_texts(task):
+    seed, count, anchor = task
+    faker = Faker()
+    faker.seed_instance(seed)
+    rows = []
     for i in range(count):
-        category = Category(name=fake.word())
-        db.session.add(category)
-        # 若随机生成分类名重复则回滚，取消添加到category的临时会话
-        try:
-            db.session.commit()
-        except IntegrityError:
-            db.session.rollback()
+        body = faker.text(2000)
+        excerpt, word_count, reading_time = summarize_html(body)
+        timestamp = faker.date_time_between(anchor - timedelta(days=365), anchor)
+        rows.append(dict(title=faker.sentence(), body=body, excerpt=excerpt, word_count=word_count,
+                         reading_time=reading_time, timestamp=timestamp, updated=timestamp))
+    return rows
 
 
-def fake_post(count=25):
-    for i in range(count):
-        post = Post(
-            title=fake.sentence(),
-            body=fake.text(2000),
-            category=Category.query.get(random.randint(1, Category.query.count())),
-            timestamp=fake.date_time_this_year()
-        )
-        db.session.add(post)
-    db.session.commit()
+def _comment_texts(task):
+    seed, count, anchor = task
+    faker = Faker()
+    faker.seed_instance(seed)
+    return [dict(author=faker.name(), body=faker.sentence(),
+                 timestamp=faker.date_time_between(anchor - timedelta(days=365), anchor))
+            for i in range(count)]
 
 
-def fake_comment(count=150):
-    for i in range(count):
-        comment = Comment(
-            author=fake.name(),
-            body=fake.sentence(),
-            timestamp=fake.date_time_this_year(),
-            post=Post.query.get(random.randint(1, Post.query.count())),
-            reviewed=True
-        )
-        db.session.add(comment)
-    db.session.commit()
+def _generate(worker, count, batch_size, rng, anchor, processes):
+    """按批生成数据,processes大于1时用进程池并行生成Faker文本,保持批次顺序"""
+    # 各批的种子先全部取出,之后rng的取值与进程池预取任务的时机无关
+    tasks = [(rng.getrandbits(64), min(batch_size, count - start), anchor) for start in range(0, count, batch_size)]
+    if processes > 1:
+        with Pool(processes) as pool:
+            for rows in pool.imap(worker, tasks):
+                yield rows
+    else:
+        for rows in map(worker, tasks):
+            yield rows
 
-    salt = int(0.1*count)
-    for i in range(salt):
-        comment = Comment(
-            author='一头特立独行的猪',
-            from_admin=True,
-            reviewed=True,
-            body=fake.sentence(),
-            timestamp=fake.date_time_this_year(),
-            post=Post.query.get(random.randint(1, Post.query.count()))
-        )
-        db.session.add(comment)
-    db.session.commit()
 
-    for i in range(salt):
-        comment = Comment(
-            author=fake.name(),
-            body=fake.sentence(),
-            timestamp=fake.date_time_this_year(),
-            replied=Comment.query.get(random.randint(1, Comment.query.count())),
-            post=Post.query.get(random.randint(1, Post.query.count())),
-            reviewed=False
-        )
-        db.session.add(comment)
-    db.session.commit()
-    for i in range(salt):
-        comment = Comment(
-            author=fake.name(),
-            body=fake.sentence(),
-            timestamp=fake.date_time_this_year(),
-            reviewed=True,
-            replied=Comment.query.get(random.randint(1, Comment.query.count())),
-            post=Post.query.get(random.randint(1, Post.query.count()))
-        )
-        db.session.add(comment)
-    db.session.commit()
+def _streams(seed):
+    """由random.Random(seed)派生时间锚点以及文章、评论各自独立的随机序列,两者的批次种子不会重叠"""
+    master = random.Random(random.randrange(2 ** 32) if seed is None else seed)
+    anchor = EPOCH + timedelta(days=master.randrange(3 * 365))
+    return anchor, random.Random(master.getrandbits(64)), random.Random(master.getrandbits(64))
+
+
+def fake_post(count=25, batch_size=1000, seed=None, processes=1, progress=None):
+    anchor, rng, _ = _streams(seed)
+    category_ids = [category_id for category_id, in db.session.query(Category.id)]  # 预先取出分类id池
+    done = 0
+    for rows in _generate(_post_texts, count, batch_size, rng, anchor, processes):
+        for row in rows:
+            row['category_id'] = rng.choice(category_ids)
+        db.session.execute(Post.__table__.insert(), rows)
+        db.session.commit()
+        done += len(rows)
+        if progress is not None:
+            progress(done, count)
+
+
+def fake_comment(count=150, batch_size=1000, seed=None, processes=1, progress=None):
+    # 普通评论count条,另加各10%的管理员评论、未审核回复和已审核回复
+    salt = int(0.1 * count)
+    total = count + 3 * salt
+    anchor, _, rng = _streams(seed)
+    post_ids = [post_id for post_id, in db.session.query(Post.id)]
+    # 显式分配评论id,回复只指向已生成的评论,并与被回复评论属于同一篇文章
+    first_id = (db.session.query(func.max(Comment.id)).scalar() or 0) + 1
+    comment_posts = array('l')
+    comment_id = first_id
+    for rows in _generate(_comment_texts, total, batch_size, rng, anchor, processes):
+        for row in rows:
+            index = comment_id - first_id
+            row.update(id=comment_id, from_admin=False, reviewed=True, replied_id=None,
+                       post_id=rng.choice(post_ids))
+            if count <= index < count + salt:
+                row.update(author='一头特立独行的猪', from_admin=True)
+            elif index >= count + salt:
+                row['replied_id'] = rng.randrange(first_id, comment_id)
+                row['post_id'] = comment_posts[row['replied_id'] - first_id]
+                row['reviewed'] = index >= count + 2 * salt
+            comment_posts.append(row['post_id'])
+            comment_id += 1
+        db.session.execute(Comment.__table__.insert(), rows)
+        db.session.commit()
+        if progress is not None:
+            progress(comment_id - first_id, total)
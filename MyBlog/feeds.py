@@ -0,0 +1,198 @@
+import threading
+from collections import OrderedDict
+from xml.sax.saxutils import escape, quoteattr
+
+from flask import current_app, request, url_for
+from sqlalchemy import func
+from werkzeug.http import http_date, is_resource_modified
+
+from MyBlog.extensions import db, site_cache
+from MyBlog.models import Post, Category
+from MyBlog.utils import make_etag
+
+# Atom/RSS订阅与站点地图:只查询需要的列,逐块生成XML;
+# 生成结果按(最后修改时间, 文章数, 站点版本)缓存,文章未变化时直接复用或返回304
+
+ATOM = 'application/atom+xml'
+RSS = 'application/rss+xml'
+SITEMAP = 'application/xml'
+
+
+def feed_validator(category_id=None):
+    """与列表页相同的轻量查询,返回(etag, last_modified, 文章数),category_id不存在时返回None"""
+    last_modified = db.session.query(func.max(func.coalesce(Post.updated, Post.timestamp)))
+    if category_id is None:
+        count = db.session.query(func.coalesce(func.sum(Category.post_count), 0))
+    else:
+        last_modified = last_modified.filter(Post.category_id == category_id)
+        count = db.session.query(Category.post_count).filter(Category.id == category_id)
+    last_modified, count = db.session.query(last_modified.as_scalar(), count.as_scalar()).one()
+    if count is None:
+        return None
+    return '%s|%s|%s' % (last_modified, count, site_cache.get()['version']), last_modified, count
+
+
+def _entries(category_id=None):
+    # 不加载正文,摘要由update_summary()在保存时生成
+    query = db.session.query(Post.id, Post.title, Post.timestamp, func.coalesce(Post.updated, Post.timestamp),
+                             Post.excerpt, Category.name) \
+        .outerjoin(Category, Post.category_id == Category.id)
+    if category_id is not None:
+        query = query.filter(Post.category_id == category_id)
+    return query.order_by(Post.timestamp.desc(), Post.id.desc()).limit(current_app.config['MYBLOG_FEED_SIZE'])
+
+
+def _site(category_id=None):
+    admin = site_cache.get()['admin']
+    title = admin.blog_title if admin is not None and admin.blog_title else 'MyBlog'
+    subtitle = admin.blog_sub_title if admin is not None else None
+    if category_id is None:
+        link = url_for('blog.index', _external=True)
+    else:
+        name = db.session.query(Category.name).filter(Category.id == category_id).scalar()
+        title = '%s - %s' % (name, title)
+        link = url_for('blog.show_category', category_id=category_id, _external=True)
+    return title, subtitle or '', link, admin.name if admin is not None else None
+
+
+def _atom_date(value):
+    return value.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def atom(category_id=None, last_modified=None):
+    title, subtitle, link, author = _site(category_id)
+    yield '<?xml version="1.0" encoding="utf-8"?>\n<feed xmlns="http://www.w3.org/2005/Atom">\n'
+    yield '<title>%s</title>\n<subtitle>%s</subtitle>\n' % (escape(title), escape(subtitle))
+    yield '<link href=%s rel="alternate"/>\n<link href=%s rel="self"/>\n<id>%s</id>\n' % (
+        quoteattr(link), quoteattr(request.base_url), escape(request.base_url))
+    if last_modified is not None:
+        yield '<updated>%s</updated>\n' % _atom_date(last_modified)
+    if author:
+        yield '<author><name>%s</name></author>\n' % escape(author)
+    for post_id, post_title, timestamp, updated, excerpt, category in _entries(category_id):
+        url = url_for('blog.show_post', post_id=post_id, _external=True)
+        yield '<entry>\n<title>%s</title>\n<link href=%s/>\n<id>%s</id>\n' % (
+            escape(post_title or ''), quoteattr(url), escape(url))
+        yield '<published>%s</published>\n<updated>%s</updated>\n' % (_atom_date(timestamp), _atom_date(updated))
+        if category:
+            yield '<category term=%s/>\n' % quoteattr(category)
+        yield '<summary>%s</summary>\n</entry>\n' % escape(excerpt or '')
+    yield '</feed>\n'
+
+
+def rss(category_id=None, last_modified=None):
+    title, subtitle, link, author = _site(category_id)
+    yield '<?xml version="1.0" encoding="utf-8"?>\n' \
+          '<rss version="2.0" xmlns:atom="http://www.w3.org/2005/Atom">\n<channel>\n'
+    yield '<title>%s</title>\n<link>%s</link>\n<description>%s</description>\n' % (
+        escape(title), escape(link), escape(subtitle or title))
+    yield '<atom:link href=%s rel="self" type="%s"/>\n' % (quoteattr(request.base_url), RSS)
+    if last_modified is not None:
+        yield '<lastBuildDate>%s</lastBuildDate>\n' % http_date(last_modified)
+    for post_id, post_title, timestamp, updated, excerpt, category in _entries(category_id):
+        url = url_for('blog.show_post', post_id=post_id, _external=True)
+        yield '<item>\n<title>%s</title>\n<link>%s</link>\n<guid isPermaLink="true">%s</guid>\n' % (
+            escape(post_title or ''), escape(url), escape(url))
+        yield '<pubDate>%s</pubDate>\n' % http_date(timestamp)
+        if category:
+            yield '<category>%s</category>\n' % escape(category)
+        yield '<description>%s</description>\n</item>\n' % escape(excerpt or '')
+    yield '</channel>\n</rss>\n'
+
+
+def sitemap_pages(count):
+    # count为feed_validator()按冗余计数得到的文章总数,不再查询
+    return max(1, -(-count // current_app.config['MYBLOG_SITEMAP_SIZE']))
+
+
+def sitemap_index(pages, last_modified=None):
+    yield '<?xml version="1.0" encoding="utf-8"?>\n' \
+          '<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n'
+    lastmod = '<lastmod>%s</lastmod>' % _atom_date(last_modified) if last_modified is not None else ''
+    for page in range(1, pages + 1):
+        yield '<sitemap><loc>%s</loc>%s</sitemap>\n' % (
+            escape(url_for('feed.sitemap_page', page=page, _external=True)), lastmod)
+    yield '</sitemapindex>\n'
+
+
+def sitemap(page=1, last_modified=None):
+    """第page个站点地图;首页和分类页放在第一页,文章按id顺序分页"""
+    size = current_app.config['MYBLOG_SITEMAP_SIZE']
+    yield '<?xml version="1.0" encoding="utf-8"?>\n<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n'
+    if page == 1:
+        lastmod = '<lastmod>%s</lastmod>' % _atom_date(last_modified) if last_modified is not None else ''
+        yield '<url><loc>%s</loc>%s</url>\n' % (escape(url_for('blog.index', _external=True)), lastmod)
+        categories = db.session.query(Category.id, func.max(func.coalesce(Post.updated, Post.timestamp))) \
+            .outerjoin(Post, Post.category_id == Category.id).group_by(Category.id).order_by(Category.id)
+        for category_id, updated in categories:
+            yield '<url><loc>%s</loc>%s</url>\n' % (
+                escape(url_for('blog.show_category', category_id=category_id, _external=True)),
+                '<lastmod>%s</lastmod>' % _atom_date(updated) if updated is not None else '')
+    posts = db.session.query(Post.id, func.coalesce(Post.updated, Post.timestamp)).order_by(Post.id) \
+        .offset((page - 1) * size).limit(size).yield_per(1000)
+    for post_id, updated in posts:
+        yield '<url><loc>%s</loc><lastmod>%s</lastmod></url>\n' % (
+            escape(url_for('blog.show_post', post_id=post_id, _external=True)), _atom_date(updated))
+    yield '</urlset>\n'
+
+
+class FeedCache(object):
+    """保存生成好的订阅与站点地图,按路径保存最近使用的max_entries个,数据未变化(ETag相同)时直接复用"""
+
+    def __init__(self, max_entries=100):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()   # 路径 -> (etag, body)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def serve(self, validators, generate, mimetype):
+        """validators为feed_validator()的结果,generate接收last_modified并逐块返回文本"""
+        tag, last_modified = validators[:2]
+        # 文档中是含主机名的完整URL,ETag按完整URL计算;缓存键只用路径,
+        # 不同的Host请求头不会增加缓存条目,只会使ETag不同而重新生成
+        etag = make_etag(tag, request.base_url)
+        key = request.path
+        if not is_resource_modified(request.environ, etag, last_modified=last_modified):
+            response = current_app.response_class(status=304)
+        else:
+            body = self._get(key, etag)
+            if body is None:
+                self.misses += 1
+                # 在请求内完整生成,查询计入本请求(语句数预算),请求上下文结束前生成器已执行完毕
+                body = ''.join(generate(last_modified=last_modified)).encode('utf-8')
+                self._set(key, etag, body)
+            else:
+                self.hits += 1
+            response = current_app.response_class(body, mimetype=mimetype)
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        response.cache_control.public = True
+        response.cache_control.max_age = current_app.config['MYBLOG_FEED_MAX_AGE']
+        return response
+
+    def _get(self, key, etag):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != etag:
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def _set(self, key, etag, body):
+        with self._lock:
+            self._entries[key] = (etag, body)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses, entries=len(self._entries),
+                    bytes=sum(len(body) for etag, body in self._entries.values()))
+
+
+feed_cache = FeedCache()
@@ -0,0 +1,116 @@
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+from jinja2 import nodes
+from jinja2.ext import Extension
+
+from MyBlog.signals import models_changed
+
+# 模板片段缓存:
+#
+#     {% cache key[, ttl[, '模型名'...]] %} ... {% endcache %}
+#
+# 缓存键由模板名、标签所在行、key表达式的值以及所列模型的版本号组成。模型版本在models_changed信号中递增,
+# 旧版本的片段不再被命中,随LRU淘汰;key中带上记录自身的更新时间(如post.updated)时无需列出模型。
+# ttl省略或为none时使用MYBLOG_FRAGMENT_CACHE_TTL,0表示不过期。
+# 片段在整页缓存之下工作:管理员等无法使用整页缓存的请求也能复用大部分已渲染的HTML
+
+
+class FragmentCache(object):
+
+    def __init__(self, app=None):
+        self.max_bytes = 0
+        self.ttl = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.size = 0  # 当前占用的估算字节数
+        self.versions = {}  # 模型名 -> 版本号
+        self._entries = OrderedDict()  # key -> (expires, value, size)
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.max_bytes = app.config['MYBLOG_FRAGMENT_CACHE_SIZE'] or 0
+        self.ttl = app.config['MYBLOG_FRAGMENT_CACHE_TTL']
+        app.jinja_env.add_extension(FragmentCacheExtension)
+        app.jinja_env.extend(fragment_cache=self)
+        models_changed.connect(self._on_models_changed)
+
+    def _on_models_changed(self, sender, changes):
+        with self._lock:
+            for model in set(change.model for change in changes):
+                self.versions[model] = self.versions.get(model, 0) + 1
+
+    def stamp(self, models):
+        return tuple(self.versions.get(model, 0) for model in models)
+
+    def get(self, key):
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None or (item[0] is not None and item[0] <= time.time()):
+                if item is not None:
+                    self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def set(self, key, value, ttl=None):
+        # 按对象实际占用的内存计算,超过上限时从最久未使用的片段开始淘汰
+        size = sys.getsizeof(key) + sys.getsizeof(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (time.time() + ttl if ttl else None, value, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        item = self._entries.pop(key, None)
+        if item is not None:
+            self.size -= item[2]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses, evictions=self.evictions,
+                    entries=len(self._entries), bytes=self.size)
+
+
+class FragmentCacheExtension(Extension):
+    tags = {'cache'}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        key = parser.parse_expression()
+        ttl = nodes.Const(None)
+        models = []
+        if parser.stream.skip_if('comma'):
+            ttl = parser.parse_expression()
+            while parser.stream.skip_if('comma'):
+                models.append(parser.parse_expression())
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        args = [nodes.Const('%s:%d' % (parser.name, lineno)), key, ttl, nodes.List(models)]
+        return nodes.CallBlock(self.call_method('_render', args), [], [], body).set_lineno(lineno)
+
+    def _render(self, location, key, ttl, models, caller):
+        cache = self.environment.fragment_cache
+        if not cache.max_bytes:
+            return caller()
+        key = '%s:%r:%r' % (location, key, cache.stamp(models))
+        value = cache.get(key)
+        if value is None:
+            value = caller()  # 自动转义开启时为Markup,原样缓存,输出时不会再次转义
+            cache.set(key, value, cache.ttl if ttl is None else ttl)
+        return value
@@ -0,0 +1,244 @@
+import html
+import json
+import os
+import posixpath
+import re
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, parse_qsl
+
+from flask import current_app, url_for, safe_join
+from sqlalchemy import func
+from werkzeug.exceptions import HTTPException
+
+from MyBlog.extensions import db, site_cache
+from MyBlog.models import Post, Category, Comment
+from MyBlog.utils import FREEZE_ENVIRON_KEY
+
+# 静态导出:把首页、分类页的每一页和每篇文章(评论第一页)渲染为HTML文件,可由nginx直接发送或在本地直接打开。
+#
+#     /                   -> index.html             /?page=2            -> page/2.html
+#     /post/5             -> post/5.html            /category/3?page=2  -> category/3/page/2.html
+#
+# 页面之间、页面到静态文件和上传图片的链接改写为相对路径;其他链接(评论翻页、搜索、登录、后台等)保持原样,
+# 由Flask处理。渲染时评论表单换成指向动态页面的链接,静态页面中没有会过期的CSRF令牌。
+# 每个页面的指纹(与条件请求的ETag使用相同的时间戳与计数)记录在.freeze.json中,再次导出时只渲染有变化的页面
+
+MANIFEST = '.freeze.json'
+VERSION = 1
+_url_attribute = re.compile(r'''(\s(?:href|src|action|srcset)=)(["'])(.*?)\2''', re.S)
+
+
+class FreezeError(RuntimeError):
+    pass
+
+
+def _pages(per_page, count):
+    return max((count + per_page - 1) // per_page, 1)
+
+
+def _page_file(path, page):
+    base = path.strip('/')
+    if page > 1:
+        return posixpath.join(base, 'page', '%d.html' % page)
+    return (base or 'index') + '.html'
+
+
+def plan_pages():
+    """返回[(url, 文件, 指纹)],每类页面各一次查询"""
+    per_page = current_app.config['MYBLOG_POST_PER_PAGE']
+    version = site_cache.get()['version']
+    pages = []
+
+    last_modified, count = db.session.query(func.max(Post.updated), func.count(Post.id)).one()
+    fingerprint = '%s|%s|%s' % (last_modified, count, version)
+    path = url_for('blog.index')
+    for page in range(1, _pages(per_page, count) + 1):
+        pages.append((url_for('blog.index', page=page) if page > 1 else path, _page_file(path, page), fingerprint))
+
+    last_updated = db.session.query(Post.category_id, func.max(Post.updated).label('updated')) \
+        .group_by(Post.category_id).subquery()
+    categories = db.session.query(Category.id, Category.post_count, last_updated.c.updated) \
+        .outerjoin(last_updated, last_updated.c.category_id == Category.id).order_by(Category.id)
+    for category_id, count, last_modified in categories:
+        fingerprint = '%s|%s|%s' % (last_modified, count, version)
+        path = url_for('blog.show_category', category_id=category_id)
+        for page in range(1, _pages(per_page, count or 0) + 1):
+            url = url_for('blog.show_category', category_id=category_id, page=page) if page > 1 else path
+            pages.append((url, _page_file(path, page), fingerprint))
+
+    last_comment = db.session.query(func.max(Comment.timestamp)).filter(Comment.post_id == Post.id) \
+        .correlate(Post).as_scalar()
+    posts = db.session.query(Post.id, func.coalesce(Post.updated, Post.timestamp), Post.comment_count,
+                             last_comment).order_by(Post.id)
+    for post_id, updated, count, last_comment in posts:
+        path = url_for('blog.show_post', post_id=post_id)
+        pages.append((path, _page_file(path, 1), '%s|%s|%s|%s' % (updated, last_comment, count, version)))
+    return pages
+
+
+class Freezer(object):
+
+    def __init__(self, app, output, workers=4):
+        self.app = app
+        self.output = os.path.abspath(output)
+        self.workers = max(workers, 1)
+        self.files = {}     # 已导出页面的url -> 文件
+        self.static_prefix = app.static_url_path.rstrip('/') + '/'
+
+    def freeze(self, full=False, progress=None):
+        """导出到self.output,返回各类文件数;full为True时忽略上次的指纹全部重新渲染"""
+        with self.app.test_request_context():
+            pages = plan_pages()
+        self.files = dict((url, filename) for url, filename, _ in pages)
+        manifest = {} if full else self._load_manifest()
+        previous = manifest.get('pages', {})
+
+        todo = [(url, filename, fingerprint) for url, filename, fingerprint in pages
+                if full or previous.get(url, {}).get('fingerprint') != fingerprint
+                or not os.path.isfile(os.path.join(self.output, filename))]
+        entries = dict((url, previous[url]) for url, _, _ in pages if url in previous)
+        done = 0
+        with ThreadPoolExecutor(self.workers) as executor:
+            for url, entry in executor.map(self._render, todo):
+                entries[url] = entry
+                done += 1
+                if progress is not None:
+                    progress(done, len(todo))
+
+        # 删除已不存在的页面(删除的文章、减少的页数)
+        removed = 0
+        for url, entry in previous.items():
+            if url not in self.files and self._remove(entry['file']):
+                removed += 1
+        # 复制仍被引用的静态文件和上传图片,删除不再被引用的上传图片
+        assets = set()
+        for entry in entries.values():
+            assets.update(entry['assets'])
+        copied = sum(self._copy(path) for path in sorted(assets))
+        for path in set(manifest.get('assets', ())) - assets:
+            removed += self._remove(path)
+
+        self._write(MANIFEST, json.dumps(dict(version=VERSION, pages=entries, assets=sorted(assets)),
+                                         indent=1, sort_keys=True).encode('utf-8'))
+        return dict(rendered=len(todo), unchanged=len(pages) - len(todo), removed=removed, copied=copied)
+
+    def _load_manifest(self):
+        try:
+            with open(os.path.join(self.output, MANIFEST), encoding='utf-8') as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        return manifest if manifest.get('version') == VERSION else {}
+
+    def _render(self, item):
+        url, filename, fingerprint = item
+        # 每个线程各自的客户端和应用上下文(数据库会话);不保存cookie,页面总以匿名用户渲染
+        client = self.app.test_client(use_cookies=False)
+        response = client.get(url, environ_base={FREEZE_ENVIRON_KEY: True})
+        if response.status_code != 200:
+            raise FreezeError('%s 返回 %s' % (url, response.status))
+        assets = set()
+        body = self.rewrite(response.get_data(as_text=True), filename, assets)
+        self._write(filename, body.encode('utf-8'))
+        return url, dict(file=filename, fingerprint=fingerprint, assets=sorted(assets))
+
+    def rewrite(self, body, filename, assets):
+        """把body中指向已导出页面、静态文件和上传图片的链接改写为相对filename的路径,引用的文件加入assets"""
+        start = posixpath.dirname(filename) or '.'
+
+        def relative(value):
+            parts = urlsplit(value)
+            if parts.scheme or parts.netloc or not parts.path.startswith('/'):
+                return value
+            fragment = '#' + parts.fragment if parts.fragment else ''
+            query = parse_qsl(parts.query, keep_blank_values=True)
+            target = None
+            if not query or [key for key, _ in query] == ['page']:
+                page = query[0][1] if query else '1'
+                target = self.files.get(parts.path if page == '1' else '%s?page=%s' % (parts.path, page))
+            if target is not None:
+                return posixpath.relpath(target, start) + fragment
+            if self._asset_file(parts.path) is None:
+                return value
+            assets.add(parts.path.lstrip('/'))
+            # 保留静态文件的?v=指纹,浏览器缓存随内容失效
+            return posixpath.relpath(parts.path.lstrip('/'), start) + \
+                ('?' + parts.query if parts.query else '') + fragment
+
+        def replace(match):
+            attribute, quote, value = match.groups()
+            value = html.unescape(value)
+            if attribute.strip() == 'srcset=':
+                candidates = [candidate.strip().split(None, 1) for candidate in value.split(',') if candidate.strip()]
+                new = ', '.join(' '.join([relative(candidate[0])] + candidate[1:]) for candidate in candidates)
+            else:
+                new = relative(value)
+            if new == value:
+                return match.group(0)
+            return attribute + quote + html.escape(new) + quote
+
+        return _url_attribute.sub(replace, body)
+
+    def _asset_file(self, path):
+        """返回URL对应的静态文件或上传文件的路径,其他URL返回None"""
+        if not path.startswith(self.static_prefix) and not path.startswith('/admin/uploads/'):
+            return None
+        adapter = self.app.url_map.bind('localhost')
+        try:
+            endpoint, values = adapter.match(path, method='GET')
+        except HTTPException:
+            return None
+        if endpoint == 'admin.get_image':
+            folder = self.app.config['MYBLOG_UPLOAD_PATH']
+        elif endpoint == 'static':
+            folder = self.app.static_folder
+        elif endpoint.endswith('.static') and endpoint.rsplit('.', 1)[0] in self.app.blueprints:
+            folder = self.app.blueprints[endpoint.rsplit('.', 1)[0]].static_folder
+        else:
+            return None
+        source = safe_join(folder, values['filename']) if folder else None
+        return source if source is not None and os.path.isfile(source) else None
+
+    def _copy(self, path):
+        # 大小和修改时间都相同时跳过
+        source = self._asset_file('/' + path)
+        if source is None:
+            return 0
+        target = os.path.join(self.output, path)
+        stat = os.stat(source)
+        try:
+            current = os.stat(target)
+            if current.st_size == stat.st_size and int(current.st_mtime) == int(stat.st_mtime):
+                return 0
+        except OSError:
+            pass
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        shutil.copy2(source, target)
+        return 1
+
+    def _write(self, filename, data):
+        # 先写临时文件再替换,nginx不会读到写了一半的页面
+        target = os.path.join(self.output, filename)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(target), prefix='.freeze-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.chmod(tmp, 0o644)
+            os.replace(tmp, target)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def _remove(self, filename):
+        try:
+            os.unlink(os.path.join(self.output, filename))
+        except OSError:
+            return 0
+        return 1
+
+
+def freeze_site(output, workers=4, full=False, progress=None):
+    return Freezer(current_app._get_current_object(), output, workers).freeze(full, progress)
@@ -0,0 +1,143 @@
+import json
+import logging
+import time
+
+from flask import before_render_template, template_rendered, current_app, g, has_app_context, request
+from flask_login import current_user
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# 请求级性能记录:总耗时、SQL条数与耗时、模板渲染耗时、响应大小
+# 结果写入Server-Timing响应头和MyBlog.perf日志(每行一个JSON),慢请求附带完整的SQL与参数
+
+perf_logger = logging.getLogger('MyBlog.perf')
+
+
+class RequestTiming(object):
+
+    def __init__(self, keep_statements):
+        self.start = time.perf_counter()
+        self.sql_count = 0
+        self.sql_time = 0.0
+        self.render_time = 0.0
+        self.keep_statements = keep_statements  # 最多保留的语句数,0表示不保留
+        self.statements = []  # (耗时毫秒, 语句, 参数)
+        self._render_start = []
+
+    def elapsed(self):
+        return (time.perf_counter() - self.start) * 1000
+
+
+def _timing():
+    return g.get('myblog_timing') if has_app_context() else None
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('myblog_query_start', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get('myblog_query_start')
+    if not starts:
+        return
+    duration = (time.perf_counter() - starts.pop()) * 1000
+    timing = _timing()
+    if timing is not None:
+        timing.sql_count += 1
+        timing.sql_time += duration
+        if len(timing.statements) < timing.keep_statements:
+            timing.statements.append((duration, statement, parameters))
+
+
+def _before_render(sender, template, context, **extra):
+    timing = _timing()
+    if timing is not None:
+        timing._render_start.append(time.perf_counter())
+
+
+def _rendered(sender, template, context, **extra):
+    timing = _timing()
+    if timing is not None and timing._render_start:
+        start = timing._render_start.pop()
+        if not timing._render_start:  # 嵌套渲染只计外层
+            timing.render_time += (time.perf_counter() - start) * 1000
+
+
+class JSONFormatter(logging.Formatter):
+    """每条日志输出为一行JSON,perf字段(见finish_timing)展开到顶层"""
+    request_fields = ('url', 'remote_addr', 'method', 'endpoint', 'status', 'latency_ms')
+
+    def format(self, record):
+        data = dict(time=self.formatTime(record), level=record.levelname, message=record.getMessage())
+        # 由logwriter.RequestQueueHandler在请求线程中取出的请求信息
+        for key in self.request_fields:
+            value = getattr(record, key, None)
+            if value is not None:
+                data[key] = value
+        data.update(getattr(record, 'perf', {}))
+        if record.exc_info:
+            data['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            data['exception'] = record.exc_text
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+def _short(value, limit=200):
+    value = repr(value)
+    return value if len(value) <= limit else value[:limit] + '...'
+
+
+def register_instrumentation(app):
+    """MYBLOG_SERVER_TIMING控制响应头(True、False或'admin');MYBLOG_SLOW_REQUEST_MS为慢请求阈值(毫秒),None表示不记录SQL明细"""
+    if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+    before_render_template.connect(_before_render, app)
+    template_rendered.connect(_rendered, app)
+
+    @app.before_request
+    def start_timing():
+        threshold = current_app.config['MYBLOG_SLOW_REQUEST_MS']
+        g.myblog_timing = RequestTiming(current_app.config['MYBLOG_SLOW_SQL_LIMIT'] if threshold is not None else 0)
+
+    @app.after_request
+    def finish_timing(response):
+        timing = g.pop('myblog_timing', None)
+        if timing is None:
+            return response
+        total = timing.elapsed()
+        size = None if response.is_streamed else response.calculate_content_length()
+        server_timing = current_app.config['MYBLOG_SERVER_TIMING']
+        if server_timing == 'admin':
+            server_timing = current_user.is_authenticated
+        if server_timing:
+            response.headers['Server-Timing'] = \
+                'app;dur=%.1f, db;dur=%.1f;desc="%d queries", tpl;dur=%.1f' % (
+                    total, timing.sql_time, timing.sql_count, timing.render_time)
+        record = dict(
+            method=request.method,
+            path=request.full_path.rstrip('?'),
+            endpoint=request.endpoint,
+            status=response.status_code,
+            total_ms=round(total, 2),
+            sql_count=timing.sql_count,
+            sql_ms=round(timing.sql_time, 2),
+            render_ms=round(timing.render_time, 2),
+            bytes=size,
+            cache=response.headers.get('X-Page-Cache')
+        )
+        threshold = current_app.config['MYBLOG_SLOW_REQUEST_MS']
+        if threshold is not None and total >= threshold:
+            record['slow'] = True
+            record['statements'] = [dict(ms=round(duration, 2), sql=statement, params=_short(parameters))
+                                    for duration, statement, parameters in timing.statements]
+            perf_logger.warning('slow request', extra=dict(perf=record))
+        else:
+            perf_logger.info('request', extra=dict(perf=record))
+        return response
+
+
+def request_statements():
+    """当前请求已执行的SQL(耗时毫秒, 语句, 参数),供异常日志使用"""
+    timing = _timing()
+    return timing.statements if timing is not None else []
@@ -0,0 +1,237 @@
+import atexit
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+from logging.handlers import QueueHandler
+
+from flask import g, has_request_context, request
+
+# 异步日志:请求线程只把记录放入有界队列(满时丢弃并计数,不阻塞),
+# 由每个日志文件各自的写线程批量格式化、写入,并按大小和时间轮转。
+# 写线程在每个进程第一次入队时启动:gunicorn --preload等先创建应用再fork时,子进程不会沿用父进程中不存在的线程
+
+
+class RequestQueueHandler(QueueHandler):
+
+    def __init__(self, writer):
+        super(RequestQueueHandler, self).__init__(writer.queue)
+        self.writer = writer
+
+    def prepare(self, record):
+        # 写线程中没有请求上下文,入队前先取出请求信息
+        if has_request_context():
+            record.url = request.url
+            record.remote_addr = request.remote_addr
+            record.method = request.method
+            record.endpoint = request.endpoint
+            timing = g.get('myblog_timing')
+            if timing is not None:
+                record.latency_ms = round(timing.elapsed(), 2)
+        perf = getattr(record, 'perf', None)
+        if perf is not None:
+            record.status = perf.get('status')
+            record.latency_ms = perf.get('total_ms', getattr(record, 'latency_ms', None))
+        # 与QueueHandler.prepare相同:提前生成消息与异常文本,记录可以安全地跨线程
+        record.message = record.getMessage()
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.msg = record.message
+        record.args = None
+        record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        writer = self.writer
+        if writer.pid != os.getpid():
+            writer.start()
+        try:
+            writer.queue.put_nowait(record)
+        except queue.Full:
+            writer.dropped += 1
+
+
+class AsyncLogWriter(object):
+
+    def __init__(self, path, formatter, max_bytes=10 * 1024 * 1024, backup_count=10, rotate_seconds=None,
+                 queue_size=10000, batch_size=200, flush_interval=1.0):
+        self.path = path
+        self.formatter = formatter
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.rotate_seconds = rotate_seconds
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue_size = queue_size
+        self.pid = None     # 写线程所在的进程
+        self._thread = None
+        self._lock = threading.Lock()
+        self._reset()
+        folder = os.path.dirname(path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+
+    def _reset(self):
+        self.queue = queue.Queue(self.queue_size)
+        # 计数:写入、因队列满而丢弃、批次、轮转,以及队列最大积压;每个进程各自计数
+        self.written = 0
+        self.dropped = 0
+        self.batches = 0
+        self.rotations = 0
+        self.max_backlog = 0
+        self.errors = 0     # 写入或轮转失败的批次
+        self._reported_drops = 0
+        self._failing = False
+        self._stopping = False
+        self._stream = None
+        self._rollover_at = None
+
+    def handler(self, level=logging.NOTSET):
+        handler = RequestQueueHandler(self)
+        handler.setLevel(level)
+        return handler
+
+    def start(self):
+        """在当前进程中启动写线程;fork出的子进程丢弃继承来的队列、文件和计数,重新启动"""
+        with self._lock:
+            if self.pid == os.getpid():
+                return
+            if self.pid is not None:
+                self._reset()   # 父进程的缓冲已在每批写入后flush,不会重复写入
+            self.pid = os.getpid()
+            self._thread = threading.Thread(target=self.run, name='myblog-log-writer')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def run(self):
+        while True:
+            try:
+                batch = [self.queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                batch = []
+            self.max_backlog = max(self.max_backlog, self.queue.qsize() + len(batch))
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            records = [record for record in batch if record is not None]
+            try:
+                self._write(records)
+            except Exception as e:
+                # 磁盘已满、没有权限等错误不能结束写线程,否则之后的记录全部被静默丢弃;
+                # 这一批计为丢弃,恢复后写入的第一批会附带丢弃数
+                self.errors += 1
+                self.dropped += len(records)
+                if not self._failing:  # 只报告每次故障的开始,错误持续时不刷屏
+                    sys.stderr.write('myblog log writer: cannot write %s: %r\n' % (self.path, e))
+                    self._failing = True
+                self._close()
+            else:
+                if self._failing:
+                    sys.stderr.write('myblog log writer: resumed writing %s\n' % self.path)
+                    self._failing = False
+            if None in batch:  # stop()放入的结束标记
+                break
+        self._close()
+
+    def _write(self, records):
+        lines = []
+        dropped = self.dropped
+        if dropped > self._reported_drops:
+            # 写线程跟不上或写入出错时在日志中留下记录
+            lines.append(self.formatter.format(logging.makeLogRecord(dict(
+                name='MyBlog.logwriter', levelno=logging.WARNING, levelname='WARNING',
+                msg='log queue full or write failed, dropped %d records' % (dropped - self._reported_drops)))))
+        for record in records:
+            try:
+                lines.append(self.formatter.format(record))
+            except Exception:
+                self.dropped += 1
+        if not lines:
+            return
+        if self._stream is None or self._stream.closed:  # 首次写入,或上次打开、轮转失败
+            self._open()
+        if self._should_rotate():
+            self._rotate()
+        self._stream.write('\n'.join(lines) + '\n')
+        self._stream.flush()
+        self._reported_drops = dropped
+        self.written += len(records)
+        self.batches += 1
+
+    def _open(self):
+        self._stream = open(self.path, 'a', encoding='utf-8')
+        if self.rotate_seconds:
+            self._rollover_at = time.time() + self.rotate_seconds
+
+    def _close(self):
+        # 出错后丢弃缓冲区中未写入的内容,下一批重新打开文件
+        if self._stream is not None:
+            try:
+                self._stream.close()
+            except OSError:
+                pass
+            self._stream = None
+
+    def _should_rotate(self):
+        if self.max_bytes and self._stream.tell() >= self.max_bytes:
+            return True
+        return self._rollover_at is not None and time.time() >= self._rollover_at
+
+    def _rotate(self):
+        # 与RotatingFileHandler相同的命名:path.1为最近一份
+        self._stream.close()
+        for index in range(self.backup_count - 1, 0, -1):
+            source = '%s.%d' % (self.path, index)
+            if os.path.exists(source):
+                os.replace(source, '%s.%d' % (self.path, index + 1))
+        if self.backup_count:
+            os.replace(self.path, self.path + '.1')
+        else:
+            os.remove(self.path)
+        self.rotations += 1
+        self._open()
+
+    def stop(self):
+        if not self._stopping and self.pid == os.getpid() and self._thread.is_alive():
+            self._stopping = True
+            self.queue.put(None)  # 结束标记可以阻塞等待,保证退出前写完
+            self._thread.join(5)
+
+    def stats(self):
+        return dict(path=self.path, written=self.written, dropped=self.dropped, errors=self.errors,
+                    batches=self.batches,
+                    rotations=self.rotations, backlog=self.queue.qsize(), max_backlog=self.max_backlog)
+
+
+_writers = {}
+_lock = threading.Lock()
+
+
+def get_writer(path, formatter, config):
+    """同一文件只有一个写对象,写线程在每个进程第一次写日志时启动"""
+    with _lock:
+        writer = _writers.get(path)
+        if writer is None:
+            writer = _writers[path] = AsyncLogWriter(
+                path, formatter,
+                max_bytes=config['MYBLOG_LOG_MAX_BYTES'],
+                backup_count=config['MYBLOG_LOG_BACKUP_COUNT'],
+                rotate_seconds=config['MYBLOG_LOG_ROTATE_SECONDS'],
+                queue_size=config['MYBLOG_LOG_QUEUE_SIZE'],
+                batch_size=config['MYBLOG_LOG_BATCH_SIZE'],
+                flush_interval=config['MYBLOG_LOG_FLUSH_INTERVAL'])
+        return writer
+
+
+def writer_stats():
+    return [writer.stats() for writer in _writers.values()]
+
+
+@atexit.register
+def _stop_writers():
+    for writer in list(_writers.values()):
+        writer.stop()
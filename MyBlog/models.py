@@ -1,7 +1,12 @@
+import hashlib
+
 from flask_moment import datetime
 from MyBlog.extensions import db
+from MyBlog.signals import record_change
+from MyBlog.utils import summarize_html
 from flask_login import UserMixin
 
+from sqlalchemy.orm.attributes import set_committed_value
 from werkzeug.security import generate_password_hash, check_password_hash
 
 
@@ -24,29 +29,51 @@ class Admin(db.Model, UserMixin):
     def validate_password(self, password):
         return check_password_hash(self.password_hash, password)
 
+    # 会话与记住我cookie中保存的标识带有密码哈希的指纹,修改密码后旧的登录状态全部失效
+    def get_id(self):
+        fingerprint = hashlib.sha256((self.password_hash or '').encode('utf-8')).hexdigest()[:16]
+        return '%d:%s' % (self.id, fingerprint)
+
 
 # 分类
 class Category(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(30), unique=True)    # 分类名不允许重复,unique=True
+    post_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)  # 文章数,由counters模块维护
     # back_populates为SQLAlchemy的关系函数参数,用于定义反向引用,建立双向关系,在关系的另一侧也必须显式定义关系属性
     posts = db.relationship('Post', back_populates='category')
 
     def delete(self):
-        default_category = Category.query.get(1)  # 获取默认分类
-        posts = self.posts[:]
-        for post in posts:
-            post.category = default_category
+        # 用一条UPDATE把文章批量移动到默认分类(id为1),并在同一事务中转移文章数
+        record_change(db.session, 'Post', 'bulk', {'category_id': 1}, {'category_id': self.id})
+        # 按实际移动的行数计数,内存中的self.post_count可能已被其他进程的写入改变
+        moved = Post.query.filter_by(category_id=self.id).update({'category_id': 1}, synchronize_session=False)
+        db.session.execute(Category.__table__.update().where(Category.id == 1)
+                           .values(post_count=Category.post_count + moved))
+        db.session.expire(self, ['posts'])
         db.session.delete(self)
         db.session.commit()
 
 
 # 文章
 class Post(db.Model):
+    # 复合索引对应列表页的(时间戳, id)排序及游标分页
+    __table_args__ = (
+        db.Index('ix_post_timestamp_id', 'timestamp', 'id'),
+        db.Index('ix_post_category_id_timestamp', 'category_id', 'timestamp'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(30))
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)  # 时间戳
+    # 最后修改时间,每次UPDATE文章记录时自动刷新,用于生成ETag/Last-Modified
+    updated = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
     body = db.Column(db.Text)
+    # 以下三项在设置body时由update_summary()自动生成,列表页无需加载完整正文
+    excerpt = db.Column(db.Text)    # 纯文本摘要
+    word_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    reading_time = db.Column(db.Integer, default=1, server_default='1', nullable=False)  # 阅读分钟数
+    comment_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)  # 评论数,由counters模块维护
     can_comments = db.Column(db.Boolean, default=True)
 
     category_id = db.Column(db.Integer, db.ForeignKey('category.id'))    # 将category_id设置为外键
@@ -55,8 +82,20 @@ class Post(db.Model):
     comments = db.relationship('Comment', back_populates='post', cascade='all, delete-orphan')  # cascade设置级联操作
 
 
+# 正文被赋值(新建、编辑、导入)时同步更新摘要、字数和阅读时间
+@db.event.listens_for(Post.body, 'set')
+def update_summary(target, value, oldvalue, initiator):
+    target.excerpt, target.word_count, target.reading_time = summarize_html(value)
+
+
 # 评论
 class Comment(db.Model):
+    __table_args__ = (
+        db.Index('ix_comment_post_id_timestamp', 'post_id', 'timestamp'),
+        db.Index('ix_comment_timestamp_id', 'timestamp', 'id'),  # 后台评论管理列表
+        db.Index('ix_comment_post_id_path', 'post_id', 'path'),  # 按路径范围取出整个回复树
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     author = db.Column(db.String(20))
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
@@ -70,4 +109,60 @@ class Comment(db.Model):
     replied_id = db.Column(db.Integer, db.ForeignKey('comment.id'))
     # replied表示被回复评论的标量关系属性, remote_side=[id]将id字段定义为关系远程侧
     replied = db.relationship('Comment', back_populates='replies', remote_side=[id])
-    replies = db.relationship('Comment', back_populates='replied', cascade='all')
\ No newline at end of file
+    # 删除评论及其回复由threads.delete_thread()按路径范围一次完成,ORM不再逐层加载回复
+    replies = db.relationship('Comment', back_populates='replied', cascade='save-update, merge', passive_deletes='all')
+    # 物化路径:各级祖先评论id(定宽)以'/'连接,顶层评论为自身id;按path排序即为回复树的先序遍历
+    path = db.Column(db.String(255))
+    depth = db.Column(db.Integer, default=0, server_default='0', nullable=False)  # 回复层级,顶层为0
+
+    @staticmethod
+    def child_path(parent_path, parent_depth, id):
+        """返回新评论的(path, depth);超过THREAD_MAX_DEPTH层的回复与最深一层并列"""
+        segment = PATH_FORMAT % id
+        if parent_path is None:
+            return segment, 0
+        depth = min(parent_depth + 1, THREAD_MAX_DEPTH)
+        return parent_path[:len(segment) * depth + depth - 1] + PATH_SEPARATOR + segment, depth
+
+    @staticmethod
+    def descendants(path):
+        """path下全部回复的过滤条件,是(post_id, path)索引上的范围查询"""
+        return db.and_(Comment.path > path + PATH_SEPARATOR, Comment.path < path + PATH_UPPER)
+
+
+PATH_FORMAT = '%010d'
+PATH_SEPARATOR = '/'
+PATH_UPPER = chr(ord(PATH_SEPARATOR) + 1)  # 比分隔符大的下一个字符,作为子树路径的上界
+THREAD_MAX_DEPTH = 16  # 17段定宽id,路径不超过String(255)
+
+
+# 新评论写入后根据被回复评论的路径生成自己的路径
+@db.event.listens_for(Comment, 'after_insert')
+def set_comment_path(mapper, connection, target):
+    parent_path, parent_depth = None, 0
+    if target.replied_id is not None:
+        parent = target.__dict__.get('replied')
+        if parent is not None and 'path' in parent.__dict__ and parent.__dict__.get('id') == target.replied_id:
+            row = parent.path, parent.depth  # 同一次flush中先写入的被回复评论
+        else:
+            row = connection.execute(db.select([Comment.path, Comment.depth])
+                                     .where(Comment.id == target.replied_id)).first()
+        if row is not None:  # 被回复评论不存在时作为顶层评论
+            parent_path, parent_depth = row
+            if parent_path is None:
+                return  # 被回复评论尚无路径(旧数据),由flask threads补全
+    path, depth = Comment.child_path(parent_path, parent_depth, target.id)
+    connection.execute(Comment.__table__.update().where(Comment.id == target.id).values(path=path, depth=depth))
+    set_committed_value(target, 'path', path)
+    set_committed_value(target, 'depth', depth)
+
+
+# 站点级计数器,如未读评论数
+class Counter(db.Model):
+    name = db.Column(db.String(30), primary_key=True)
+    value = db.Column(db.Integer, default=0, nullable=False)
+
+    # 读取计数器,记录不存在(尚未执行flask counters)时返回None
+    @staticmethod
+    def get_value(name):
+        return db.session.query(Counter.value).filter_by(name=name).scalar()
@@ -0,0 +1,109 @@
+import base64
+import json
+from datetime import datetime
+
+from flask import abort, current_app, request
+from sqlalchemy import and_, or_
+
+from MyBlog.utils import freezing
+
+_time_format = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def encode_cursor(timestamp, id, direction, page):
+    data = json.dumps([timestamp.strftime(_time_format), id, direction, page], separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        data = base64.urlsafe_b64decode((cursor + '=' * (-len(cursor) % 4)).encode('ascii'))
+        timestamp, id, direction, page = json.loads(data.decode('utf-8'))
+        if direction not in ('n', 'p'):
+            raise ValueError(direction)
+        return datetime.strptime(timestamp, _time_format), int(id), direction, int(page)
+    except (ValueError, TypeError, UnicodeError):
+        abort(404)
+
+
+# 与Flask-SQLAlchemy的Pagination对象接口兼容,可直接传给bootstrap的render_pagination
+class KeysetPagination(object):
+
+    def __init__(self, items, page, per_page, has_prev, has_next, prev_num=None, next_num=None, count=None):
+        self.items = items
+        self.page = page  # 当前页码,仅用于显示和序号计算
+        self.per_page = per_page
+        self.has_prev = has_prev
+        self.has_next = has_next
+        self.prev_num = prev_num  # 上一页游标
+        self.next_num = next_num  # 下一页游标
+        self._count = count
+        self._total = None
+
+    @property
+    def total(self):
+        # 总数按需计算,模板不使用时不会产生COUNT查询
+        if self._total is None and self._count is not None:
+            self._total = self._count() if callable(self._count) else self._count
+        return self._total
+
+    @property
+    def pages(self):
+        if not self.total:
+            return self.page
+        return max(self.page, (self.total + self.per_page - 1) // self.per_page)
+
+    def iter_pages(self, *args, **kwargs):
+        # 游标分页无法跳转到任意页,只显示当前页码
+        yield self.page
+
+
+def paginate(query, per_page, timestamp_column, id_column, count=None):
+    """按(时间戳, id)倒序分页
+
+    开启MYBLOG_KEYSET_PAGINATION时,查询字符串中的page为不透明游标,
+    每页只需一次带索引的范围查询,不再有COUNT(*)和OFFSET扫描;
+    仍兼容page=数字形式的旧链接。count为总数或返回总数的函数,可省略。
+    """
+    page = request.args.get('page', '1')
+    # 静态页面按页码保存,链接也必须是页码
+    if not current_app.config['MYBLOG_KEYSET_PAGINATION'] or freezing():
+        page = int(page) if page.isdigit() else 1
+        return query.order_by(timestamp_column.desc(), id_column.desc()).paginate(page, per_page=per_page)
+
+    if page.isdigit():
+        page = max(int(page), 1)
+        items = query.order_by(timestamp_column.desc(), id_column.desc()) \
+            .offset((page - 1) * per_page).limit(per_page + 1).all()
+        has_prev = page > 1
+        has_next = len(items) > per_page
+        items = items[:per_page]
+    else:
+        timestamp, id, direction, page = decode_cursor(page)
+        if direction == 'n':
+            items = query.filter(or_(timestamp_column < timestamp,
+                                     and_(timestamp_column == timestamp, id_column < id))) \
+                .order_by(timestamp_column.desc(), id_column.desc()).limit(per_page + 1).all()
+            has_prev = True
+            has_next = len(items) > per_page
+            items = items[:per_page]
+        else:
+            items = query.filter(or_(timestamp_column > timestamp,
+                                     and_(timestamp_column == timestamp, id_column > id))) \
+                .order_by(timestamp_column.asc(), id_column.asc()).limit(per_page + 1).all()
+            has_prev = len(items) > per_page
+            has_next = True
+            items = items[:per_page][::-1]
+    if not items and page > 1:
+        abort(404)
+
+    timestamp_key = timestamp_column.key
+    id_key = id_column.key
+    prev_num = next_num = None
+    if items and has_prev:
+        first = items[0]
+        prev_num = encode_cursor(getattr(first, timestamp_key), getattr(first, id_key), 'p', page - 1)
+    if items and has_next:
+        last = items[-1]
+        next_num = encode_cursor(getattr(last, timestamp_key), getattr(last, id_key), 'n', page + 1)
+    return KeysetPagination(items, page, per_page, has_prev, has_next, prev_num, next_num, count)
@@ -0,0 +1,195 @@
+import atexit
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+
+from flask import current_app, g, request
+from flask_login import current_user
+
+# 采样分析器:被选中的请求在处理期间由后台线程定时抓取调用栈,在进程内按栈累计,
+# 每MYBLOG_PROFILE_FLUSH_SAMPLES个采样以火焰图工具(flamegraph.pl、speedscope)使用的折叠栈格式
+# 重写该进程在MYBLOG_PROFILE_DIR下的文件;不同的栈最多保留MYBLOG_PROFILE_MAX_STACKS个,文件大小有上限
+
+OTHER_FRAME = '[other]'     # 超出上限的栈按根帧合并到这一帧
+
+
+def _frame_name(code):
+    return '%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+
+def collapse(frame, root, max_depth=128):
+    names = []
+    while frame is not None and len(names) < max_depth:
+        names.append(_frame_name(frame.f_code))
+        frame = frame.f_back
+    names.append(root)
+    return ';'.join(reversed(names))
+
+
+class Sampler(object):
+    """只在有请求被分析时运行的采样线程,空闲后自动退出"""
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self._targets = {}  # 线程id -> (根帧名, Counter)
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self, ident, root):
+        samples = Counter()
+        with self._lock:
+            self._targets[ident] = (root, samples)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='myblog-profiler')
+                self._thread.daemon = True
+                self._thread.start()
+        return samples
+
+    def stop(self, ident):
+        with self._lock:
+            target = self._targets.pop(ident, None)
+        return target[1] if target is not None else Counter()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self._lock:
+                if not self._targets:
+                    self._thread = None
+                    return
+                for ident, (root, samples) in self._targets.items():
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        samples[collapse(frame, root)] += 1
+            del frames
+
+
+class Profiler(object):
+
+    def __init__(self, app=None):
+        self.sampler = None
+        self.folder = None
+        self.flush_samples = 1000
+        self.max_stacks = 5000
+        self.totals = Counter()     # 本进程已写入文件的累计采样
+        self._pending = Counter()   # 尚未写入的采样
+        self._written = False
+        self._pid = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.sampler = Sampler(app.config['MYBLOG_PROFILE_INTERVAL'])
+        self.folder = app.config['MYBLOG_PROFILE_DIR']
+        self.flush_samples = app.config['MYBLOG_PROFILE_FLUSH_SAMPLES']
+        self.max_stacks = app.config['MYBLOG_PROFILE_MAX_STACKS']
+        atexit.register(self.flush)
+
+        @app.before_request
+        def start_profile():
+            if self._wanted():
+                g.myblog_profile = self.sampler.start(threading.get_ident(), request.endpoint or request.path)
+
+        @app.after_request
+        def stop_profile(response):
+            samples = g.pop('myblog_profile', None)
+            if samples is not None:
+                samples = self.sampler.stop(threading.get_ident())
+                self.save(samples)
+                response.headers['X-Profile-Samples'] = str(sum(samples.values()))
+            return response
+
+    def _wanted(self):
+        # 关闭时只有一次请求头/参数判断和一次随机数比较
+        config = current_app.config
+        if request.headers.get(config['MYBLOG_PROFILE_HEADER']) or '_profile' in request.args:
+            return current_user.is_authenticated  # 只有管理员可以手动开启
+        rate = config['MYBLOG_PROFILE_RATE']
+        return rate > 0 and random.random() < rate
+
+    def save(self, samples):
+        """暂存一次请求的采样,攒够flush_samples个采样时并入累计并写入文件"""
+        if not samples:
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                # fork出的子进程不继承父进程的采样,各进程只写自己的文件
+                self._pid = os.getpid()
+                self.totals = Counter()
+                self._pending = Counter()
+                self._written = False
+            self._pending.update(samples)
+            if sum(self._pending.values()) >= self.flush_samples:
+                self._flush()
+
+    def flush(self):
+        with self._lock:
+            if self._pending and self._pid == os.getpid():
+                self._flush()
+
+    def _flush(self):
+        path = os.path.join(self.folder, 'stacks-%d.txt' % self._pid)
+        if self._written and not os.path.exists(path):
+            # 文件已被flask profile --clear删除,之前的累计不再写回
+            self.totals = Counter()
+        self.totals.update(self._pending)
+        self._pending = Counter()
+        if len(self.totals) > self.max_stacks:
+            self.totals = self._truncate(self.totals)
+        os.makedirs(self.folder, exist_ok=True)
+        # 每个进程一个文件,写临时文件后替换,flask profile读取时不会读到写了一半的文件
+        tmp = '%s.tmp' % path
+        with open(tmp, 'w') as f:
+            f.write(self.collapsed(self.totals))
+        os.replace(tmp, path)
+        self._written = True
+
+    def _truncate(self, stacks):
+        # 保留采样数最多的3/4,其余按根帧(端点)合并为'根帧;[other]',留出余量,不必每次写入都截断
+        kept = Counter(dict(stacks.most_common(self.max_stacks * 3 // 4)))
+        for stack, count in stacks.items():
+            if stack not in kept:
+                kept[stack.split(';', 1)[0] + ';' + OTHER_FRAME] += count
+        return kept
+
+    def load(self, endpoint=None):
+        """汇总全部进程的采样结果,endpoint只保留该端点的栈"""
+        stacks = Counter()
+        if not self.folder or not os.path.isdir(self.folder):
+            return stacks
+        for filename in os.listdir(self.folder):
+            if not filename.startswith('stacks-') or not filename.endswith('.txt'):
+                continue
+            with open(os.path.join(self.folder, filename)) as f:
+                for line in f:
+                    stack, _, count = line.rstrip('\n').rpartition(' ')
+                    if stack and (endpoint is None or stack.split(';', 1)[0] == endpoint):
+                        stacks[stack] += int(count)
+        return stacks
+
+    def clear(self):
+        if self.folder and os.path.isdir(self.folder):
+            for filename in os.listdir(self.folder):
+                if filename.startswith('stacks-'):
+                    os.remove(os.path.join(self.folder, filename))
+
+    @staticmethod
+    def collapsed(stacks):
+        return ''.join('%s %d\n' % item for item in sorted(stacks.items()))
+
+    @staticmethod
+    def top(stacks, limit=20):
+        """按自身采样数(栈顶帧)排序的热点函数,返回[(帧名, 自身采样数, 累计采样数)]"""
+        own = Counter()
+        total = Counter()
+        for stack, count in stacks.items():
+            frames = stack.split(';')
+            own[frames[-1]] += count
+            for frame in set(frames[1:]):
+                total[frame] += count
+        return [(frame, count, total[frame]) for frame, count in own.most_common(limit)]
@@ -0,0 +1,62 @@
+from flask import current_app, request
+from flask_sqlalchemy import get_debug_queries
+from sqlalchemy.orm import joinedload, contains_eager, defer
+
+from MyBlog.models import Post, Comment
+
+
+# 各视图的查询配置:模板里用到的关联一次性预加载,计数用SQL聚合完成,避免逐行懒加载(N+1查询)
+
+# 首页与分类页文章列表:只显示摘要,不加载正文
+def post_listing():
+    return Post.query.options(defer(Post.body))
+
+
+# 文章详情页:分类名
+def post_detail():
+    return Post.query.options(joinedload(Post.category))
+
+
+# 文章评论列表:按顶层评论分页,回复由threads.comment_threads()一次取出
+def comment_thread(post):
+    return Comment.query.with_parent(post).filter(Comment.depth == 0)
+
+
+# 后台文章管理:分类,字数使用Post.word_count
+def manage_posts():
+    return Post.query.options(joinedload(Post.category), defer(Post.body))
+
+
+# 后台评论管理:所属文章标题
+def manage_comments(filter_rule):
+    query = Comment.query.join(Comment.post).options(contains_eager(Comment.post).load_only('id', 'title'))
+    if filter_rule == 'unread':
+        query = query.filter(Comment.reviewed == False)  # noqa: E712
+    elif filter_rule == 'admin':
+        query = query.filter(Comment.from_admin == True)  # noqa: E712
+    return query
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+def register_query_budget(app):
+    """按端点检查每个GET请求的SQL语句数(依赖SQLALCHEMY_RECORD_QUERIES)
+
+    MYBLOG_QUERY_BUDGETS为{端点: 最大语句数};MYBLOG_QUERY_BUDGET_STRICT为True时超出预算抛出
+    QueryBudgetExceeded(测试与基准中让请求失败),否则只记录警告日志。
+    """
+    @app.after_request
+    def check_query_budget(response):
+        budget = current_app.config['MYBLOG_QUERY_BUDGETS'].get(request.endpoint)
+        if budget is None or request.method != 'GET':  # 预算只针对页面读取
+            return response
+        queries = get_debug_queries()
+        if len(queries) > budget:
+            message = '%s executed %d queries (budget %d):\n%s' % (
+                request.full_path, len(queries), budget, '\n'.join(query.statement for query in queries))
+            if current_app.config['MYBLOG_QUERY_BUDGET_STRICT']:
+                raise QueryBudgetExceeded(message)
+            current_app.logger.warning(message)
+        return response
@@ -0,0 +1,68 @@
+from sqlalchemy import inspect
+from sqlalchemy.schema import CreateColumn
+
+from MyBlog.extensions import db
+from MyBlog.models import Post
+from MyBlog.utils import summarize_html
+
+# 旧数据库升级:补齐模型中新增的表、列和索引,并为新列回填数据。可重复执行,已存在的表、列和索引不再处理。
+# 新增的非空列都带有server_default,SQLite的ALTER TABLE ADD COLUMN可直接为已有行填入默认值
+
+
+def upgrade_tables():
+    """在主库上创建缺少的表、列和索引,返回执行的变更说明列表"""
+    engine = db.get_engine()
+    changes = []
+    with engine.begin() as connection:
+        inspector = inspect(connection)
+        existing_tables = set(inspector.get_table_names())
+        for table in db.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                table.create(connection)  # 连同索引一起创建
+                changes.append('创建表 %s' % table.name)
+                continue
+            columns = set(column['name'] for column in inspector.get_columns(table.name))
+            for column in table.columns:
+                if column.name not in columns:
+                    connection.execute('ALTER TABLE %s ADD COLUMN %s' % (
+                        connection.dialect.identifier_preparer.format_table(table),
+                        CreateColumn(column).compile(dialect=connection.dialect)))
+                    changes.append('添加列 %s.%s' % (table.name, column.name))
+            indexes = set(index['name'] for index in inspector.get_indexes(table.name))
+            for index in table.indexes:
+                if index.name not in indexes:
+                    index.create(connection)
+                    changes.append('创建索引 %s' % index.name)
+    return changes
+
+
+def backfill_updated():
+    """旧文章没有最后修改时间,取发表时间;返回更新的文章数"""
+    result = db.session.execute(Post.__table__.update().where(Post.updated == None)  # noqa: E711
+                                .values(updated=Post.timestamp))
+    db.session.commit()
+    return result.rowcount
+
+
+def backfill_excerpts(batch_size=500, missing_only=False):
+    """重新生成文章的摘要、字数和阅读时间,missing_only为True时只处理没有摘要的文章;返回更新的文章数"""
+    last_id = 0
+    total = 0
+    while True:
+        query = db.session.query(Post.id, Post.body).filter(Post.id > last_id)
+        if missing_only:
+            query = query.filter(Post.excerpt == None)  # noqa: E711
+        rows = query.order_by(Post.id).limit(batch_size).all()
+        if not rows:
+            break
+        values = []
+        for post_id, body in rows:
+            excerpt, word_count, reading_time = summarize_html(body)
+            values.append(dict(_id=post_id, _excerpt=excerpt, _words=word_count, _minutes=reading_time))
+        db.session.execute(Post.__table__.update().where(Post.id == db.bindparam('_id')).values(
+            excerpt=db.bindparam('_excerpt'), word_count=db.bindparam('_words'),
+            reading_time=db.bindparam('_minutes'), updated=Post.updated), values)
+        db.session.commit()
+        last_id = rows[-1][0]
+        total += len(rows)
+    return total
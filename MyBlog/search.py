@@ -0,0 +1,417 @@
+import base64
+import json
+import math
+import re
+import threading
+from collections import defaultdict
+
+from flask import abort, current_app, has_app_context
+from markupsafe import Markup, escape
+from sqlalchemy import event, text
+
+from MyBlog.extensions import db
+from MyBlog.models import Post, Comment
+from MyBlog.pagination import KeysetPagination
+from MyBlog.signals import models_changed
+from MyBlog.utils import html_to_text
+
+# 全文搜索:SQLite数据库使用FTS5虚拟表,其他数据库退回到进程内的倒排索引
+
+_cjk = re.compile(u'([぀-ヿ㐀-䶿一-鿿豈-﫿가-힯])')
+_word = re.compile(r"[^\W_]+", re.UNICODE)
+_zwsp = u'​'
+
+# 标题、正文、评论三列的权重,两种实现保持一致
+WEIGHTS = (10.0, 1.0, 0.5)
+
+
+# unicode61分词器不切分连续的汉字;在每个汉字两侧插入零宽空格(分隔符),使单字成词,显示时再去掉
+def segment(value):
+    return _cjk.sub(_zwsp + r'\1' + _zwsp, value)
+
+
+def tokenize(value):
+    return [token.lower() for token in _word.findall(segment(value))]
+
+
+def _mark(value):
+    # \x02 \x03 标记命中词的起止位置,先转义再替换为<mark>,避免正文中的尖括号被当作HTML
+    value = escape(value.replace(_zwsp, '').replace('\x03\x02', ''))  # 相邻的单字命中合并为一段
+    return Markup(value.replace('\x02', Markup('<mark>')).replace('\x03', Markup('</mark>')))
+
+
+def encode_cursor(score, id, page):
+    data = json.dumps([score, id, page], separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        data = base64.urlsafe_b64decode((cursor + '=' * (-len(cursor) % 4)).encode('ascii'))
+        score, id, page = json.loads(data.decode('utf-8'))
+        return float(score), int(id), int(page)
+    except (ValueError, TypeError, UnicodeError):
+        abort(404)
+
+
+class SearchResult(object):
+
+    def __init__(self, post_id, score, snippet, post=None):
+        self.post_id = post_id
+        self.score = score
+        self.snippet = snippet
+        self.post = post
+
+
+def _document(connection, post_id, with_comments):
+    """读取一篇文章的(标题, 正文纯文本, 评论),文章不存在时返回None"""
+    row = connection.execute(text('SELECT title, body FROM post WHERE id = :id'), id=post_id).first()
+    if row is None:
+        return None
+    comments = ''
+    if with_comments:
+        comments = ' '.join(body for body, in connection.execute(
+            text('SELECT body FROM comment WHERE post_id = :id'), id=post_id) if body)
+    return row[0] or '', html_to_text(row[1]), comments
+
+
+def _documents(connection, batch_size, with_comments):
+    """按id顺序分批读取全部文章,生成(id, 标题, 正文纯文本, 评论)"""
+    last_id = 0
+    while True:
+        rows = connection.execute(text('SELECT id, title, body FROM post WHERE id > :id ORDER BY id LIMIT :n'),
+                                  id=last_id, n=batch_size).fetchall()
+        if not rows:
+            break
+        comments = defaultdict(list)
+        if with_comments:
+            for post_id, body in connection.execute(
+                    text('SELECT post_id, body FROM comment WHERE post_id BETWEEN :first AND :last'),
+                    first=rows[0][0], last=rows[-1][0]):
+                if body:
+                    comments[post_id].append(body)
+        for post_id, title, body in rows:
+            yield post_id, title or '', html_to_text(body), ' '.join(comments[post_id])
+        last_id = rows[-1][0]
+
+
+# SQLite FTS5实现,索引与文章写入在同一事务中更新
+class FTS5Backend(object):
+    name = 'fts5'
+
+    def __init__(self, with_comments):
+        self.with_comments = with_comments
+        self.ready = None
+        self._warned = False
+
+    def _exists(self, connection):
+        if not self.ready:
+            self.ready = connection.execute(
+                text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'post_fts'")).first() is not None
+        return self.ready
+
+    def rebuild(self, connection, batch_size):
+        connection.execute(text('DROP TABLE IF EXISTS post_fts'))
+        connection.execute(text("CREATE VIRTUAL TABLE post_fts USING fts5(title, body, comments, "
+                                "tokenize = 'unicode61 remove_diacritics 2')"))
+        insert = text('INSERT INTO post_fts (rowid, title, body, comments) VALUES (:id, :title, :body, :comments)')
+        count = 0
+        batch = []
+        for post_id, title, body, comments in _documents(connection, batch_size, self.with_comments):
+            batch.append(dict(id=post_id, title=segment(title), body=segment(body), comments=segment(comments)))
+            if len(batch) >= batch_size:
+                connection.execute(insert, batch)
+                count += len(batch)
+                batch = []
+        if batch:
+            connection.execute(insert, batch)
+            count += len(batch)
+        self.ready = True
+        return count
+
+    def update(self, connection, post_ids):
+        if not self._exists(connection):
+            return
+        for post_id in post_ids:
+            connection.execute(text('DELETE FROM post_fts WHERE rowid = :id'), id=post_id)
+            document = _document(connection, post_id, self.with_comments)
+            if document is not None:
+                connection.execute(
+                    text('INSERT INTO post_fts (rowid, title, body, comments) VALUES (:id, :title, :body, :comments)'),
+                    id=post_id, title=segment(document[0]), body=segment(document[1]), comments=segment(document[2]))
+
+    @staticmethod
+    def _match(terms):
+        # 每个词作为短语加引号,避免用户输入被解析为FTS5查询语法;最后一个词按前缀匹配
+        phrases = ['"%s"' % ' '.join(tokenize(term)) for term in terms]
+        phrases = [phrase for phrase in phrases if phrase != '""']
+        if phrases and not _cjk.search(terms[-1]):
+            phrases[-1] += '*'
+        return ' '.join(phrases)
+
+    def search(self, terms, after, limit):
+        match = self._match(terms)
+        if not match:
+            return []
+        connection = db.session.connection()
+        if not self._exists(connection):
+            # 不在GET请求中建表:匿名请求可能使用只读连接,建立索引由部署时的flask reindex(或upgrade-schema)完成
+            if not self._warned:
+                current_app.logger.warning('search index post_fts does not exist, run "flask reindex"')
+                self._warned = True
+            return []
+        sql = ('SELECT id, score, snip FROM ('
+               'SELECT rowid AS id, bm25(post_fts, %s, %s, %s) AS score, '
+               "snippet(post_fts, -1, char(2), char(3), '…', 24) AS snip "
+               'FROM post_fts WHERE post_fts MATCH :match) ' % WEIGHTS)
+        params = dict(match=match, limit=limit)
+        if after is not None:
+            sql += 'WHERE score > :score OR (score = :score AND id > :id) '
+            params.update(score=after[0], id=after[1])
+        sql += 'ORDER BY score, id LIMIT :limit'
+        return [SearchResult(post_id, score, _mark(snip))
+                for post_id, score, snip in connection.execute(text(sql), **params)]
+
+
+# 纯Python倒排索引,用于非SQLite数据库;每个进程各自在首次搜索时建立,提交后按需刷新变更的文章
+class InvertedIndex(object):
+    name = 'python'
+    k1 = 1.2
+    b = 0.75
+
+    def __init__(self, with_comments):
+        self.with_comments = with_comments
+        self.postings = defaultdict(dict)  # 词 -> {文章id: (标题词频, 正文词频, 评论词频)}
+        self.documents = {}  # 文章id -> (各列长度, (标题, 正文纯文本), 词集合)
+        self.totals = [0, 0, 0]
+        self.built = False
+        self.dirty = set()
+        self._lock = threading.Lock()
+
+    def _add(self, post_id, title, body, comments):
+        columns = [tokenize(title), tokenize(body), tokenize(comments)]
+        frequencies = defaultdict(lambda: [0, 0, 0])
+        for index, tokens in enumerate(columns):
+            for token in tokens:
+                frequencies[token][index] += 1
+        for token, counts in frequencies.items():
+            self.postings[token][post_id] = tuple(counts)
+        lengths = tuple(len(tokens) for tokens in columns)
+        self.totals = [total + length for total, length in zip(self.totals, lengths)]
+        self.documents[post_id] = (lengths, (title, body), set(frequencies))
+
+    def _remove(self, post_id):
+        document = self.documents.pop(post_id, None)
+        if document is None:
+            return
+        self.totals = [total - length for total, length in zip(self.totals, document[0])]
+        for token in document[2]:
+            postings = self.postings.get(token)
+            if postings is not None:
+                postings.pop(post_id, None)
+                if not postings:
+                    del self.postings[token]
+
+    def rebuild(self, connection, batch_size):
+        with self._lock:
+            self.postings.clear()
+            self.documents.clear()
+            self.totals = [0, 0, 0]
+            for document in _documents(connection, batch_size, self.with_comments):
+                self._add(*document)
+            self.built = True
+            self.dirty.clear()
+            return len(self.documents)
+
+    def mark_dirty(self, post_ids):
+        with self._lock:
+            self.dirty.update(post_ids)
+
+    def _refresh(self, connection):
+        with self._lock:
+            dirty, self.dirty = self.dirty, set()
+            for post_id in dirty:
+                self._remove(post_id)
+                document = _document(connection, post_id, self.with_comments)
+                if document is not None:
+                    self._add(post_id, *document)
+
+    @staticmethod
+    def _snippet(texts, pattern, width=48):
+        # 与FTS5的snippet相近:从命中次数最多的列中截取第一个命中词附近的文字
+        value = max(texts, key=lambda text: len(pattern.findall(text)))
+        match = pattern.search(value)
+        start = max(match.start() - width // 2, 0) if match else 0
+        end = start + width * 2
+        snippet = pattern.sub(lambda m: '\x02%s\x03' % m.group(0), value[start:end])
+        return _mark(('…' if start else '') + snippet + ('…' if end < len(value) else ''))
+
+    def search(self, terms, after, limit):
+        tokens = tokenize(' '.join(terms))
+        if not tokens:
+            return []
+        # 与FTS5查询一致:最后一个非中日韩词按前缀匹配
+        prefix = tokens[-1] if not _cjk.search(terms[-1]) else None
+        connection = db.session.connection()
+        if not self.built:
+            self.rebuild(connection, 1000)
+        if self.dirty:
+            self._refresh(connection)
+        with self._lock:
+            groups = []
+            for token in set(tokens):
+                if token == prefix:
+                    groups.append([term for term in self.postings if term.startswith(prefix)])
+                else:
+                    groups.append([token] if token in self.postings else [])
+            # 所有词都出现的文章才算命中
+            candidates = None
+            for group in groups:
+                docs = set()
+                for term in group:
+                    docs.update(self.postings[term])
+                candidates = docs if candidates is None else candidates & docs
+            count = len(self.documents) or 1
+            averages = [(total / float(count)) or 1.0 for total in self.totals]
+            scored = []
+            for post_id in candidates or ():
+                lengths = self.documents[post_id][0]
+                score = 0.0
+                for group in groups:
+                    for term in group:
+                        postings = self.postings[term]
+                        if post_id not in postings:
+                            continue
+                        idf = math.log((count - len(postings) + 0.5) / (len(postings) + 0.5) + 1.0)
+                        for index, tf in enumerate(postings[post_id]):
+                            if tf:
+                                norm = self.k1 * (1 - self.b + self.b * lengths[index] / averages[index])
+                                score -= WEIGHTS[index] * idf * tf * (self.k1 + 1) / (tf + norm)
+                scored.append((score, post_id))
+            scored.sort()
+            if after is not None:
+                scored = [item for item in scored if item > after]
+            words = [re.escape(token) if _cjk.match(token) else
+                     r'\b%s%s' % (re.escape(token), r'\w*' if token == prefix else r'\b') for token in set(tokens)]
+            pattern = re.compile('|'.join(words), re.IGNORECASE | re.UNICODE)
+            return [SearchResult(post_id, score, self._snippet(self.documents[post_id][1], pattern))
+                    for score, post_id in scored[:limit]]
+
+
+class SearchIndex(object):
+    backends = {
+        'fts5': FTS5Backend,
+        'python': InvertedIndex
+    }
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['myblog_search'] = None  # 首次使用时根据数据库类型选择实现
+        models_changed.connect(self._on_models_changed)
+        if not event.contains(db.session, 'after_flush', _after_flush):
+            event.listen(db.session, 'after_flush', _after_flush)
+
+    @property
+    def backend(self):
+        backend = current_app.extensions.get('myblog_search')
+        if backend is None:
+            name = current_app.config['MYBLOG_SEARCH_BACKEND']
+            if name == 'auto':
+                name = 'fts5' if db.engine.dialect.name == 'sqlite' and _has_fts5() else 'python'
+            backend = current_app.extensions['myblog_search'] = \
+                self.backends[name](current_app.config['MYBLOG_SEARCH_COMMENTS'])
+        return backend
+
+    def rebuild(self, batch_size=1000):
+        count = self.backend.rebuild(db.session.connection(), batch_size)
+        db.session.commit()
+        return count
+
+    def update(self, post_ids):
+        """绕过ORM批量写入评论后调用,在当前事务中更新FTS5索引;其余实现由models_changed信号处理"""
+        backend = self.backend
+        if isinstance(backend, FTS5Backend) and backend.with_comments:
+            backend.update(db.session.connection(), sorted(post_ids))
+
+    def search(self, q, cursor, per_page):
+        """搜索并返回与render_pagination兼容的分页对象,items为SearchResult列表"""
+        terms = q.split()[:10]
+        after = None
+        page = 1
+        if cursor and not cursor.isdigit():
+            score, post_id, page = decode_cursor(cursor)
+            after = (score, post_id)
+        results = self.backend.search(terms, after, per_page + 1)
+        has_next = len(results) > per_page
+        results = results[:per_page]
+        posts = dict((post.id, post) for post in Post.query.options(db.defer(Post.body))
+                     .filter(Post.id.in_([result.post_id for result in results])))
+        results = [result for result in results if result.post_id in posts]
+        for result in results:
+            result.post = posts[result.post_id]
+        # 搜索结果只提供下一页游标,上一页由浏览器后退完成
+        next_num = encode_cursor(results[-1].score, results[-1].post_id, page + 1) if has_next and results else None
+        return KeysetPagination(results, page, per_page, False, has_next, None, next_num)
+
+    def _on_models_changed(self, sender, changes):
+        if sender is None:
+            return
+        backend = sender.extensions.get('myblog_search')
+        if isinstance(backend, InvertedIndex):
+            backend.mark_dirty(_affected_posts(changes, backend.with_comments))
+
+
+def _has_fts5():
+    # 使用单独的连接探测,可在flush过程中调用,不影响会话的事务
+    with db.engine.connect() as conn:
+        try:
+            conn.execute(text('CREATE VIRTUAL TABLE temp.fts5_probe USING fts5(x)'))
+            conn.execute(text('DROP TABLE temp.fts5_probe'))
+            return True
+        except Exception:
+            return False
+
+
+def _affected_posts(changes, with_comments):
+    post_ids = set()
+    for change in changes:
+        if change.model == 'Post' and (change.op != 'update' or {'title', 'body'} & set(change.old)):
+            post_ids.add(change.get('id'))
+        elif change.model == 'Comment' and with_comments and (change.op != 'update' or 'body' in change.old):
+            post_ids.add(change.get('post_id'))
+    post_ids.discard(None)
+    return post_ids
+
+
+def _after_flush(session, flush_context):
+    # FTS5索引在写入文章/评论的同一事务中更新
+    if not has_app_context() or 'myblog_search' not in current_app.extensions:
+        return
+    # 尚未选择实现时在此选择,否则进程处理第一次搜索之前写入的文章不会进入索引
+    backend = search_index.backend
+    if not isinstance(backend, FTS5Backend):
+        return
+    post_ids = set()
+    for obj in list(session.new) + list(session.deleted):
+        if isinstance(obj, Post):
+            post_ids.add(obj.id)
+        elif isinstance(obj, Comment) and backend.with_comments:
+            post_ids.add(obj.post_id)
+    for obj in session.dirty:
+        if isinstance(obj, Post) and (_modified(obj, 'title') or _modified(obj, 'body')):
+            post_ids.add(obj.id)
+        elif isinstance(obj, Comment) and backend.with_comments and _modified(obj, 'body'):
+            post_ids.add(obj.post_id)
+    post_ids.discard(None)
+    if post_ids:
+        backend.update(session.connection(), sorted(post_ids))
+
+
+def _modified(obj, key):
+    return db.inspect(obj).attrs[key].history.has_changes()
+
+
+search_index = SearchIndex()
@@ -27,14 +27,112 @@ class BaseConfig(object):
     MYBLOG_MANAGE_POST_PER_PAGE = 15    # 后台管理界面每页文章数
     MYBLOG_COMMENT_PER_PAGE = 5    # 每页评论数
     MYBLOG_MANAGE_COMMENT_PER_PAGE = 15
+    # 列表页改用(时间戳, id)游标分页,避免深页的COUNT(*)和OFFSET扫描
+    MYBLOG_KEYSET_PAGINATION = os.getenv('MYBLOG_KEYSET_PAGINATION', 'false').lower() == 'true'
+
+    # 每个端点单次请求允许的最大SQL语句数(以管理员登录、缓存已预热计),超出时记录警告,严格模式下请求失败
+    MYBLOG_QUERY_BUDGETS = {
+        'blog.index': 4,
+        'blog.show_category': 5,
+        'blog.show_post': 5,
+        'feed.atom_feed': 3,
+        'feed.sitemap_xml': 3,
+        'login.login': 1,
+        'admin.manage_post': 5,
+        'admin.manage_category': 3,
+        'admin.manage_comments': 4,
+        'admin.settings': 2,
+        'admin.edit_post': 4,
+    }
+    MYBLOG_QUERY_BUDGET_STRICT = False
 
     MYBLOG_UPLOAD_PATH = os.path.join(basedir, 'uploads')   # 上传路径
-    MYBLOG_ALLOWED_IMAGE_EXTENSIONS = ['jpg', 'png', 'gif', 'jpeg']    # 允许的图片格式
+    MYBLOG_ALLOWED_IMAGE_EXTENSIONS = ['jpg', 'png', 'gif', 'jpeg']    # 允许的图片格式(按文件头判断)
+    MYBLOG_MAX_IMAGE_SIZE = 8 * 1024 * 1024     # 单张图片上限
+    MAX_CONTENT_LENGTH = 16 * 1024 * 1024   # 请求体上限,超出时直接返回413
+    # 缩放图(需要Pillow):生成的WebP宽度、质量、后台线程数,以及<img>的sizes属性
+    MYBLOG_IMAGE_WIDTHS = [480, 960, 1600]
+    MYBLOG_IMAGE_QUALITY = 80
+    MYBLOG_IMAGE_WORKERS = 2
+    MYBLOG_IMAGE_SIZES = '(max-width: 960px) 100vw, 960px'
+    # 上传文件交给前端服务器发送: None、'x-sendfile'或'x-accel-redirect'(需在nginx中把该前缀设为internal并指向上传目录)
+    MYBLOG_SENDFILE = os.getenv('MYBLOG_SENDFILE')
+    MYBLOG_ACCEL_PREFIX = '/protected-uploads/'
+
+    MYBLOG_ASSET_MANIFEST = os.path.join(basedir, 'cache', 'assets.json')  # flask assets生成的静态文件指纹清单
+    MYBLOG_FREEZE_PATH = os.path.join(basedir, 'frozen')    # flask freeze默认的静态页面输出目录
+
+    # 评论写入队列文件,设置后评论先写入队列,由后台线程批量写入数据库;None表示直接写入
+    MYBLOG_COMMENT_QUEUE = os.getenv('MYBLOG_COMMENT_QUEUE')
+    MYBLOG_COMMENT_QUEUE_BATCH = 200    # 每个事务写入的最多评论数
+    MYBLOG_COMMENT_QUEUE_INTERVAL = 0.5     # 批量写入的间隔(秒)
+
+    MYBLOG_SQLITE_PRAGMAS = None    # SQLite每个新连接执行的PRAGMA,{名称: 值}
+    MYBLOG_READ_DATABASE_URI = None     # 只读连接/只读副本,匿名用户的blog与feed蓝本GET请求使用
+
+    MYBLOG_DEBUG_TOOLBAR = False    # 只在开发配置中按需开启,其他环境不导入flask_debugtoolbar
+
+    MYBLOG_SITE_CACHE_TTL = 60  # 全局模板上下文缓存有效期(秒),多进程部署时其他进程的修改最迟在此时间后可见
+
+    # 已登录管理员的身份与未读评论数缓存(秒);管理员记录变更时更新标记文件,同一台机器上的进程立即失效
+    MYBLOG_IDENTITY_CACHE_TTL = 30
+    MYBLOG_IDENTITY_STAMP = os.path.join(basedir, 'cache', 'identity.stamp')
+
+    MYBLOG_PAGE_CACHE = 'memory'    # 匿名页面缓存后端: 'memory'、'sqlite'或None(关闭)
+    MYBLOG_PAGE_CACHE_PATH = os.path.join(basedir, 'cache', 'pages.db')    # sqlite后端的缓存文件
+    MYBLOG_PAGE_CACHE_SIZE = 500    # 最多缓存的页面数
+    MYBLOG_PAGE_CACHE_TTL = 300     # 页面缓存有效期(秒),None表示只依赖数据变更清除
+    # 模板片段缓存({% cache %}):进程内LRU占用的内存上限(字节,None关闭)与默认有效期(秒)
+    MYBLOG_FRAGMENT_CACHE_SIZE = 4 * 1024 * 1024
+    MYBLOG_FRAGMENT_CACHE_TTL = 60  # 其他进程的修改最迟在此时间后可见,与MYBLOG_SITE_CACHE_TTL一致
+
+    MYBLOG_COMPRESS = True  # 按Accept-Encoding压缩响应(br需要安装brotli)
+    MYBLOG_COMPRESS_MIN_SIZE = 500  # 小于该字节数的响应不压缩
+    MYBLOG_COMPRESS_LEVEL = 6   # gzip压缩级别
+    MYBLOG_BROTLI_QUALITY = 5
+    MYBLOG_COMPRESS_MIMETYPES = ['text/html', 'text/css', 'text/plain', 'text/xml', 'application/json',
+                                 'application/javascript', 'application/xml', 'application/atom+xml',
+                                 'application/rss+xml', 'image/svg+xml']
+
+    MYBLOG_FEED_SIZE = 20   # 订阅中的文章数
+    MYBLOG_FEED_MAX_AGE = 300   # 订阅与站点地图的Cache-Control max-age(秒),过期后以条件请求验证
+    MYBLOG_SITEMAP_SIZE = 50000     # 单个站点地图文件最多的文章数(协议上限50000)
+
+    MYBLOG_SEARCH_BACKEND = 'auto'  # 全文搜索实现: 'fts5'、'python'或'auto'(SQLite且支持FTS5时用fts5)
+    MYBLOG_SEARCH_COMMENTS = True   # 评论内容是否参与搜索
+    MYBLOG_SEARCH_PER_PAGE = 10     # 每页搜索结果数
+
+    # 在响应头Server-Timing中给出总耗时、SQL耗时与条数、模板渲染耗时;'admin'表示只对已登录的管理员给出
+    MYBLOG_SERVER_TIMING = True
+    MYBLOG_PERF_LOG = os.path.join(basedir, 'logs', 'perf.log')    # 每个请求一行JSON的性能日志,None表示不写
+    MYBLOG_SLOW_REQUEST_MS = 500    # 超过该耗时(毫秒)的请求在性能日志中附带SQL语句与参数,None表示关闭
+    MYBLOG_SLOW_SQL_LIMIT = 100     # 慢请求最多记录的SQL条数
+
+    # 日志由后台线程批量写入,队列满时丢弃并计数
+    MYBLOG_LOG_QUEUE_SIZE = 10000
+    MYBLOG_LOG_BATCH_SIZE = 200     # 每次写入的最多记录数
+    MYBLOG_LOG_FLUSH_INTERVAL = 1.0     # 队列空闲时的最长等待(秒)
+    MYBLOG_LOG_MAX_BYTES = 10 * 1024 * 1024     # 按大小轮转
+    MYBLOG_LOG_ROTATE_SECONDS = 24 * 3600   # 按时间轮转,None表示只按大小
+    MYBLOG_LOG_BACKUP_COUNT = 10
+
+    # 采样分析器:管理员请求带上MYBLOG_PROFILE_HEADER头或_profile参数,或按MYBLOG_PROFILE_RATE比例随机抽取
+    MYBLOG_PROFILE_HEADER = 'X-MyBlog-Profile'
+    MYBLOG_PROFILE_RATE = float(os.getenv('MYBLOG_PROFILE_RATE', '0'))
+    MYBLOG_PROFILE_INTERVAL = 0.005     # 采样间隔(秒)
+    MYBLOG_PROFILE_DIR = os.path.join(basedir, 'profiles')   # 各进程的折叠栈文件
+    MYBLOG_PROFILE_FLUSH_SAMPLES = 1000     # 进程内累计多少个采样后重写一次文件
+    MYBLOG_PROFILE_MAX_STACKS = 5000    # 每个进程最多保留的不同栈数,超出的按端点合并
 
 
 # 开发配置类
 class DevelopmentConfig(BaseConfig):
     SQLALCHEMY_DATABASE_URI = prefix + os.path.join(basedir, 'Myblog.db')   # 设置数据库URI
+    MYBLOG_PAGE_CACHE = None    # 开发时修改模板需要立即生效
+    MYBLOG_FRAGMENT_CACHE_SIZE = None
+    # Flask-DebugToolbar(需要安装),设置环境变量MYBLOG_DEBUG_TOOLBAR=true开启
+    MYBLOG_DEBUG_TOOLBAR = os.getenv('MYBLOG_DEBUG_TOOLBAR', 'false').lower() == 'true'
+    DEBUG_TB_INTERCEPT_REDIRECTS = False
 
 
 # 测试配置类
@@ -42,12 +140,30 @@ class TestConfig(BaseConfig):
     TESTING = True
     CKEDITOR_ENABLE_CSRF = False
     SQLALCHEMY_DATABASE_URI = 'sqlite:///:memory:'  # 采用内存型数据库
+    MYBLOG_PERF_LOG = None
+    MYBLOG_COMMENT_QUEUE = None
+    MYBLOG_IDENTITY_STAMP = None
 
 
 # 生产配置类
 class ProductionConfig(BaseConfig):
     # 生产环境下更换其他类型DBMS时，数据库URI会包含敏感信息，因此优先从环境变量DATABASE_URL获取
     SQLALCHEMY_DATABASE_URI = os.getenv('DATABASE_URL', prefix + os.path.join(basedir, 'Myblog_pd.db'))
+    MYBLOG_PAGE_CACHE = 'sqlite'    # 多个worker进程共享页面缓存
+    MYBLOG_SERVER_TIMING = 'admin'  # 耗时和SQL条数不对访客公开
+    # 连接池:SQLite默认每次请求新建连接(NullPool),设置pool_size后复用连接,PRAGMA只在建立连接时执行一次
+    SQLALCHEMY_ENGINE_OPTIONS = {'pool_size': 5, 'max_overflow': 10, 'pool_timeout': 10, 'pool_recycle': 3600}
+    # WAL模式下读写互不阻塞;NORMAL在WAL下只在检查点时同步,断电最多丢失最近的事务而不会损坏数据库
+    MYBLOG_SQLITE_PRAGMAS = {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'busy_timeout': 5000,   # 等待写锁的毫秒数,避免并发写入时立即报database is locked
+        'mmap_size': 256 * 1024 * 1024,
+        'cache_size': -64000,   # 负数表示KiB,约64MB
+        'temp_store': 'MEMORY',
+    }
+    # 例如只读副本的地址;SQLite可以直接设为与主库相同的URI,读请求使用单独的只读连接池
+    MYBLOG_READ_DATABASE_URI = os.getenv('READ_DATABASE_URL')
 
 
 # 定义配置映射字典
@@ -0,0 +1,96 @@
+from flask import current_app, has_app_context
+from flask.signals import Namespace
+from sqlalchemy import event, inspect
+
+# 博客内部信号,缓存等组件通过订阅models_changed得知哪些记录在事务提交后发生了变化
+_signals = Namespace()
+models_changed = _signals.signal('models-changed')
+
+
+class Change(object):
+    """一条记录的变更快照,在flush时生成,提交后随models_changed信号发送"""
+    __slots__ = ('model', 'op', 'values', 'old')
+
+    def __init__(self, model, op, values=None, old=None):
+        self.model = model  # 模型类名,如'Post'
+        self.op = op  # insert / update / delete / bulk
+        self.values = values or {}  # flush时已加载的列值
+        self.old = old or {}  # 本次被修改列的旧值
+
+    def get(self, key, default=None):
+        return self.values.get(key, default)
+
+    def __repr__(self):
+        return '<Change %s %s %r>' % (self.model, self.op, self.values.get('id'))
+
+
+def _snapshot(obj, op):
+    state = inspect(obj)
+    values = {}
+    old = {}
+    for attr in state.mapper.column_attrs:
+        key = attr.key
+        if key in state.dict:
+            values[key] = state.dict[key]
+        if op == 'update':
+            history = state.attrs[key].history
+            if history.deleted:
+                old[key] = history.deleted[0]
+    return Change(type(obj).__name__, op, values, old)
+
+
+def _pending(session):
+    return session.info.setdefault('myblog_changes', [])
+
+
+def record_change(session, model, op, values=None, old=None):
+    """手动登记变更,供绕过ORM的批量语句(query.update()/delete())使用,需在批量语句执行前调用"""
+    _pending(session).append(Change(model, op, values, old))
+    session.info['myblog_bulk_recorded'] = model
+
+
+def _after_flush(session, flush_context):
+    # after_flush中new/dirty/deleted与属性历史仍保留flush前的状态
+    changes = _pending(session)
+    for obj in session.new:
+        changes.append(_snapshot(obj, 'insert'))
+    for obj in session.dirty:
+        if session.is_modified(obj, include_collections=False):
+            changes.append(_snapshot(obj, 'update'))
+    for obj in session.deleted:
+        changes.append(_snapshot(obj, 'delete'))
+
+
+def _after_bulk(update_context):
+    # 未经record_change登记的批量操作,只能知道涉及的模型
+    session = update_context.session
+    model = update_context.mapper.class_.__name__
+    if session.info.pop('myblog_bulk_recorded', None) != model:
+        _pending(session).append(Change(model, 'bulk'))
+
+
+def _after_commit(session):
+    changes = session.info.pop('myblog_changes', None)
+    if changes:
+        sender = current_app._get_current_object() if has_app_context() else None
+        models_changed.send(sender, changes=changes)
+
+
+def _after_rollback(session, previous_transaction):
+    session.info.pop('myblog_changes', None)
+    session.info.pop('myblog_bulk_recorded', None)
+
+
+def register_session_events(session):
+    """在会话上注册变更跟踪事件,重复调用不会重复注册"""
+    if event.contains(session, 'after_flush', _after_flush):
+        return
+    event.listen(session, 'after_flush', _after_flush)
+    event.listen(session, 'after_bulk_update', _after_bulk)
+    event.listen(session, 'after_bulk_delete', _after_bulk)
+    event.listen(session, 'after_commit', _after_commit)
+    event.listen(session, 'after_soft_rollback', _after_rollback)
+
+
+def changed_models(changes):
+    return set(change.model for change in changes)
@@ -0,0 +1,47 @@
+import json
+import os
+import subprocess
+import sys
+
+# 冷启动分析:在新的解释器中用-X importtime导入MyBlog并调用create_app(),
+# 当前进程已导入的模块不会影响结果,相当于一个新启动的gunicorn worker
+
+basedir = os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
+
+_script = '''
+import json, sys, time
+start = time.perf_counter()
+import MyBlog
+imported = time.perf_counter()
+MyBlog.create_app(sys.argv[1])
+created = time.perf_counter()
+print(json.dumps(dict(import_ms=(imported - start) * 1000, create_app_ms=(created - imported) * 1000)))
+'''
+
+
+def parse_importtime(lines):
+    """解析-X importtime的输出,返回[{name, self, cumulative, depth}],时间单位为微秒"""
+    modules = []
+    for line in lines:
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        if len(fields) != 3 or not fields[0].strip().isdigit():
+            continue  # 表头
+        name = fields[2].rstrip()
+        stripped = name.lstrip()
+        modules.append(dict(name=stripped, self=int(fields[0]), cumulative=int(fields[1]),
+                            depth=(len(name) - len(stripped) - 1) // 2))
+    return modules
+
+
+def profile_startup(config_name='production'):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [basedir, os.environ.get('PYTHONPATH')])))
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', _script, config_name],
+                             cwd=basedir, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                             universal_newlines=True)
+    if process.returncode != 0:
+        raise RuntimeError('create_app(%r) failed:\n%s' % (config_name, process.stderr[-2000:]))
+    result = json.loads(process.stdout.strip().splitlines()[-1])
+    result['modules'] = parse_importtime(process.stderr.splitlines())
+    return result
@@ -0,0 +1,104 @@
+from sqlalchemy import or_
+from sqlalchemy.orm import aliased
+from sqlalchemy.orm.attributes import set_committed_value
+
+from MyBlog.counters import UNREAD_COMMENTS
+from MyBlog.extensions import db
+from MyBlog.models import Post, Comment, Counter, PATH_SEPARATOR, THREAD_MAX_DEPTH
+from MyBlog.search import search_index
+from MyBlog.signals import record_change
+
+# 评论回复树:Comment.path为物化路径,写入时由models.set_comment_path生成。
+# 文章页按顶层评论分页,再用一次路径范围查询取出这一页的全部回复;删除评论时按路径范围整棵子树一次删除
+
+
+def comment_threads(post_id, roots):
+    """roots为一页顶层评论,返回按回复树先序排列的评论列表,comment.depth为缩进层级"""
+    ranges = [Comment.descendants(root.path) for root in roots if root.path is not None]
+    replies = Comment.query.filter(Comment.post_id == post_id, or_(*ranges)).order_by(Comment.path).all() \
+        if ranges else []
+    by_id = dict((comment.id, comment) for comment in roots)
+    by_id.update((comment.id, comment) for comment in replies)
+    children = {}
+    for reply in replies:
+        # 被回复评论已在本次结果中,直接关联,模板访问comment.replied不再查询
+        if reply.replied_id in by_id:
+            set_committed_value(reply, 'replied', by_id[reply.replied_id])
+        children.setdefault(reply.path.split(PATH_SEPARATOR, 1)[0], []).append(reply)
+    comments = []
+    for root in roots:
+        comments.append(root)
+        if root.path is not None:
+            comments.extend(children.get(root.path, ()))
+    return comments
+
+
+def delete_thread(comment):
+    """删除评论及其全部回复,并在同一事务中更新评论数和未读数;返回删除的评论数"""
+    post_id = comment.post_id
+    if comment.path is not None and comment.depth < THREAD_MAX_DEPTH:
+        subtree = Comment.query.filter(Comment.post_id == post_id,
+                                       or_(Comment.id == comment.id, Comment.descendants(comment.path)))
+    else:
+        # 最深一层评论的回复与它并列存放,不在它的路径范围内,与没有路径的旧评论一样按replied_id逐层查找
+        subtree = Comment.query.filter(Comment.id.in_(_subtree_ids(comment.id)))
+    unread = db.func.sum(db.case([(Comment.reviewed == False, 1)], else_=0))  # noqa: E712
+    total, unread = subtree.with_entities(db.func.count(Comment.id), unread).one()
+    record_change(db.session, 'Comment', 'delete', {'id': comment.id, 'post_id': post_id})
+    subtree.delete(synchronize_session=False)
+    db.session.execute(Post.__table__.update().where(Post.id == post_id)
+                       .values(comment_count=Post.comment_count - total, updated=Post.updated))
+    if unread:
+        db.session.execute(Counter.__table__.update().where(Counter.name == UNREAD_COMMENTS)
+                           .values(value=Counter.value - unread))
+    search_index.update([post_id])
+    db.session.commit()
+    return total
+
+
+def _subtree_ids(comment_id):
+    # 逐层查找回复,每层一次查询
+    ids = [comment_id]
+    level = [comment_id]
+    while level:
+        level = [reply_id for reply_id, in db.session.query(Comment.id).filter(Comment.replied_id.in_(level))]
+        ids.extend(level)
+    return ids
+
+
+def rebuild_threads(full=False, batch_size=1000, progress=None):
+    """为没有路径的评论生成路径,full为True时全部重新生成;返回更新的评论数
+
+    每轮用一次连接查询找出父评论已有路径的评论,轮数等于回复树的最大深度。
+    """
+    if full:
+        db.session.execute(Comment.__table__.update().values(path=None, depth=0))
+    parent = aliased(Comment)
+    total = 0
+    while True:
+        rows = db.session.query(Comment.id, parent.path, parent.depth) \
+            .join(parent, Comment.replied_id == parent.id) \
+            .filter(Comment.path == None, parent.path != None).all()  # noqa: E711
+        if not rows:
+            # 剩余的是顶层评论、被回复评论已不存在的评论,以及(数据损坏时)互相回复成环的评论
+            rows = db.session.query(Comment.id, db.null(), db.null()) \
+                .outerjoin(parent, Comment.replied_id == parent.id) \
+                .filter(Comment.path == None, parent.id == None).all()  # noqa: E711
+        if not rows:
+            rows = db.session.query(Comment.id, db.null(), db.null()).filter(Comment.path == None) \
+                .order_by(Comment.id).limit(1).all()  # noqa: E711
+        if not rows:
+            break
+        for start in range(0, len(rows), batch_size):
+            values = []
+            for comment_id, parent_path, parent_depth in rows[start:start + batch_size]:
+                path, depth = Comment.child_path(parent_path, parent_depth, comment_id)
+                values.append(dict(_id=comment_id, _path=path, _depth=depth))
+            db.session.execute(Comment.__table__.update().where(Comment.id == db.bindparam('_id'))
+                               .values(path=db.bindparam('_path'), depth=db.bindparam('_depth')), values)
+            db.session.commit()
+            total += len(values)
+            if progress is not None:
+                progress(total)
+    db.session.commit()
+    return total
@@ -0,0 +1,199 @@
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app, url_for
+from markupsafe import Markup
+
+try:
+    from PIL import Image
+except ImportError:  # 未安装Pillow时只保存原图,不生成缩放图
+    Image = None
+
+# 图片上传:分块流式写入并计算sha256,按内容寻址保存为 uploads/ab/<hash>.<ext>,相同图片只存一份;
+# 缩放后的WebP图由后台线程池生成,文章正文中的<img>据此补充srcset
+
+CHUNK_SIZE = 64 * 1024
+
+# 文件头魔数 -> 扩展名,不信任客户端提供的文件名和Content-Type
+MAGIC = (
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'\xff\xd8\xff', 'jpg'),
+    (b'GIF87a', 'gif'),
+    (b'GIF89a', 'gif'),
+)
+
+
+class UploadError(ValueError):
+    pass
+
+
+def sniff(head):
+    for magic, extension in MAGIC:
+        if head.startswith(magic):
+            return extension
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'webp'
+    return None
+
+
+def save_image(stream):
+    """保存上传的图片,返回相对上传目录的路径;类型不符或超出大小限制时抛出UploadError"""
+    folder = current_app.config['MYBLOG_UPLOAD_PATH']
+    limit = current_app.config['MYBLOG_MAX_IMAGE_SIZE']
+    allowed = current_app.config['MYBLOG_ALLOWED_IMAGE_EXTENSIONS']
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    digest = hashlib.sha256()
+    size = 0
+    extension = None
+    # 临时文件与目标在同一目录,完成后原子改名
+    fd, temp_path = tempfile.mkstemp(dir=folder, suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            while True:
+                chunk = stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                if extension is None:
+                    extension = sniff(chunk)
+                    if extension is None or extension not in allowed:
+                        raise UploadError('Image only!')
+                size += len(chunk)
+                if size > limit:
+                    raise UploadError('Image too large (max %d MB)' % (limit // (1024 * 1024)))
+                digest.update(chunk)
+                f.write(chunk)
+        if extension is None:
+            raise UploadError('Empty file')
+        hexdigest = digest.hexdigest()
+        name = '%s/%s.%s' % (hexdigest[:2], hexdigest, extension)
+        path = os.path.join(folder, name)
+        if os.path.exists(path):  # 重复上传
+            os.remove(temp_path)
+        else:
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            os.replace(temp_path, path)
+            schedule_variants(current_app._get_current_object(), path)
+        return name
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor(workers):
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=workers)
+        return _executor
+
+
+def check_image_support(app):
+    """配置了MYBLOG_IMAGE_WIDTHS却没有安装Pillow时,启动时给出警告,而不是上传后才发现没有缩放图"""
+    if Image is None and app.config['MYBLOG_IMAGE_WIDTHS']:
+        app.logger.warning('MYBLOG_IMAGE_WIDTHS is set but Pillow is not installed; '
+                           'uploaded images will be served without resized variants')
+
+
+def schedule_variants(app, path):
+    if Image is None or not app.config['MYBLOG_IMAGE_WIDTHS'] or path.endswith('.gif'):
+        return None  # GIF可能是动图,保持原样
+    future = _get_executor(app.config['MYBLOG_IMAGE_WORKERS']).submit(
+        make_variants, path, app.config['MYBLOG_IMAGE_WIDTHS'], app.config['MYBLOG_IMAGE_QUALITY'])
+
+    def report(future):
+        # 没有人等待这个Future,Pillow的异常必须在这里记录,否则会静默消失(页面只是没有srcset)
+        error = None if future.cancelled() else future.exception()
+        if error is not None:
+            app.logger.exception('cannot create image variants for %s', path, exc_info=error)
+    future.add_done_callback(report)
+    return future
+
+
+def make_variants(path, widths, quality=80):
+    """生成各宽度的WebP图,并把原图宽度和已生成的宽度写入同名.json,供srcset使用"""
+    base = os.path.splitext(path)[0]
+    with Image.open(path) as image:
+        width, height = image.size
+        image = image.convert('RGBA' if image.mode in ('RGBA', 'LA', 'P') else 'RGB')
+        done = []
+        for target in sorted(widths):
+            if target >= width:
+                break
+            variant = image.resize((target, max(1, height * target // width)), Image.LANCZOS)
+            variant.save('%s-%dw.webp' % (base, target), 'WEBP', quality=quality)
+            done.append(target)
+    info_path = base + '.json'
+    with open(info_path + '.part', 'w') as f:
+        json.dump(dict(width=width, widths=done), f)
+    os.replace(info_path + '.part', info_path)
+    return done
+
+
+_hashed_name = re.compile(r'^[0-9a-f]{2}/[0-9a-f]{64}(-\d+w)?\.\w+$')
+
+
+def is_hashed_name(name):
+    return _hashed_name.match(name) is not None
+
+
+_info_cache = {}
+
+
+def image_info(name):
+    """读取缩放图信息;尚未生成时返回None且不缓存,生成完成后自然生效"""
+    info = _info_cache.get(name)
+    if info is None:
+        try:
+            with open(os.path.join(current_app.config['MYBLOG_UPLOAD_PATH'],
+                                   os.path.splitext(name)[0] + '.json')) as f:
+                info = _info_cache[name] = json.load(f)
+        except (IOError, ValueError):
+            return None
+    return info
+
+
+_img = re.compile(r'<img\b[^>]*>', re.IGNORECASE)
+_src = re.compile(r'''\ssrc=(["'])([^"']+)\1''', re.IGNORECASE)
+_hashed = re.compile(r'/([0-9a-f]{2}/[0-9a-f]{64}\.\w+)$')
+
+
+def responsive_images(html):
+    """Jinja过滤器:给指向已上传图片的<img>补充srcset/sizes,并延迟加载"""
+    if not html or '<img' not in html:
+        return Markup(html or '')
+    prefix = url_for('admin.get_image', filename='_')[:-1]
+
+    def replace(match):
+        tag = match.group(0)
+        src = _src.search(tag)
+        if src is None or 'srcset=' in tag:
+            return tag
+        url = src.group(2)
+        hashed = _hashed.search(url)
+        attributes = ''
+        if 'loading=' not in tag:
+            attributes += ' loading="lazy"'
+        info = image_info(hashed.group(1)) if hashed and url.startswith(prefix) else None
+        if info and info['widths']:
+            base = url.rsplit('.', 1)[0]
+            candidates = ['%s-%dw.webp %dw' % (base, width, width) for width in info['widths']]
+            candidates.append('%s %dw' % (url, info['width']))
+            attributes += ' srcset="%s" sizes="%s"' % (', '.join(candidates),
+                                                       current_app.config['MYBLOG_IMAGE_SIZES'])
+        if not attributes:
+            return tag
+        return tag[:src.end()] + attributes + tag[src.end():]
+
+    return Markup(_img.sub(replace, html))
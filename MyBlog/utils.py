@@ -1,4 +1,12 @@
-from flask import redirect, request, url_for, current_app
+import hashlib
+import re
+import time
+from functools import wraps
+from html.parser import HTMLParser
+
+from flask import redirect, request, url_for, current_app, make_response, session, g
+from flask_login import current_user
+from werkzeug.http import is_resource_modified
 
 try:
     from urlparse import urlparse, urljoin
@@ -25,7 +33,139 @@ def redirect_back(default='blog.index', **kwargs):
     return redirect(url_for(default, **kwargs))
 
 
+# 从CKEditor生成的HTML中提取纯文本
+class _TextExtractor(HTMLParser):
+    block_tags = {'p', 'br', 'div', 'li', 'ul', 'ol', 'tr', 'td', 'th', 'blockquote', 'pre',
+                  'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'hr', 'img', 'figure', 'figcaption'}
+    skip_tags = {'script', 'style'}
+
+    def __init__(self):
+        super(_TextExtractor, self).__init__(convert_charrefs=True)
+        self.parts = []
+        self.skipping = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.skip_tags:
+            self.skipping += 1
+        elif tag in self.block_tags:
+            self.parts.append(' ')
+
+    def handle_endtag(self, tag):
+        if tag in self.skip_tags:
+            self.skipping = max(self.skipping - 1, 0)
+        elif tag in self.block_tags:
+            self.parts.append(' ')
+
+    def handle_data(self, data):
+        if not self.skipping:
+            self.parts.append(data)
+
+
+def html_to_text(html):
+    parser = _TextExtractor()
+    parser.feed(html or '')
+    parser.close()
+    return ' '.join(''.join(parser.parts).split())
+
+
+_cjk = re.compile(r'[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af]')
+_word = re.compile(r"[^\W_]+(?:['’-][^\W_]+)*")
+
+EXCERPT_LENGTH = 300    # 摘要字符数
+READING_SPEED = 300     # 每分钟阅读字数
+
+
+# 字数统计:中日韩文字每字计一个,其余按单词计
+def count_words(text):
+    cjk = len(_cjk.findall(text))
+    return cjk + len(_word.findall(_cjk.sub(' ', text)))
+
+
+# 截取摘要,英文尽量在单词边界处截断
+def make_excerpt(text, length=EXCERPT_LENGTH):
+    if len(text) <= length:
+        return text
+    cut = text[:length]
+    space = cut.rfind(' ')
+    if space > length - 20:
+        cut = cut[:space]
+    return cut.rstrip() + '…'
+
+
+# 文章保存时生成(摘要, 字数, 阅读分钟数)
+def summarize_html(html):
+    text = html_to_text(html)
+    words = count_words(text)
+    return make_excerpt(text), words, max(1, -(-words // READING_SPEED))
+
+
 # 给允许上传的文件加上“.”
 def allowed_file(filename):
     return '.' in filename and \
-           filename.rsplit('.', 1)[1].lower() in current_app.config['MYBLOG_ALLOWED_IMAGE_EXTENSIONS']
\ No newline at end of file
+           filename.rsplit('.', 1)[1].lower() in current_app.config['MYBLOG_ALLOWED_IMAGE_EXTENSIONS']
+
+
+# 生成强ETag,parts为决定页面内容的各项数据
+def make_etag(*parts):
+    return hashlib.sha1('|'.join(str(part) for part in parts).encode('utf-8')).hexdigest()
+
+
+# CSRF令牌有效期内的时间段编号,页面含表单时计入ETag,避免浏览器长期复用带过期令牌的页面
+def csrf_epoch():
+    limit = current_app.config.get('WTF_CSRF_TIME_LIMIT', 3600)
+    return int(time.time() // (limit // 2)) if limit else 0
+
+
+# 带闪现消息或有待发布评论(见commentqueue)的会话看到的页面因人而异,不使用页面缓存和条件请求
+def personalized():
+    return bool(session.get('_flashes') or session.get('myblog_pending_comments'))
+
+
+# flask freeze生成静态页面时的请求(见freeze模块),WSGI环境变量无法由HTTP客户端设置
+FREEZE_ENVIRON_KEY = 'myblog.freeze'
+
+
+def freezing():
+    return bool(request.environ.get(FREEZE_ENVIRON_KEY))
+
+
+def conditional(validator, private=False):
+    """条件请求装饰器
+
+    validator接收视图参数,以轻量查询返回(etag, last_modified),记录不存在时返回None交给视图处理。
+    客户端缓存仍有效时直接返回304,不执行视图也不渲染模板。
+    页面缓存中已有该页面时使用随页面缓存的验证器,不再执行validator。
+    private为True表示页面含有与会话绑定的CSRF令牌,200和304响应都不允许共享缓存保存。
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            # 登录用户和带闪现消息的页面内容因人而异,不参与条件请求
+            if request.method != 'GET' or personalized() or current_user.is_authenticated:
+                return f(*args, **kwargs)
+            from MyBlog.extensions import page_cache  # caching模块导入了本模块
+
+            entry = page_cache.lookup()
+            validators = entry.get('validators') if entry is not None else None
+            if validators is None or validators[2] != csrf_epoch():
+                validators = validator(**kwargs)
+                if validators is None:
+                    return f(*args, **kwargs)
+                validators = g.myblog_validators = tuple(validators) + (csrf_epoch(),)
+            etag, last_modified, _ = validators
+            etag = make_etag(etag, request.full_path)
+            if not is_resource_modified(request.environ, etag, last_modified=last_modified):
+                response = current_app.response_class(status=304)
+            else:
+                response = make_response(f(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag)
+            response.last_modified = last_modified
+            # 304与它所代替的200响应使用相同的Cache-Control
+            response.cache_control.no_cache = True
+            if private:
+                response.cache_control.private = True
+            return response
+        return decorated_function
+    return decorator
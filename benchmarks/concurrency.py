@@ -0,0 +1,142 @@
+"""并发基准:多个读进程请求首页和文章页,同时有写进程不断提交评论,比较不同数据库配置下的读吞吐
+
+每个配置从同一份数据的副本开始,读写进程各自创建应用,相当于多个gunicorn worker:
+
+    stock       默认设置(回滚日志、每次请求新建连接)
+    tuned       ProductionConfig的连接池与PRAGMA(WAL、synchronous=NORMAL、busy_timeout等)
+    tuned+read  在tuned基础上,匿名GET请求使用单独的只读连接
+
+    $ python benchmarks/concurrency.py --readers 4 --writers 2 --duration 10
+"""
+import argparse
+import copy
+import math
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import warnings
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from MyBlog import create_app  # noqa: E402
+from MyBlog.extensions import db  # noqa: E402
+from MyBlog.settings import config, TestConfig, ProductionConfig  # noqa: E402
+
+
+class ConcurrencyConfig(TestConfig):
+    WTF_CSRF_ENABLED = False
+    MYBLOG_PAGE_CACHE = None  # 测量数据库访问,不使用页面缓存
+    MYBLOG_QUERY_BUDGETS = {}
+    MYBLOG_SLOW_REQUEST_MS = None
+
+
+PROFILES = ('stock', 'tuned', 'tuned+read')
+
+
+def make_app(profile, database):
+    uri = 'sqlite:///' + database
+    overrides = dict(SQLALCHEMY_DATABASE_URI=uri)
+    if profile != 'stock':
+        overrides.update(SQLALCHEMY_ENGINE_OPTIONS=copy.deepcopy(ProductionConfig.SQLALCHEMY_ENGINE_OPTIONS),
+                         MYBLOG_SQLITE_PRAGMAS=dict(ProductionConfig.MYBLOG_SQLITE_PRAGMAS))
+    if profile == 'tuned+read':
+        overrides['MYBLOG_READ_DATABASE_URI'] = uri
+    config['concurrency'] = type('ProfileConfig', (ConcurrencyConfig,), overrides)
+    return create_app('concurrency')
+
+
+def worker(role, profile, database, post_ids, duration, seed, results):
+    warnings.simplefilter('ignore')
+    app = make_app(profile, database)
+    client = app.test_client()
+    rng = random.Random(seed)
+    timings = []
+    errors = 0
+    deadline = time.time() + duration
+    while time.time() < deadline:
+        post_id = rng.choice(post_ids)
+        start = time.perf_counter()
+        try:
+            if role == 'reader':
+                response = client.get('/post/%d' % post_id if rng.random() < 0.7 else '/')
+                ok = response.status_code == 200
+            else:
+                response = client.post('/post/%d' % post_id, data=dict(name='bench', comment='x' * 200))
+                ok = response.status_code == 302
+        except Exception:  # 多为database is locked
+            ok = False
+        if ok:
+            timings.append((time.perf_counter() - start) * 1000)
+        else:
+            errors += 1
+    results.put((role, timings, errors))
+
+
+def percentile(values, fraction):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(math.ceil(fraction * len(values))) - 1)]
+
+
+def run_profile(profile, pristine, folder, post_ids, args):
+    database = os.path.join(folder, '%s.db' % profile.replace('+', '_'))
+    shutil.copy(pristine, database)
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    processes = [context.Process(target=worker, args=(role, profile, database, post_ids, args.duration,
+                                                      args.seed + index, results))
+                 for index, role in enumerate(['reader'] * args.readers + ['writer'] * args.writers)]
+    for process in processes:
+        process.start()
+    collected = dict(reader=([], 0), writer=([], 0))
+    for _ in processes:
+        role, timings, errors = results.get(timeout=args.duration + 120)  # 子进程启动失败时不会一直等待
+        collected[role] = (collected[role][0] + timings, collected[role][1] + errors)
+    for process in processes:
+        process.join()
+    row = dict(profile=profile)
+    for role, (timings, errors) in collected.items():
+        row[role] = dict(per_second=len(timings) / args.duration, p50=percentile(timings, 0.5),
+                         p95=percentile(timings, 0.95), errors=errors)
+    return row
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--post', type=int, default=500)
+    parser.add_argument('--comment', type=int, default=5000)
+    parser.add_argument('--readers', type=int, default=4)
+    parser.add_argument('--writers', type=int, default=2)
+    parser.add_argument('--duration', type=float, default=10, help='每个配置运行的秒数')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--profile', action='append', choices=PROFILES, help='只运行指定配置,可重复')
+    args = parser.parse_args()
+
+    folder = tempfile.mkdtemp()
+    pristine = os.path.join(folder, 'pristine.db')
+    app = make_app('stock', pristine)
+    with app.app_context():
+        app.test_cli_runner().invoke(args=['forge', '--post', str(args.post), '--comment', str(args.comment),
+                                           '--seed', str(args.seed)])
+        post_ids = [post_id for post_id, in db.session.execute('SELECT id FROM post')]
+        db.session.remove()
+        db.engine.dispose()
+
+    print('%-12s %10s %9s %9s %7s %10s %9s %9s %7s' % (
+        'profile', 'reads/s', 'p50 ms', 'p95 ms', 'errors', 'writes/s', 'p50 ms', 'p95 ms', 'errors'))
+    for profile in args.profile or PROFILES:
+        row = run_profile(profile, pristine, folder, post_ids, args)
+        reader, writer = row['reader'], row['writer']
+        print('%-12s %10.1f %9.2f %9.2f %7d %10.1f %9.2f %9.2f %7d' % (
+            profile, reader['per_second'], reader['p50'], reader['p95'], reader['errors'],
+            writer['per_second'], writer['p50'], writer['p95'], writer['errors']))
+    shutil.rmtree(folder, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
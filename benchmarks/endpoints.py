@@ -0,0 +1,336 @@
+"""端点基准:用forge生成数据,通过测试客户端请求blog、admin、login蓝本的全部路由
+
+记录每个场景的p50/p95延迟、SQL语句数和响应字节数并写入JSON;
+指定--baseline时与之前保存的结果比较,超出预算的场景使运行以非零状态退出。
+
+    $ python benchmarks/endpoints.py --post 2000 --comment 20000 --output benchmarks/baseline.json
+    $ python benchmarks/endpoints.py --post 2000 --comment 20000 --baseline benchmarks/baseline.json
+"""
+import argparse
+import io
+import json
+import math
+import os
+import platform
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import request_finished  # noqa: E402
+from flask_sqlalchemy import get_debug_queries  # noqa: E402
+
+from MyBlog import create_app  # noqa: E402
+from MyBlog.counters import recompute_counters  # noqa: E402
+from MyBlog.extensions import db  # noqa: E402
+from MyBlog.models import Post, Category, Comment  # noqa: E402
+from MyBlog.queries import QueryBudgetExceeded  # noqa: E402
+from MyBlog.settings import config, TestConfig  # noqa: E402
+
+# 1x1透明GIF,用于上传场景
+GIF = b'GIF89a\x01\x00\x01\x00\x80\x00\x00\x00\x00\x00\xff\xff\xff!\xf9\x04\x01\x00\x00\x00\x00' \
+      b',\x00\x00\x00\x00\x01\x00\x01\x00\x00\x02\x02D\x01\x00;'
+
+
+class BenchmarkConfig(TestConfig):
+    WTF_CSRF_ENABLED = False
+    MYBLOG_PAGE_CACHE = None  # 默认测量完整渲染,--page-cache可开启
+    MYBLOG_QUERY_BUDGET_STRICT = True  # 超出settings中的语句数预算时请求直接失败
+
+
+class Scenario(object):
+
+    def __init__(self, name, url, method='GET', data=None, client='anon', setup=None, status=(200,), after=None):
+        self.name = name
+        self.url = url  # 字符串,或接收迭代序号返回URL的函数
+        self.method = method
+        self.data = data  # 表单数据,或接收迭代序号返回表单的函数
+        self.client = client  # 'anon'、'admin'或'session'(每次迭代前由setup登录)
+        self.setup = setup
+        self.status = status
+        self.after = after  # 接收成功的响应,供后续场景使用响应内容
+
+    def request(self, client, i):
+        if self.setup is not None:
+            self.setup(client, i)
+        url = self.url(i) if callable(self.url) else self.url
+        data = self.data(i) if callable(self.data) else self.data
+        start = time.perf_counter()
+        response = client.open(url, method=self.method, data=data)
+        elapsed = (time.perf_counter() - start) * 1000
+        return response, elapsed
+
+
+def build_dataset(app, args):
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=['forge', '--category', str(args.category), '--post', str(args.post),
+                                 '--comment', str(args.comment), '--seed', str(args.seed),
+                                 '--batch-size', str(args.batch_size)])
+    if result.exception is not None:
+        raise result.exception
+    # 长评论串:集中到一篇文章上,测试评论深分页
+    post_id = db.session.query(Post.id).order_by(Post.id).first()[0]
+    first_id = db.session.query(db.func.max(Comment.id)).scalar() + 1
+    now = datetime.utcnow()
+    db.session.execute(Comment.__table__.insert(), [
+        dict(id=first_id + i, author='reader %d' % i, body='long thread comment %d' % i, post_id=post_id,
+             reviewed=True, from_admin=False, replied_id=first_id + i - 1 if i else None,
+             timestamp=now - timedelta(seconds=args.thread - i))
+        for i in range(args.thread)])
+    db.session.commit()
+    recompute_counters()
+    return post_id
+
+
+def make_scenarios(app, args, thread_post_id):
+    total = args.iterations + args.warmup
+    post_ids = [post_id for post_id, in db.session.query(Post.id).order_by(Post.id)]
+    category_id = db.session.query(Category.id).filter(Category.id != 1).order_by(Category.id).first()[0]
+    unread_ids = [comment_id for comment_id, in db.session.query(Comment.id).filter_by(reviewed=False)
+                  .order_by(Comment.id).limit(total)] or [1]
+    # 删除类场景使用最后几篇文章和评论,避免影响其他场景
+    doomed_posts = post_ids[-total:]
+    doomed_comments = [comment_id for comment_id, in db.session.query(Comment.id)
+                       .filter(Comment.post_id.notin_(doomed_posts + [thread_post_id]))
+                       .order_by(Comment.id.desc()).limit(total)]
+    post_id = post_ids[1]
+    thread_pages = int(math.ceil(args.thread / float(app.config['MYBLOG_COMMENT_PER_PAGE'])))
+
+    def last_page(query, per_page):
+        # 删除类场景会改变总数,末页在请求前(计时之外)重新计算
+        def url(i):
+            with app.app_context():
+                return max(1, int(math.ceil(query().count() / float(app.config[per_page]))))
+        return url
+
+    post_pages = last_page(lambda: Post.query, 'MYBLOG_POST_PER_PAGE')
+    manage_pages = last_page(lambda: Post.query, 'MYBLOG_MANAGE_POST_PER_PAGE')
+    comment_pages = last_page(lambda: Comment.query, 'MYBLOG_MANAGE_COMMENT_PER_PAGE')
+
+    def category_named(i):  # 由new_category post场景创建
+        with app.app_context():
+            return db.session.query(Category.id).filter_by(name='bench-%d' % i).scalar()
+
+    def login(client, i):
+        client.post('/auth/login', data=dict(username='xixi1216', password='helloflask'))
+
+    # 上传的文件按内容命名,get_image使用upload_image场景返回的URL
+    uploaded = {}
+
+    def upload_form(i):
+        return dict(upload=(io.BytesIO(GIF), 'bench.gif'))
+
+    def remember_upload(response):
+        uploaded['url'] = response.get_json()['url']
+
+    def ensure_upload(client, i):  # 用--only单独运行get_image时先上传一次
+        if 'url' not in uploaded:
+            response = client.post('/admin/upload', data=upload_form(i))
+            remember_upload(response)
+            response.close()
+
+    return [
+        # blog
+        Scenario('blog.index', '/'),
+        Scenario('blog.index deep', lambda i: '/?page=%d' % post_pages(i)),
+        Scenario('blog.show_category', '/category/%d' % category_id),
+        Scenario('blog.show_post', '/post/%d' % post_id),
+        Scenario('blog.show_post long thread', '/post/%d' % thread_post_id),
+        Scenario('blog.show_post deep thread', '/post/%d?page=%d' % (thread_post_id, thread_pages)),
+        Scenario('blog.show_post comment', '/post/%d' % post_id, 'POST',
+                 lambda i: dict(name='bench', comment='comment %d' % i), status=(302,)),
+        Scenario('blog.reply_comment', lambda i: '/reply/comment/%d' % unread_ids[i % len(unread_ids)],
+                 status=(302,)),
+        Scenario('blog.search', '/search?q=the'),
+        # feed
+        Scenario('feed.atom_feed', '/feed.atom'),
+        Scenario('feed.rss_feed', '/feed.rss'),
+        Scenario('feed.category_atom', '/category/%d/feed.atom' % category_id),
+        Scenario('feed.sitemap_xml', '/sitemap.xml'),
+        # login
+        Scenario('login.login', '/auth/login'),
+        Scenario('login.login post', '/auth/login', 'POST', dict(username='xixi1216', password='helloflask'),
+                 client='session', setup=lambda client, i: client.get('/auth/logout'), status=(302,)),
+        Scenario('login.logout', '/auth/logout', client='session', setup=login, status=(302,)),
+        # admin
+        Scenario('blog.index admin', '/', client='admin'),
+        Scenario('blog.show_post admin', '/post/%d' % post_id, client='admin'),
+        Scenario('admin.settings', '/admin/setting', client='admin'),
+        Scenario('admin.settings post', '/admin/setting', 'POST',
+                 dict(blog_title="授我以驴'blog", name='一头特立独行的猪', about='benchmark'),
+                 client='admin', status=(302,)),
+        Scenario('admin.new_post', '/admin/post/new', client='admin'),
+        Scenario('admin.new_post post', '/admin/post/new', 'POST',
+                 lambda i: dict(title='bench %d' % i, category=category_id, body='<p>benchmark post %d</p>' % i),
+                 client='admin', status=(302,)),
+        Scenario('admin.edit_post', '/admin/post/%d/edit' % post_id, client='admin'),
+        Scenario('admin.edit_post post', '/admin/post/%d/edit' % post_id, 'POST',
+                 lambda i: dict(title='edited %d' % i, category=category_id, body='<p>edited %d</p>' % i),
+                 client='admin', status=(302,)),
+        Scenario('admin.delete_post', lambda i: '/admin/post/%d/delete' % doomed_posts[i], 'POST',
+                 client='admin', status=(302,)),
+        Scenario('admin.manage_post', '/admin/post/manage', client='admin'),
+        Scenario('admin.manage_post deep', lambda i: '/admin/post/manage?page=%d' % manage_pages(i),
+                 client='admin'),
+        Scenario('admin.new_category', '/admin/category/new', client='admin'),
+        Scenario('admin.new_category post', '/admin/category/new', 'POST', lambda i: dict(name='bench-%d' % i),
+                 client='admin', status=(302,)),
+        Scenario('admin.manage_category', '/admin/category/manage', client='admin'),
+        Scenario('admin.edit_category', '/admin/category/%d/edit' % category_id, client='admin'),
+        Scenario('admin.delete_category', lambda i: '/admin/category/%d/delete' % category_named(i), 'POST',
+                 client='admin', status=(302,)),
+        Scenario('admin.manage_comments', '/admin/comment/manages', client='admin'),
+        Scenario('admin.manage_comments unread', '/admin/comment/manages?filter=unread', client='admin'),
+        Scenario('admin.manage_comments admin', '/admin/comment/manages?filter=admin', client='admin'),
+        Scenario('admin.manage_comments deep', lambda i: '/admin/comment/manages?page=%d' % comment_pages(i),
+                 client='admin'),
+        Scenario('admin.set_comment', '/admin/set-comment/%d' % post_id, 'POST', client='admin', status=(302,)),
+        Scenario('admin.approve_comments',
+                 lambda i: '/admin/comment/%d/approve' % unread_ids[i % len(unread_ids)], 'POST',
+                 client='admin', status=(302,)),
+        Scenario('admin.delete_comments', lambda i: '/admin/comment/%d/delete' % doomed_comments[i],
+                 client='admin', status=(302,)),
+        Scenario('admin.upload_image', '/admin/upload', 'POST', upload_form, client='admin', after=remember_upload),
+        Scenario('admin.get_image', lambda i: uploaded['url'], client='admin', setup=ensure_upload),
+    ]
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(math.ceil(fraction * len(values))) - 1)]
+
+
+def run(app, scenarios, args):
+    clients = dict(anon=app.test_client(), admin=app.test_client(), session=app.test_client())
+    clients['admin'].post('/auth/login', data=dict(username='xixi1216', password='helloflask'))
+
+    recorded = []
+
+    def record_queries(sender, response, **extra):
+        recorded.append(len(get_debug_queries()))
+    request_finished.connect(record_queries, app)
+
+    results = {}
+    i = 0
+    for scenario in scenarios:
+        client = clients[scenario.client]
+        timings, queries, sizes, errors = [], [], [], []
+        for i in range(args.warmup + args.iterations):
+            del recorded[:]
+            try:
+                response, elapsed = scenario.request(client, i)
+            except QueryBudgetExceeded as e:
+                if i >= args.warmup:  # 预算以缓存已预热计,预热请求超出不算失败
+                    errors.append(str(e).splitlines()[0].rstrip(':'))
+                continue
+            # 每个响应都读完并关闭(包括预热和出错的请求),流式响应保留的请求上下文随之弹出
+            size = len(response.get_data())
+            response.close()
+            if response.status_code not in scenario.status:
+                errors.append('status %d' % response.status_code)
+                continue
+            if scenario.after is not None:
+                scenario.after(response)
+            if i < args.warmup:  # 预热:填充站点缓存、编译模板
+                continue
+            timings.append(elapsed)
+            queries.append(recorded[-1] if recorded else 0)
+            sizes.append(size)
+        result = dict(method=scenario.method, client=scenario.client, errors=sorted(set(errors)))
+        if timings:
+            result.update(n=len(timings), p50_ms=round(percentile(timings, 0.5), 3),
+                          p95_ms=round(percentile(timings, 0.95), 3), queries=max(queries), bytes=max(sizes))
+        results[scenario.name] = result
+        print('%-34s %8s %8s %4s %8s %s' % (
+            scenario.name, result.get('p50_ms', '-'), result.get('p95_ms', '-'), result.get('queries', '-'),
+            result.get('bytes', '-'), '; '.join(result['errors'])))
+    return results
+
+
+def compare(results, baseline, args):
+    """返回超出预算的问题列表:语句数不得增加,p95与字节数按倍数和余量放宽"""
+    problems = []
+    for name, result in sorted(results.items()):
+        if result['errors']:
+            problems.append('%s: %s' % (name, '; '.join(result['errors'])))
+        old = baseline.get(name)
+        if old is None or 'p95_ms' not in old or 'p95_ms' not in result:
+            continue
+        if result['queries'] > old['queries'] + args.query_slack:
+            problems.append('%s: %d queries (baseline %d)' % (name, result['queries'], old['queries']))
+        limit = old['p95_ms'] * args.latency_factor + args.latency_slack
+        if result['p95_ms'] > limit:
+            problems.append('%s: p95 %.2f ms (baseline %.2f ms, limit %.2f ms)' % (
+                name, result['p95_ms'], old['p95_ms'], limit))
+        if result['bytes'] > old['bytes'] * args.bytes_factor:
+            problems.append('%s: %d bytes (baseline %d)' % (name, result['bytes'], old['bytes']))
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--category', type=int, default=10)
+    parser.add_argument('--post', type=int, default=1000)
+    parser.add_argument('--comment', type=int, default=10000)
+    parser.add_argument('--thread', type=int, default=500, help='长评论串的评论数')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--batch-size', type=int, default=5000)
+    parser.add_argument('--database', help='SQLite文件路径,默认使用临时文件;":memory:"为内存数据库')
+    parser.add_argument('--page-cache', choices=['memory', 'sqlite'], help='开启匿名页面缓存')
+    parser.add_argument('--keyset', action='store_true', help='开启游标分页')
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--only', help='只运行名称包含该字符串的场景')
+    parser.add_argument('--output', default='benchmarks/results.json')
+    parser.add_argument('--baseline', help='与之比较的基准JSON')
+    parser.add_argument('--latency-factor', type=float, default=1.5, help='允许的p95倍数')
+    parser.add_argument('--latency-slack', type=float, default=2.0, help='允许的p95余量(毫秒)')
+    parser.add_argument('--bytes-factor', type=float, default=1.1, help='允许的响应大小倍数')
+    parser.add_argument('--query-slack', type=int, default=0, help='允许增加的SQL语句数')
+    args = parser.parse_args()
+
+    folder = tempfile.mkdtemp()
+    database = args.database or os.path.join(folder, 'benchmark.db')
+    BenchmarkConfig.SQLALCHEMY_DATABASE_URI = 'sqlite://' if database == ':memory:' else 'sqlite:///' + database
+    BenchmarkConfig.MYBLOG_UPLOAD_PATH = os.path.join(folder, 'uploads')
+    BenchmarkConfig.MYBLOG_PAGE_CACHE_PATH = os.path.join(folder, 'pages.db')
+    BenchmarkConfig.MYBLOG_PAGE_CACHE = args.page_cache
+    BenchmarkConfig.MYBLOG_KEYSET_PAGINATION = args.keyset
+    config['benchmark'] = BenchmarkConfig
+    app = create_app('benchmark')
+
+    with app.app_context():
+        start = time.time()
+        thread_post_id = build_dataset(app, args)
+        print('dataset: %d posts, %d comments in %.1fs' % (
+            Post.query.count(), Comment.query.count(), time.time() - start))
+        scenarios = make_scenarios(app, args, thread_post_id)
+    if args.only:
+        scenarios = [scenario for scenario in scenarios if args.only in scenario.name]
+
+    print('%-34s %8s %8s %4s %8s' % ('scenario', 'p50 ms', 'p95 ms', 'sql', 'bytes'))
+    results = run(app, scenarios, args)
+
+    with open(args.output, 'w') as f:
+        json.dump(dict(meta=dict(python=platform.python_version(), post=args.post, comment=args.comment,
+                                 thread=args.thread, seed=args.seed, page_cache=args.page_cache,
+                                 keyset=args.keyset, iterations=args.iterations, time=time.time()),
+                       results=results), f, indent=2, sort_keys=True, ensure_ascii=False)
+    print('results written to %s' % args.output)
+
+    problems = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            problems = compare(results, json.load(f)['results'], args)
+    else:
+        problems = ['%s: %s' % (name, '; '.join(result['errors']))
+                    for name, result in sorted(results.items()) if result['errors']]
+    for problem in problems:
+        print('FAIL ' + problem)
+    return 1 if problems else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
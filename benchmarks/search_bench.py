@@ -0,0 +1,85 @@
+"""全文搜索基准:比较FTS5、纯Python倒排索引与LIKE '%词%'全表扫描
+
+    $ python benchmarks/search_bench.py --post 2000 --comment 6000 --repeat 20
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from MyBlog import create_app  # noqa: E402
+from MyBlog.extensions import db  # noqa: E402
+from MyBlog.fakes import fake_admin, fake_category, fake_post, fake_comment  # noqa: E402
+from MyBlog.models import Post  # noqa: E402
+from MyBlog.search import FTS5Backend, InvertedIndex, tokenize  # noqa: E402
+
+
+def like_search(terms, limit):
+    query = Post.query.with_entities(Post.id)
+    for term in terms:
+        pattern = '%' + term + '%'
+        query = query.filter(db.or_(Post.title.like(pattern), Post.body.like(pattern)))
+    return query.order_by(Post.timestamp.desc()).limit(limit).all()
+
+
+def measure(function, queries, repeat):
+    timings = []
+    hits = 0
+    for _ in range(repeat):
+        for terms in queries:
+            start = time.perf_counter()
+            hits = len(function(terms))
+            timings.append((time.perf_counter() - start) * 1000)
+            db.session.rollback()  # 每次查询使用新事务,与请求处理一致
+    timings.sort()
+    return statistics.median(timings), timings[int(len(timings) * 0.95) - 1], hits
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--post', type=int, default=1000)
+    parser.add_argument('--comment', type=int, default=3000)
+    parser.add_argument('--queries', type=int, default=10)
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--limit', type=int, default=10)
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), 'search_bench.db')
+    app = create_app('test')
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + path
+    app.config['MYBLOG_QUERY_BUDGETS'] = {}
+    random.seed(0)
+    with app.app_context():
+        db.create_all()
+        fake_admin()
+        fake_category(5)
+        fake_post(args.post)
+        fake_comment(args.comment)
+
+        words = [token for post in Post.query.limit(200) for token in tokenize(post.title) if len(token) > 3]
+        queries = [[word] for word in random.sample(words, args.queries)]
+        print('%d posts, %d comments, queries: %s' % (args.post, args.comment, ' '.join(q[0] for q in queries)))
+
+        fts5 = FTS5Backend(with_comments=True)
+        inverted = InvertedIndex(with_comments=True)
+        for name, backend in (('fts5', fts5), ('python', inverted)):
+            start = time.perf_counter()
+            backend.rebuild(db.session.connection(), 1000)
+            db.session.commit()
+            print('%-8s index built in %.0f ms' % (name, (time.perf_counter() - start) * 1000))
+
+        print('%-8s %10s %10s %6s' % ('backend', 'p50 ms', 'p95 ms', 'hits'))
+        for name, function in (('fts5', lambda terms: fts5.search(terms, None, args.limit)),
+                               ('python', lambda terms: inverted.search(terms, None, args.limit)),
+                               ('like', lambda terms: like_search(terms, args.limit))):
+            p50, p95, hits = measure(function, queries, args.repeat)
+            print('%-8s %10.2f %10.2f %6d' % (name, p50, p95, hits))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+import pytest
+from sqlalchemy import event
+
+from MyBlog import create_app, settings
+from MyBlog.extensions import db
+from MyBlog.models import Post, Category
+
+# 按MYBLOG_QUERY_BUDGETS逐个请求端点,以管理员登录、缓存预热后的第二次请求计算SQL语句数
+
+URLS = {
+    'blog.index': '/',
+    'blog.show_category': '/category/{category_id}',
+    'blog.show_post': '/post/{post_id}',
+    'feed.atom_feed': '/feed.atom',
+    'feed.sitemap_xml': '/sitemap.xml',
+    'login.login': '/auth/login',
+    'admin.manage_post': '/admin/post/manage',
+    'admin.manage_category': '/admin/category/manage',
+    'admin.manage_comments': '/admin/comment/manages',
+    'admin.settings': '/admin/setting',
+    'admin.edit_post': '/admin/post/{post_id}/edit',
+}
+ANONYMOUS = {'login.login'}     # 已登录时登录页直接重定向
+
+
+class QueryBudgetConfig(settings.TestConfig):
+    SQLALCHEMY_RECORD_QUERIES = True
+    MYBLOG_QUERY_BUDGET_STRICT = True
+    MYBLOG_PAGE_CACHE = None    # 管理员请求本来就不使用页面缓存
+    WTF_CSRF_ENABLED = False
+
+
+@pytest.fixture(scope='module')
+def app(tmp_path_factory):
+    # 模块级fixture不能使用monkeypatch,改用MonkeyPatch.context(),测试结束后恢复settings.config和测试配置类
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setattr(QueryBudgetConfig, 'SQLALCHEMY_DATABASE_URI',
+                      'sqlite:///%s' % tmp_path_factory.mktemp('db').joinpath('test.db'))
+        patch.setitem(settings.config, 'query_budget', QueryBudgetConfig)
+        app = create_app('query_budget')
+    with app.app_context():
+        result = app.test_cli_runner().invoke(args=['forge', '--category', '3', '--post', '20',
+                                                    '--comment', '100', '--seed', '1'])
+        assert result.exit_code == 0, result.output
+        values = dict(post_id=db.session.query(db.func.max(Post.id)).scalar(),
+                      category_id=db.session.query(db.func.max(Category.id)).scalar())
+    app.config['TEST_URL_VALUES'] = values
+    return app
+
+
+@pytest.fixture(scope='module')
+def clients(app):
+    admin = app.test_client()
+    response = admin.post('/auth/login', data=dict(username='xixi1216', password='helloflask'))
+    assert response.status_code == 302
+    return dict(admin=admin, anonymous=app.test_client())
+
+
+@pytest.fixture
+def statements(app):
+    executed = []
+
+    def record(conn, cursor, statement, *args):
+        executed.append(statement)
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', record)
+    yield executed
+    event.remove(engine, 'before_cursor_execute', record)
+
+
+def test_every_budget_has_a_url():
+    assert set(settings.BaseConfig.MYBLOG_QUERY_BUDGETS) == set(URLS)
+
+
+def test_config_not_leaked(app):
+    assert 'query_budget' not in settings.config
+    assert 'SQLALCHEMY_DATABASE_URI' not in vars(QueryBudgetConfig)
+
+
+@pytest.mark.parametrize('endpoint', sorted(URLS))
+def test_query_budget(app, clients, statements, endpoint):
+    client = clients['anonymous' if endpoint in ANONYMOUS else 'admin']
+    url = URLS[endpoint].format(**app.config['TEST_URL_VALUES'])
+    # 预热站点缓存、身份缓存等,预算以缓存已预热计,预热请求不检查
+    app.config['MYBLOG_QUERY_BUDGET_STRICT'] = False
+    try:
+        client.get(url).close()
+    finally:
+        app.config['MYBLOG_QUERY_BUDGET_STRICT'] = True
+    del statements[:]
+    response = client.get(url)
+    assert response.status_code == 200
+    response.get_data()     # 流式响应在读取时才执行查询
+    response.close()
+    budget = app.config['MYBLOG_QUERY_BUDGETS'][endpoint]
+    assert len(statements) <= budget, '%s executed %d queries (budget %d):\n%s' % (
+        url, len(statements), budget, '\n'.join(statements))